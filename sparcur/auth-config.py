@@ -17,4 +17,5 @@
   'datasets-no': None,
   'datasets-test': None,
   'sparse-limit': {'default': 10000,
-                   'environment-variables': 'SPARCUR_SPARSE_LIMIT SPARSE_LIMIT'},}}
+                   'environment-variables': 'SPARCUR_SPARSE_LIMIT SPARSE_LIMIT'},
+  'object-cache-limit-mb': {'environment-variables': 'SPARCUR_OBJECT_CACHE_LIMIT_MB'},}}
@@ -1,6 +1,7 @@
 import os
 import json
 from pathlib import PurePosixPath, PurePath
+from urllib.parse import urlparse
 from datetime import datetime
 import idlib
 import augpathlib as aug
@@ -15,6 +16,7 @@ class BlackfynnRemote(aug.RemotePath):
 
     _api_class = None  # set in _setup
     _async_rate = None
+    _fetch_scheduler = None  # see sparcur.fetching.FetchScheduler.bind
     _local_dataset_name = object()
 
     _exclude_uploaded = True
@@ -132,18 +134,45 @@ class BlackfynnRemote(aug.RemotePath):
             return cls._api.get_file_url(id, file_id)
 
     @classmethod
-    def get_file_by_id(cls, id, file_id):
+    def get_file_by_id(cls, id, file_id, start=0):
         url = cls.get_file_url(id, file_id)
-        yield from cls.get_file_by_url(url)
+        yield from cls.get_file_by_url(url, start=start)
 
     @classmethod
-    def get_file_by_url(cls, url):
-        """ NOTE THAT THE FIRST YIELD IS HEADERS """
-        resp = cls._requests.get(url, stream=True)
+    def get_file_by_url(cls, url, start=0):
+        """ NOTE THAT THE FIRST YIELD IS HEADERS
+
+            start > 0 requests the file from that byte onward so
+            that a partial download can be resumed """
+        scheduler = cls._fetch_scheduler
+        if scheduler is None:
+            yield from cls._get_file_by_url(url, start)
+            return
+
+        with scheduler.connection(urlparse(url).netloc):
+            for chunk in cls._get_file_by_url(url, start):
+                if isinstance(chunk, bytes):  # first yield is headers
+                    scheduler.transferred(len(chunk))
+
+                yield chunk
+
+    @classmethod
+    def _get_file_by_url(cls, url, start):
+        headers = {'Range': f'bytes={start}-'} if start else {}
+        resp = cls._requests.get(url, stream=True, headers=headers)
         headers = resp.headers
         yield headers
-        log.debug(f'reading from {url}')
+        log.debug(f'reading from {url} starting at {start}')
+        # if the server ignores the range we get the whole file back
+        skip = start if start and resp.status_code != 206 else 0
         for chunk in resp.iter_content(chunk_size=4096):  # FIXME align chunksizes between local and remote
+            if skip:
+                if len(chunk) <= skip:
+                    skip -= len(chunk)
+                    continue
+
+                chunk, skip = chunk[skip:], 0
+
             if chunk:
                 yield chunk
 
@@ -626,6 +655,39 @@ class BlackfynnRemote(aug.RemotePath):
 
         return True
 
+    @staticmethod
+    def _package_parent_int_id(remote):
+        """ packages listings only give the int id of the parent """
+        if remote.from_packages:
+            bfobject = remote.bfobject
+            json = (bfobject.package._json if hasattr(bfobject, 'package') else
+                    bfobject._json)
+            return json['content'].get('parentId', None)
+
+    def _sparse_parents(self):
+        """ map from folder int id to folder remote for the whole dataset
+
+            a package listing only has the int id of the parent, so get
+            every folder in one paginated listing of just the collections
+            instead of going to the network for each ancestor, the listing
+            links each folder to its parent so the remotes have their
+            parents set and walking up from them stays off the network """
+
+        remotes = {}
+        int_ids = {}
+        for bfobject in self.bfobject.packagesByType(includeSourceFiles=False,
+                                                     types=('Collection',)):
+            remote = self.__class__(bfobject)
+            remotes[remote.id] = remote
+            int_ids[bfobject._json['content']['id']] = remote.id
+
+        for remote in remotes.values():
+            parent = remote.bfobject.parent
+            if parent is not None and not isinstance(parent, str):
+                remote._c_parent = remotes[parent.id]
+
+        return {int_id:remotes[id] for int_id, id in int_ids.items()}
+
     def _rchildren(self,
                    create_cache=True,
                    exclude_uploaded=True,
@@ -646,7 +708,7 @@ class BlackfynnRemote(aug.RemotePath):
                 filenames = self._sparse_stems
                 sbfo = self.bfobject
                 _parents_yielded = set()
-                _int_id_map = {}
+                children = []
                 for bfobject in self.bfobject.packagesByName(filenames=filenames):
                     child = self.__class__(bfobject)
                     if child.is_dir() or child.is_file():
@@ -657,27 +719,21 @@ class BlackfynnRemote(aug.RemotePath):
                         #log.debug(f'skipping {child} becuase it is neither a directory nor a file')
                         continue
 
+                    children.append(child)
+
+                _int_id_map = self._sparse_parents()
+                for child in children:
                     parent = child
                     parents = []
                     while True:
                         log.debug(parent)
-                        parent_int_id = None
-                        if (parent.from_packages and
-                            'parentId' in parent.bfobject.package._json['content']):
-                            # FIXME HACK
-                            # FIXME incredibly slow, but still faster than non-sparse
-                            parent_int_id = parent.bfobject.package._json['content']['parentId']
-                            if parent_int_id not in _int_id_map:
-                                parent = self.__class__(parent.id)
-                                parent.bfobject
-                                _int_id_map[parent_int_id] = parent.parent
-
                         if not parents:  # add the child as the last parent
                             parents.append(parent)
 
                         if parent.parent_id in (sbfo, self.id):
                             break  # child yielded below
                         else:
+                            parent_int_id = self._package_parent_int_id(parent)
                             if parent_int_id is not None:
                                 parent = _int_id_map[parent_int_id]
                             else:
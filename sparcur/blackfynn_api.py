@@ -1,8 +1,10 @@
 import io
 import os
 import json
+import time
 import types
-from copy import deepcopy
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 #from nibabel import nifti1
 #from pydicom import dcmread
 #from scipy.io import loadmat
@@ -349,30 +351,161 @@ def packagesByName(self, pageSize=1000, includeSourceFiles=True, filenames=tuple
         yield from self._packages(pageSize=pageSize, includeSourceFiles=includeSourceFiles)
 
 
-def _packages(self, pageSize=1000, includeSourceFiles=True, raw=False, latest_only=False, filename=None):
+def packagesByType(self, pageSize=1000, includeSourceFiles=True, types=tuple()):
+    """ e.g. types=('Collection',) for every folder in the dataset """
+    yield from self._packages(pageSize=pageSize, includeSourceFiles=includeSourceFiles,
+                              types=types)
+
+
+def _get_with_backoff(session, url, retries=5, backoff=1):
+    """ retry connection errors and sporadic 5xx errors (usually 504s)
+        sleeping backoff * 2 ** attempt seconds between attempts """
+    for attempt in range(retries + 1):
+        try:
+            resp = session.get(url)
+            if resp.status_code < 500 or attempt == retries:
+                return resp
+
+            log.warning(f'{resp.status_code} on attempt {attempt} for {url}')
+        except (requests.exceptions.RetryError, ConnectionError) as e:
+            if attempt == retries:
+                raise e
+
+            log.warning(f'{e!r} on attempt {attempt} for {url}')
+
+        time.sleep(backoff * 2 ** attempt)
+
+
+def _package_pages(session, url, prefetch=True, retries=5):
+    """ yield the json of each page of a cursor paginated listing
+
+        the next page is requested in a background thread as soon as
+        the cursor for it is known so that the network round trip
+        overlaps with whatever the caller does with the current page """
+    def get(cursor_args=''):
+        return _get_with_backoff(session, url + cursor_args, retries=retries)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        resp = get()
+        while True:
+            if not resp.ok:
+                log.error(f'{resp.status_code} {resp.reason} for {resp.url}')
+                return
+
+            j = resp.json()
+            if 'cursor' not in j:
+                yield j
+                return
+
+            cursor_args = f'&cursor={j["cursor"]}'
+            if prefetch:
+                future = executor.submit(get, cursor_args)
+                yield j
+                resp = future.result()
+            else:
+                yield j
+                resp = get(cursor_args)
+
+
+def _packages(self, pageSize=1000, includeSourceFiles=True, raw=False, latest_only=False, filename=None,
+              types=tuple()):
     """ python implementation to make use of /dataset/{id}/packages """
     remapids = {}
     def restructure(j):
         """ restructure package json to match what api needs? """
         # FIXME something's still wonky here
+        # build new dicts instead of mutating so that bfobject._json
+        # can be the original package without paying for a deepcopy
         c = j['content']
-        c['int_id'] = c['id']
-        c['id'] = c['nodeId']  # FIXME indeed packages do seem to be missing ids!?
-        remapids[c['int_id']] = c['id']
-        c['int_datasetId'] = c['datasetId']
-        c['datasetId'] = c['datasetNodeId']
+        content = {**c,
+                   'int_id': c['id'],
+                   'id': c['nodeId'],  # FIXME indeed packages do seem to be missing ids!?
+                   'int_datasetId': c['datasetId'],
+                   'datasetId': c['datasetNodeId'],}
+        remapids[content['int_id']] = content['id']
         if 'parentId' in c:
             pid = c['parentId']
-            c['parent'] = remapids[pid]  # key error to signal out of order
-            #if pid in remapids:
-            #else:
-                #c['parent'] = f'WTF ERROR: {pid}'
-                #print('wtf', pid, c['id'], c['datasetId'])
-            #else:
-                #c['parent'] = remapids['latest']
-        return j
+            content['parent'] = remapids[pid]  # key error to signal out of order
+
+        return {**j, 'content': content}
 
     index = {self.id:self}  # make sure that dataset is in the index
+    # if a parent is on the other side of a pagination boundary
+    # its children wait here keyed on the parent's int id and are
+    # released as soon as the parent arrives so each package is
+    # only ever touched once no matter how the pages are ordered
+    pending = defaultdict(list)
+
+    def place(package):
+        """ restructure, attach to the parent, yield it and its files """
+        content = package['content']
+        name = content['name']
+        bftype = id_to_type(content['nodeId'])
+        if 'parentId' in content and content['parentId'] not in remapids:
+            # filename case, parents will simply not be listed
+            # if you are using filename then beware
+            rdp = restructure({**package,
+                               'content': {k:v for k, v in content.items()
+                                           if k != 'parentId'}})
+        else:
+            #if id.startswith('N:package:'):
+                #log.debug(lj(package))
+            rdp = restructure(package)
+
+        bfobject = bftype.from_dict(rdp, api=self._api)
+        if name != bfobject.name:
+            log.critical(f'{name} != {bfobject.name}')
+        bfobject._json = package
+        bfobject.dataset = index[bfobject.dataset]
+
+        if isinstance(bfobject.parent, str):
+            parent = index[bfobject.parent]
+            if parent._items is None:
+                parent._items = []
+            parent.items.append(bfobject)
+            bfobject.parent = parent
+            if parent.state == 'DELETING':
+                if not bfobject.state == 'DELETING':
+                    bfobject.state = 'PARENT-DELETING'
+            elif parent.state == 'PARENT-DELETING':
+                if not bfobject.state == 'DELETING':
+                    bfobject.state = 'PARENT-DELETING'
+
+        elif bfobject.dataset is None:
+            # both collections and packages can be at the top level
+            log.debug('No parent no dataset\n'
+                      + json.dumps(bfobject._json, indent=2))
+
+        # objects only go in the index once their parent is a bfobject,
+        # this ensures that you can always recurse to base once you get
+        # an object from this function
+        index[bfobject.id] = bfobject
+        yield bfobject
+
+        if isinstance(bfobject, DataPackage):
+            bfobject.fake_files = []
+            if 'objects' not in bfobject._json:
+                log.error(f'{bfobject} has no files!??!')
+            else:
+                for i, source in enumerate(bfobject._json['objects']['source']):
+                    # TODO package id?
+                    if len(source) > 1:
+                        log.info(f'more than one key in source {sorted(source)}')
+
+                    ff = FakeBFile(bfobject, **source['content'])
+                    bfobject.fake_files.append(ff)
+                    yield ff
+
+                    if i == 1:  # only log once
+                        log.critical(f'MORE THAN ONE FILE IN PACKAGE {bfobject.id}')
+
+    def place_and_release(package):
+        stack = [package]
+        while stack:
+            package = stack.pop()
+            yield from place(package)
+            stack.extend(pending.pop(package['content']['id'], ()))
+
     session = self._api.session
     #cursor
     #pageSize
@@ -380,139 +513,39 @@ def _packages(self, pageSize=1000, includeSourceFiles=True, raw=False, latest_on
     #types
     #filename
     filename_args = f'&filename={filename}' if filename is not None else ''
-    cursor_args = ''
-    out_of_order = []
-    while True:
-        try:
-            resp = session.get(f'https://api.blackfynn.io/datasets/{self.id}/packages?'
-                            f'pageSize={pageSize}&'
-                            f'includeSourceFiles={str(includeSourceFiles).lower()}'
-                            f'{filename_args}'
-                            f'{cursor_args}')
-        except requests.exceptions.RetryError as e:
-            log.exception(e)
-            # sporadic 504 errors that we probably need to sleep on
-            breakpoint()
-            raise e
+    types_args = f'&types={",".join(types)}' if types else ''
+    url = (f'https://api.blackfynn.io/datasets/{self.id}/packages?'
+           f'pageSize={pageSize}&'
+           f'includeSourceFiles={str(includeSourceFiles).lower()}'
+           f'{filename_args}'
+           f'{types_args}')
+    for j in _package_pages(session, url, prefetch=not latest_only):
+        packages = j['packages']
+        if raw:
+            yield from packages
+            if latest_only:
+                break
+            else:
+                continue
 
-        #print(resp.url)
-        if resp.ok:
-            j = resp.json()
-            packages = j['packages']
-            if raw:
-                yield from packages
-                if latest_only:
-                    break
-                else:
-                    continue
-
-            if out_of_order:
-                packages += out_of_order
-                # if a parent is on the other side of a
-                # pagination boundary put the children
-                # at the end and move on
-            out_of_order = [None]
-            while out_of_order:
-                #log.debug(f'{out_of_order}')
-                if out_of_order[0] is None:
-                    out_of_order.remove(None)
-                elif packages == out_of_order:
-                    if filename is not None:
-                        out_of_order = None
-                    elif 'cursor' not in j:
-                        raise RuntimeError('We are going nowhere!')
-                    else:
-                        # the missing parent is in another castle!
-                        break
-                else:
-                    packages = out_of_order
-                    out_of_order = []
-                for count, package in enumerate(packages):
-                    if isinstance(package, dict):
-                        id = package['content']['nodeId']
-                        name = package['content']['name']
-                        bftype = id_to_type(id)
-                        dcp = deepcopy(package)
-                        try:
-                            #if id.startswith('N:package:'):
-                                #log.debug(lj(package))
-                            rdp = restructure(dcp)
-                        except KeyError as e:
-                            if out_of_order is None:  # filename case
-                                # parents will simply not be listed
-                                # if you are using filename then beware
-                                if 'parentId' in dcp['content']:
-                                    dcp['content'].pop('parentId')
-                                rdp = restructure(dcp)
-                            else:
-                                out_of_order.append(package)
-                                continue
-
-                        bfobject = bftype.from_dict(rdp, api=self._api)
-                        if name != bfobject.name:
-                            log.critical(f'{name} != {bfobject.name}')
-                        bfobject._json = package
-                        bfobject.dataset = index[bfobject.dataset]
-                    else:
-                        bfobject = package
-
-                    if isinstance(bfobject.parent, str) and bfobject.parent in index:
-                        parent = index[bfobject.parent]
-                        if parent._items is None:
-                            parent._items = []
-                        parent.items.append(bfobject)
-                        bfobject.parent = parent
-                        # only put objects in the index when they have a parent
-                        # that is a bfobject, this ensures that you can always
-                        # recurse to base once you get an object from this function
-                        index[bfobject.id] = bfobject
-                        if parent.state == 'DELETING':
-                            if not bfobject.state == 'DELETING':
-                                bfobject.state = 'PARENT-DELETING'
-                        elif parent.state == 'PARENT-DELETING':
-                            if not bfobject.state == 'DELETING':
-                                bfobject.state = 'PARENT-DELETING'
-
-                        yield bfobject  # only yield if we can get a parent
-                    elif out_of_order is None:  # filename case
-                        yield bfobject
-                    elif bfobject.parent is None:
-                        # both collections and packages can be at the top level
-                        # dataset was set to its bfobject repr above so safe to yield
-                        if bfobject.dataset is None:
-                            log.debug('No parent no dataset\n'
-                                      + json.dumps(bfobject._json, indent=2))
-                        index[bfobject.id] = bfobject
-                        yield bfobject
-                    else:
-                        out_of_order.append(bfobject)
-                        continue
-
-                    if isinstance(bfobject, DataPackage):
-                        bfobject.fake_files = []
-                        if 'objects' not in bfobject._json:
-                            log.error(f'{bfobject} has no files!??!')
-                        else:
-                            for i, source in enumerate(bfobject._json['objects']['source']):
-                                # TODO package id?
-                                if len(source) > 1:
-                                    log.info(f'more than one key in source {sorted(source)}')
-
-                                ff = FakeBFile(bfobject, **source['content'])
-                                bfobject.fake_files.append(ff)
-                                yield ff
-
-                                if i == 1:  # only log once
-                                    log.critical(f'MORE THAN ONE FILE IN PACKAGE {bfobject.id}')
-
-            if 'cursor' in j:
-                cursor = j['cursor']
-                cursor_args = f'&cursor={cursor}'
+        for package in packages:
+            content = package['content']
+            if 'parentId' in content and content['parentId'] not in remapids:
+                pending[content['parentId']].append(package)
             else:
-                break
+                yield from place_and_release(package)
 
-        else:
-            break
+        if filename is not None:
+            # parents that match the filename are on the same page as
+            # their children, anything still waiting is an orphan
+            orphans = [p for ps in pending.values() for p in ps]
+            pending.clear()
+            for package in orphans:
+                yield from place_and_release(package)
+
+    if pending:
+        missing = sorted(pending)
+        raise RuntimeError(f'We are going nowhere! Missing parents {missing}')
 
 
 @property
@@ -530,6 +563,7 @@ def packageTypeCounts(self):
 Dataset._packages = _packages
 Dataset.packages = packages
 Dataset.packagesByName = packagesByName
+Dataset.packagesByType = packagesByType
 Dataset.packageTypeCounts = packageTypeCounts
 
 
@@ -48,6 +48,8 @@ Commands:
 
                 options: --empty
                        : --sparse-limit
+                       : --changed-only  skip datasets unchanged since the last pull
+                       : --diff          update datasets in place instead of rebuilding them
 
     refresh     retrieve remote file sizes and fild ids (can also fetch using the new data)
 
@@ -89,6 +91,8 @@ Commands:
                        : --open=P   open the output file with specified command
                        : --show     open the output file using xopen
                        : --mbf      extract and export mbf embedded metadata
+                       : --incremental  only rebuild datasets that changed since latest
+                       : --profile-pipelines  record time and memory per pipeline stage
 
     report      generate reports
 
@@ -161,6 +165,9 @@ Options:
     -f --fetch              fetch matching files
     -R --refresh            refresh matching files
     -r --rate=HZ            sometimes we can go too fast when fetching [default: 5]
+    --bandwidth=MBPS        cap total fetch bandwidth in megabytes per second
+    --per-host=N            max concurrent downloads from a single host [default: 8]
+    --large-mb=SIZE_MB      files this size or larger use the large fetch queue [default: 100]
     -l --limit=SIZE_MB      the maximum size to download in megabytes [default: 2]
                             use zero or negative numbers to indicate no limit
     -L --level=LEVEL        how deep to go in a refresh
@@ -181,11 +188,16 @@ Options:
     --project-path=<PTH>    set the project path manually
     --sparse-limit=COUNT    package count that forces a sparse pull [default: {auth.get('sparse-limit')}]
                             use zero or negative numbers to indicate no limit
+    --changed-only          only pull datasets whose remote updated time or
+                            package counts changed since their last pull
 
     -F --export-file=PATH   run reports on a specific export file
     -t --tab-table          print simple table using tabs for copying
     -A --latest             run derived pipelines from latest json
     -P --partial            run derived pipelines from the latest partial json export
+    --incremental           reuse unchanged datasets from the latest export
+    --profile-pipelines     record time and peak memory for each pipeline stage,
+                            derive, and subpipeline per dataset during export
     -W --raw                run reporting on live data without export
     --published             run on the latest published export
     --to-sheets             push report to google sheets
@@ -202,11 +214,13 @@ Options:
     -w --show               open the output file
     -U --upload             update remote target (e.g. a google sheet) if one exists
     -N --no-google          hack for ipv6 issues
-    -D --diff               diff local vs cache
+    -D --diff               diff local vs cache, for pull only apply the differences
 
     --port=PORT             server port [default: 7250]
 
     -j --jobs=N             number of jobs to run             [default: 12]
+                            N, auto, or per stage e.g. auto,export=32,xml=4
+                            stages: pull export xml manifests subpipelines fetch
     -d --debug              drop into a shell after running a step
     -v --verbose            print extra information
     --profile               profile startup performance
@@ -249,7 +263,7 @@ from sparcur import datasets as dat
 from sparcur import exceptions as exc
 from sparcur.core import JT
 from sparcur.core import OntId, OntTerm, adops
-from sparcur.utils import GetTimeNow  # top level
+from sparcur.utils import GetTimeNow, Concurrency  # top level
 from sparcur.utils import log, logd, loge, bind_file_handler
 from sparcur.utils import register_type, fromJson
 from sparcur.paths import Path, BlackfynnCache, StashPath
@@ -292,7 +306,8 @@ class Options(clif.Options):
 
     @property
     def jobs(self):
-        return int(self._args['--jobs'])
+        """ call with the stage name to get the number of workers """
+        return Concurrency.fromString(self._args['--jobs'])
 
     @property
     def limit(self):
@@ -314,6 +329,18 @@ class Options(clif.Options):
     def rate(self):
         return int(self._args['--rate']) if self._args['--rate'] else None
 
+    @property
+    def bandwidth(self):
+        return float(self._args['--bandwidth']) if self._args['--bandwidth'] else None
+
+    @property
+    def per_host(self):
+        return int(self._args['--per-host'])
+
+    @property
+    def large_mb(self):
+        return int(self._args['--large-mb'])
+
     @property
     def fetch(self):
         return self._args['--fetch'] or self._default_fetch
@@ -339,6 +366,15 @@ class Dispatcher(clif.Dispatcher):
     spcignore = ('.git',
                  '.~lock',)
 
+    def _path_index(self, path=None):
+        """ path index for the project containing path, built on first use """
+        index = (self.cwd if path is None else path).path_index
+        if index is not None and index.empty():
+            log.info(f'building path index at {index.db_path}')
+            index.build()
+
+        return index
+
     def _export(self, export_class, export_source_path=None, org_id=None):
 
         if export_source_path is None:
@@ -564,9 +600,24 @@ class Main(Dispatcher):
 
         self.project_path = self.anchor.local
         self.summary = Summary(self.project_path)
-        Summary._n_jobs = self.options.jobs
+        from sparcur import pipelines as pipes
+        jobs = self.options.jobs
+        Summary._n_jobs = jobs('export')
+
+        def nested(stage):
+            # pools inside export workers multiply with the export pool
+            # so they are serial unless the stage is set explicitly
+            if Summary._n_jobs > 1 and stage not in jobs.overrides:
+                return 1
+
+            return jobs(stage)
+
+        pipes.MapPathsCombinator._n_jobs = nested('manifests')
+        pipes.JSONPipeline._subpipeline_jobs = nested('subpipelines')
         if self.options.debug:
             Summary._debug = True
+            pipes.JSONPipeline._subpipeline_jobs = 1
+            pipes.MapPathsCombinator._n_jobs = 1
 
     def _setup_bfl(self):
         self.BlackfynnRemote._setup()
@@ -836,10 +887,12 @@ class Main(Dispatcher):
             d.pull(
                 time_now=self._time_now,
                 debug=self.options.debug,
-                n_jobs=12,
+                n_jobs=self.options.jobs('pull'),
                 log_level='DEBUG' if self.options.verbose else 'INFO',
                 Parallel=Parallel,
-                delayed=delayed,)
+                delayed=delayed,
+                changed_only=self.options.changed_only,
+                diff=self.options.diff,)
 
     def refresh(self):
         paths = self.paths
@@ -911,13 +964,92 @@ class Main(Dispatcher):
             self._print_paths(parent_moved, title='Parent moved')
 
         if not self.options.debug:
-            refreshed = Async(rate=hz)(deferred(path.cache.refresh)(
-                update_data=fetch, size_limit_mb=limit)
-                                       for path in self._not_dirs)
+            # the index is updated for these by _fetch_scheduled
+            self._fetch_scheduled(
+                lambda path: path.cache.refresh(update_data=fetch, size_limit_mb=limit),
+                self._not_dirs)
+            refreshed = tuple()
 
         else:
-            for path in self._not_dirs:
-                path.cache.refresh(update_data=fetch, size_limit_mb=limit)
+            refreshed = [path.cache.refresh(update_data=fetch, size_limit_mb=limit)
+                         for path in self._not_dirs]
+
+        self._reindex(paths, moved, refreshed)
+        if fetch:
+            self._evict_objects()
+
+    def _fetch_scheduled(self, function, paths):
+        """ run function over paths with a size aware scheduler for
+            fetching many files at once, downloads are only routed
+            through the scheduler for the duration of the run """
+        from sparcur.fetching import FetchScheduler
+        workers = self.options.jobs('fetch')
+        scheduler = FetchScheduler(small_workers=workers,
+                                   large_workers=max(workers // 4, 1),
+                                   large_mb=self.options.large_mb,
+                                   rate=self.options.rate,
+                                   bandwidth_mb=self.options.bandwidth,
+                                   per_host=self.options.per_host)
+        paths = list(paths)
+        results = tuple()
+        scheduler.bind(self.BlackfynnRemote)
+        try:
+            results = scheduler(function, paths)
+            return results
+        finally:
+            scheduler.unbind(self.BlackfynnRemote)
+            # every caller gets an index that matches what is on disk,
+            # including the paths that finished before an error
+            self._reindex(paths, refreshed=results)
+
+    def _evict_objects(self):
+        """ keep the object store under object-cache-limit-mb if it is set """
+        limit = auth.get('object-cache-limit-mb')
+        if limit is not None:
+            self.anchor.object_store.evict(int(limit))
+
+    def _reindex(self, paths, moved=tuple(), refreshed=tuple()):
+        """ update the path index for the paths touched by refresh
+            moved folders change the relpath of everything under them
+            so only the datasets containing them are reindexed in full """
+        index = self._path_index()
+        if index is None:
+            return
+
+        try:
+            project_path = index.project_path
+            datasets = set()
+            for old, new in moved:
+                parts = new.relative_to(project_path).parts
+                if parts:
+                    datasets.add(project_path / parts[0])
+                else:
+                    datasets.update(project_path.children)
+
+            for dataset in datasets:
+                if dataset.is_dir():
+                    index.index_dataset(dataset)
+
+            def todo(path):
+                parts = path.relative_to(project_path).parts
+                return parts and project_path / parts[0] not in datasets
+
+            # refresh can rename a file, new names come back in refreshed
+            new_paths = [c.local for c in refreshed
+                         if getattr(c, 'local', None) is not None]
+            gone, update = [], []
+            for path in chain(paths, new_paths):
+                if not todo(path):
+                    continue
+                elif path.exists() or path.is_symlink():
+                    update.append(path)
+                else:
+                    gone.append(path.relative_to(project_path).as_posix())
+
+            index.remove(gone)
+            index.update(update)
+        finally:
+            index.close()
 
     def _datasets_with_extension(self, extension):
         """ Hack around the absurd slowness of python's rglob """
@@ -953,16 +1085,15 @@ done"""
         if self.options.pretend:
             return
 
-        from pyontutils.utils import Async, deferred
-        hz = self.options.rate
-        Async(rate=hz)(deferred(path.cache.fetch)(
-            size_limit_mb=self.options.limit)
-                       for path in paths
-                       if not path.exists()
-                       # FIXME need a staging area ...
-                       # FIXME also, the fact that we sometimes need content_different
-                       # means that there may be silent fetch failures
-                       or path.content_different())
+        limit = self.options.limit
+        self._fetch_scheduled(lambda path: path.cache.fetch(size_limit_mb=limit),
+                              [path for path in paths
+                               if not path.exists()
+                               # FIXME need a staging area ...
+                               # FIXME also, the fact that we sometimes need content_different
+                               # means that there may be silent fetch failures
+                               or path.content_different()])
+        self._evict_objects()
 
     def _check_duplicates(self, datasets):
         # NOTE this is an ok sanity check
@@ -1036,7 +1167,7 @@ done"""
             self._check_duplicates(dataset_paths)
             self._check_exists(dataset_paths)
             blob_ir, *rest = export.export(dataset_paths=dataset_paths,
-                                           jobs=self.options.jobs,
+                                           jobs=self.options.jobs('xml'),
                                            debug=self.options.debug)
 
             return blob_ir
@@ -1049,7 +1180,9 @@ done"""
             noexport = (auth.get_list('datasets-noexport') +
                         auth.get_list('datasets-no'))
             blob_ir, *rest = export.export(dataset_paths=dataset_paths,
-                                           exclude=noexport)
+                                           exclude=noexport,
+                                           incremental=self.options.incremental,
+                                           profile_pipelines=self.options.profile_pipelines)
 
             sc.SummarySchema().validate_strict(export.latest_export)
 
@@ -1226,18 +1359,17 @@ done"""
                     print(p.cache.meta.as_pretty(pathobject=p))
 
             if self.options.fetch or self.options.refresh:
-                from pyontutils.utils import Async, deferred
-                hz = self.options.rate  # was 30
                 limit = self.options.limit
                 fetch = self.options.fetch
                 if self.options.refresh:
-                    Async(rate=hz)(deferred(path.remote.refresh)(
-                        update_cache=True, update_data=fetch, size_limit_mb=limit)
-                                   for path in paths)
+                    self._fetch_scheduled(lambda path: path.remote.refresh(
+                        update_cache=True, update_data=fetch, size_limit_mb=limit),
+                                          paths)
                 elif fetch:
-                    Async(rate=hz)(deferred(path.cache.fetch)(
-                        size_limit_mb=limit)
-                                   for path in paths)
+                    self._fetch_scheduled(lambda path: path.cache.fetch(size_limit_mb=limit),
+                                          paths)
+
+                self._evict_objects()
 
             else:
                 self._print_paths(paths)
@@ -1252,18 +1384,39 @@ done"""
         print(eff, feedback)
 
     def missing(self):
+        index = self._path_index()
         for path in self._paths:
-            for rc in path.rchildren:
-                if rc.is_broken_symlink():
-                    m = rc.cache.meta
-                    if m.file_id is None:
-                        #print(rc)
-                        print(m.as_pretty(pathobject=rc))
+            if index is not None:
+                try:
+                    rows = index.under(path.relative_to(index.project_path).as_posix(),
+                                       files_only=True)
+                finally:
+                    index.close()
+
+                rcs = [index.project_path / row.relpath for row in rows
+                       if not row.fetched and row.file_id is None]
+            else:
+                rcs = [rc for rc in path.rchildren if rc.is_broken_symlink()]
+
+            for rc in rcs:
+                m = rc.cache.meta
+                if m.file_id is None:
+                    #print(rc)
+                    print(m.as_pretty(pathobject=rc))
         #self.bfl.find_missing_meta()
 
     def xattrs(self):
-        raise NotImplementedError('This used to populate the metastore, '
-                                  'but currently does nothing.')
+        """ snapshot xattrs of everything under the paths into the metastore """
+        from sparcur.metastore import MetaStore
+        ms = MetaStore(Path(self.options.cache_path).expanduser() / 'metastore.db')
+        paths = self.paths
+        if not paths:
+            paths = self.cwd,
+
+        for path in paths:
+            ms.backup(chain((path,), path.rchildren))
+
+        ms.close()
 
     def meta(self):
         if self.options.browser:
@@ -1327,7 +1480,19 @@ done"""
         log.setLevel(old_level)
 
     def goto(self):
-        # TODO this needs an inverted index
+        index = self._path_index()
+        if index is not None:
+            rows = index.by_id(self.options.remote_id)
+            if rows:
+                row, *_ = rows
+                rc = index.project_path / row.relpath
+                if not row.is_dir:
+                    rc = rc.parent
+
+                print(rc.relative_path_from(self.cwd).as_posix())
+                return
+
+        # not in the index, it may be stale so fall back to walking
         if self.options.remote_id.startswith('N:dataset:'):
             gen = self.cwd.children
         else:
@@ -1352,11 +1517,26 @@ done"""
             print(f'{self.cwd} is not in a project!')
             sys.exit(111)
 
-        existing_files = [f for f in project_path.rchildren if f.is_file()]
+        index = self._path_index(project_path)
+        try:
+            rows = {row.relpath: row for row in index.under('', files_only=True)}
+        finally:
+            index.close()
+
+        def cached_meta(f):
+            # rows that are missing or older than the file, e.g. from a
+            # fetch during export, fall back to reading the xattrs
+            row = rows.get(f.relative_to(project_path).as_posix())
+            if row is not None and row.fetched and index.current(row, f):
+                return index.row_meta(row)
+
+        existing = [(f, cached_meta(f)) for f in project_path.rchildren if f.is_file()]
+
         different = []
-        for f in existing_files:
+        for f, cmeta in existing:
             try:
-                cmeta = f.cache.meta
+                if cmeta is None:
+                    cmeta = f.cache.meta
             except AttributeError:
                 if f.skip_cache:
                     continue
@@ -5,6 +5,7 @@ from types import GeneratorType
 from pathlib import PurePath
 from datetime import datetime, time
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from collections import deque, defaultdict
 import idlib
 import rdflib
@@ -20,6 +21,7 @@ from pyontutils.namespaces import tech, asp, dim, unit, rdf, owl, rdfs
 from sparcur import exceptions as exc
 from sparcur.utils import log, logd  # FIXME fix other imports
 from sparcur.utils import is_list_or_tuple, register_type
+from sparcur.profiling import profiler
 
 xsd = rdflib.XSD
 po = CustomTurtleSerializer.predicateOrder
@@ -837,6 +839,70 @@ class AtomicDictOperations:
 
         yield source
 
+    @classmethod
+    def compile_get(cls, source_path):
+        """ source_path -> function(data) -> (source_key, node_key, source)
+            same result and errors as _get_source, walks nested dicts
+            directly and only falls back when it hits a list or a miss """
+
+        source_path = tuple(source_path)
+        if not source_path:
+            raise TypeError('source_path may not be empty')
+
+        source_prefixes = source_path[:-1]
+        source_key = source_path[-1]
+        node_key = (source_prefixes[-1] if source_prefixes else
+                    AtomicDictOperations.__empty_node_key)
+        def get(data):
+            source = data
+            for key in source_prefixes:
+                if isinstance(source, dict) and key in source:
+                    source = source[key]
+                else:
+                    break
+            else:
+                if isinstance(source, dict) and source_key in source:
+                    return source_key, node_key, source
+
+            # slow path for lists and for the error messages
+            return tuple(cls._get_source(data, source_path))
+
+        return get
+
+    @classmethod
+    def compile_add(cls, target_path, update=False):
+        """ target_path -> function(data, value) same as add """
+
+        if not isinstance(target_path, (list, tuple)):
+            msg = f'target_path is not a list or tuple! {type(target_path)}'
+            raise TypeError(msg)
+
+        def slow(data, value):
+            cls.add(data, target_path, value, update=update)
+
+        if int in target_path:
+            return slow
+
+        target_prefixes = tuple(target_path[:-1])
+        target_key = target_path[-1]
+        def add(data, value):
+            target = data
+            for target_name in target_prefixes:
+                if not isinstance(target, dict):
+                    return slow(data, value)
+
+                if target_name not in target:
+                    target[target_name] = {}
+
+                target = target[target_name]
+
+            if not isinstance(target, dict) or not update and target_key in target:
+                return slow(data, value)  # raises TargetPathExistsError
+
+            target[target_key] = value
+
+        return add
+
     @classmethod
     def _copy_or_move(cls, data, source_path, target_path, move=False):
         """ if exists ... """
@@ -869,6 +935,33 @@ class AtomicDictOperations:
 adops = AtomicDictOperations()
 
 
+def _qualname(thing):
+    """ name used for profiling records """
+    return getattr(thing, '__qualname__', None) or repr(thing)
+
+
+class TransformPlan:
+    """ a DictTransformer spec compiled into a flat list of steps
+
+        each step is a closure over precomputed accessors for its paths
+        so applying a plan to a blob does not reinterpret the spec, see
+        DictTransformer.compile, calling a plan returns the step results """
+
+    def __init__(self, kind, spec, steps):
+        self.kind = kind
+        self.spec = spec
+        self.steps = tuple(steps)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.kind!r}, steps={len(self.steps)})'
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __call__(self, data):
+        return [step(data) for step in self.steps]
+
+
 class _DictTransformer:
     """ transformations from rules """
 
@@ -1024,7 +1117,11 @@ class _DictTransformer:
                 """ if we fail to get args then we can't gurantee that
                     derive_function will work at all so we wrap the lot """
                 args = cls.get(*get_args)
-                return derive_function(*args)
+                if not profiler.enabled:  # skip the context manager
+                    return derive_function(*args)
+
+                with profiler.measure('derive', _qualname(derive_function)):
+                    return derive_function(*args)
 
             def express_zip(*zip_args):
                 return tuple(zipeq(*zip_args))
@@ -1055,6 +1152,207 @@ class _DictTransformer:
                                 f'{derive_function}\n{target_paths}\n'
                                 f'{idmsg}\n') from e
 
+    @classmethod
+    def compile(cls, kind, spec, source_key_optional=False):
+        """ compile a spec for copy, move, pop, update, or derive into a
+            TransformPlan that behaves like calling that method with spec """
+
+        compilers = {'copy': cls._compile_copy,
+                     'move': cls._compile_move,
+                     'pop': cls._compile_pop,
+                     'update': cls._compile_update,
+                     'derive': cls._compile_derive,}
+        if kind not in compilers:
+            raise ValueError(f'cannot compile {kind!r} not in {tuple(compilers)}')
+
+        compile_step = compilers[kind]
+        if kind in ('copy', 'move', 'update', 'derive'):
+            steps = [compile_step(*step, source_key_optional=source_key_optional)
+                     for step in spec]
+        else:
+            steps = [compile_step(step, source_key_optional=source_key_optional)
+                     for step in spec]
+
+        return TransformPlan(kind, spec, steps)
+
+    @staticmethod
+    def _optional(get, source_key_optional):
+        """ wrap get so that missing sources return None like adops.apply """
+        if not source_key_optional:
+            return get
+
+        def optional(data):
+            try:
+                return get(data)
+            except exc.NoSourcePathError as e:
+                logd.debug(e)
+
+        return optional
+
+    @classmethod
+    def _compile_copy(cls, source_path, target_path, source_key_optional=False):
+        get = cls._optional(adops.compile_get(source_path), source_key_optional)
+        add = adops.compile_add(target_path)
+        def copy_step(data):
+            got = get(data)
+            if got is None:
+                return
+
+            source_key, _, source = got
+            value = source[source_key]
+            if value is data:
+                raise BaseException('should not happen?')
+
+            add(data, copy.deepcopy(value))  # FIXME same type mangling as adops.copy
+
+        return copy_step
+
+    @classmethod
+    def _compile_move(cls, source_path, target_path, source_key_optional=False):
+        get = cls._optional(adops.compile_get(source_path), source_key_optional)
+        add = adops.compile_add(target_path)
+        empty = adops._AtomicDictOperations__empty_node_key
+        def move_step(data):
+            got = get(data)
+            if got is None:
+                return
+
+            source_key, node_key, parent = got
+            value = parent.pop(source_key)
+            try:
+                add(data, value)
+            finally:
+                # FIXME matches adops._copy_or_move which also puts
+                # the value back on the parent under the last prefix key
+                if node_key is not empty:
+                    parent[node_key] = value
+
+        return move_step
+
+    @classmethod
+    def _compile_pop(cls, source_path, source_key_optional=False):
+        get = cls._optional(adops.compile_get(source_path), source_key_optional)
+        def pop_step(data):
+            got = get(data)
+            if got is None:
+                return
+
+            source_key, _, source = got
+            if isinstance(source, tuple):
+                return adops.pop(data, source_path)
+
+            return source.pop(source_key)
+
+        return pop_step
+
+    @classmethod
+    def _compile_update(cls, path, function, source_key_optional=False):
+        if int in path and path.index(int) > 0:
+            pivot = path.index(int)
+            get = cls._optional(adops.compile_get(path[:pivot]), source_key_optional)
+            after = path[pivot + 1:]
+            if after:
+                sub_step = cls._compile_update(after, function,
+                                               source_key_optional=source_key_optional)
+
+            def update_each(data):
+                got = get(data)
+                if got is None:
+                    return
+
+                source_key, _, source = got
+                collection = source[source_key]
+                assert is_list_or_tuple(collection)
+                if not after:
+                    # NOTE this is NOT functional, this modifies in place
+                    for i, value in enumerate(collection):
+                        new = function(value)
+                        if isinstance(new, GeneratorType):
+                            new = tuple(new)
+
+                        collection[i] = new
+                else:
+                    for obj in collection:
+                        sub_step(obj)
+
+            return update_each
+
+        elif int in path:
+            def update_slow(data):
+                cls.update(data, [[path, function]],
+                           source_key_optional=source_key_optional)
+
+            return update_slow
+
+        get = cls._optional(adops.compile_get(path), source_key_optional)
+        add = adops.compile_add(path, update=True)
+        def update_step(data):
+            got = get(data)
+            if got is None:
+                return
+
+            source_key, _, source = got
+            new = function(source[source_key])
+            if isinstance(new, GeneratorType):
+                new = tuple(new)
+
+            add(data, new)  # this will fail if data is immutable
+
+        return update_step
+
+    @classmethod
+    def _compile_derive(cls, source_paths, derive_function, target_paths,
+                        source_key_optional=True):
+        """ only the default empty='CULL' behavior of derive is supported """
+
+        gets = [adops.compile_get(sp) for sp in source_paths]
+        adds = [adops.compile_add(tp) for tp in target_paths]
+        name = _qualname(derive_function)
+        def empty(value):
+            return value is None or hasattr(value, '__iter__') and not len(value)
+
+        def derive_step(data):
+            try:
+                try:
+                    args = [source[source_key]
+                            for source_key, _, source in (get(data) for get in gets)]
+                    if not profiler.enabled:
+                        values = derive_function(*args)
+                    else:
+                        with profiler.measure('derive', name):
+                            values = derive_function(*args)
+                except exc.NoSourcePathError as e:
+                    if not source_key_optional:
+                        raise e
+
+                    logd.debug(e)
+                    values = None
+
+                if not target_paths:
+                    return  # allows nesting
+
+                try:
+                    pairs = tuple(zipeq(target_paths, values))
+                except (exc.NoSourcePathError, TypeError) as e:
+                    if not source_key_optional:
+                        raise e
+
+                    logd.debug(e)
+                    pairs = tuple()
+
+                for (_, value), add in zip(pairs, adds):
+                    if not empty(value):
+                        add(data, value)
+
+            except TypeError as e:
+                log.error('wat')
+                idmsg = data['id'] if 'id' in data else ''
+                raise TypeError(f'derive failed\n{source_paths}\n'
+                                f'{derive_function}\n{target_paths}\n'
+                                f'{idmsg}\n') from e
+
+        return derive_step
+
     @staticmethod
     def _derive(data, derives, source_key_optional=True, allow_empty=False):
         # OLD
@@ -1124,10 +1422,19 @@ class _DictTransformer:
 
     @classmethod
     def subpipeline(cls, data, runtime_context, subpipelines, update=True,
-                    source_key_optional=True, lifters=None):
+                    source_key_optional=True, lifters=None, jobs=1):
         """
             [[[[get-path, add-path], ...], pipeline-class, target-path], ...]
 
+            jobs > 1 runs the subpipelines in a thread pool, results
+            are still merged into data in declaration order
+
+            NOTE only threads, not processes, pickling is not the issue,
+            PathPipelines keep only a path and a template version and
+            MapPathsCombinator sends them to joblib, but subpipelines in
+            general may hold lifters and stateful subpipelines mutate
+            their input in place which a copy in another process would lose
+
             NOTE: this function is a generator, you have to express it!
         """
 
@@ -1161,12 +1468,38 @@ class _DictTransformer:
             prepared.append((target_path, pipeline_class, DataWrapper(selected_data),
                              lifters, runtime_context))
 
+        def pdata(p, pc):
+            if not profiler.enabled:
+                return p.data
+
+            with profiler.measure('subpipeline', _qualname(pc)):
+                return p.data
+
+        def run(target_path, pc, p):
+            try:
+                return target_path, pc, p, pdata(p, pc), None
+            except BaseException as e:
+                return target_path, pc, p, None, e
+
+        jobs = min(jobs, len(prepared))
+        if jobs > 1:
+            # inputs were all selected above so the subpipelines are
+            # independent, results are merged below in declaration order
+            instances = [(target_path, pc, pc(*args)) for target_path, pc, *args in prepared]
+            with ThreadPoolExecutor(max_workers=jobs) as pool:
+                results = list(pool.map(lambda i: run(*i), instances))
+        else:
+            # construct and run one at a time after the previous is merged
+            results = (run(target_path, pc, pc(*args)) for target_path, pc, *args in prepared)
+
         function = adops.update if update else adops.add
-        for target_path, pc, *args in prepared:
-            p = pc(*args)
+        for target_path, pc, p, value, error in results:
             if target_path is not None:
                 try:
-                    function(data, target_path, p.data)
+                    if error is not None:
+                        raise error
+
+                    function(data, target_path, value)
                 except BaseException as e:
                     import inspect
                     if isinstance(pc, object):
@@ -1188,8 +1521,9 @@ class _DictTransformer:
                         f'Error while processing {p}.data for\n{__path}\n'
                         f'{__file}{__line}') from e
 
-            else:
-                p.data  # trigger the pipeline since it is stateful
+            elif error is not None:
+                # the pipeline is stateful and was only run for its side effects
+                raise error
 
             yield p
 
@@ -1,6 +1,6 @@
 import json
+import hashlib
 import logging
-import tempfile
 from socket import gethostname
 from functools import wraps
 import idlib
@@ -11,9 +11,11 @@ from sparcur.core import JT
 from sparcur.core import adops, OntTerm, JEncode
 from sparcur.paths import Path, BlackfynnCache
 from sparcur.state import State
+from sparcur.profiling import profiler
 from sparcur.utils import log, fromJson, register_type
 from sparcur import schemas as sc
 from sparcur.export.triples import TriplesExportDataset, TriplesExportSummary
+from sparcur.export.blobs import load_ir, StoredDatasets
 from sparcur.datasources import OrganData, OntologyData
 from sparcur.protocols import ProtocolData
 from sparcur import schemas as sc
@@ -461,12 +463,25 @@ class Summary(Integrator, ExporterSummarizer):
     _debug = False
     _n_jobs = 12
 
-    def __new__(cls, path, dataset_paths=tuple(), exclude=tuple()):
+    def __new__(cls, path, dataset_paths=tuple(), exclude=tuple(),
+                previous=None, blob_store=None, profile_path=None):
         #cls.schema = cls.schema_class()
         cls.schema_out = cls.schema_out_class()
         return super().__new__(cls, path)
 
-    def __init__(self, path, dataset_paths=tuple(), exclude=tuple()):
+    def __init__(self, path, dataset_paths=tuple(), exclude=tuple(),
+                 previous=None, blob_store=None, profile_path=None):
+        """ previous is None for a full rebuild, otherwise it is a dict
+            {'fingerprints': {id: fp}, 'datasets': {id: blob}} from the
+            last export, datasets whose fingerprint matches are reused,
+            the blobs must be ir, not export json, and with a blob store
+            anything in the store is reused whether or not it is here
+
+            blob_store is an export.blobs.DatasetBlobStore, if present
+            workers write there instead of returning blobs via joblib
+
+            profile_path is a folder, if present each dataset writes its
+            pipeline profile there, see sparcur.profiling """
         super().__init__(path)
         # not sure if this is kosher ... but it works
 
@@ -474,7 +489,11 @@ class Summary(Integrator, ExporterSummarizer):
         super().__init__(self.path.cache.anchor.local) # FIXME ugh
         self._use_these_datasets = dataset_paths
         self._exclude = exclude
- 
+        self._previous = previous
+        self._blob_store = blob_store
+        self._profile_path = profile_path
+        self.fingerprints = None
+
     @property
     def iter_datasets_safe(self):
         if self._use_these_datasets:
@@ -535,7 +554,9 @@ class Summary(Integrator, ExporterSummarizer):
         # that always works at the top level regardless of which
         # file it is give?
 
-        # TODO parallelize and stream this!
+        # NOTE with a blob store gen is StoredDatasets and each pass
+        # over it reads the blobs back one at a time, otherwise the ir
+        # for the whole organization is in memory
         out = {'id': self.id,
                'meta': {'folder_name': self.name,
                         'uri_api': self.uri_api,
@@ -543,7 +564,7 @@ class Summary(Integrator, ExporterSummarizer):
                'prov': {'export_system_identifier': Path.sysid,
                         'export_hostname': gethostname(),
                         'export_project_path': self.path.cache.anchor.local,},}
-        ds = list(gen)
+        ds = gen if isinstance(gen, (list, StoredDatasets)) else list(gen)
         count = len(ds)
         out['datasets'] = ds
         out['meta']['count'] = count
@@ -581,45 +602,175 @@ class Summary(Integrator, ExporterSummarizer):
 
             ca = self.path._cache_class._remote_class._cache_anchor
 
+            datasets = list(self.iter_datasets_safe)
+            store = self._blob_store
+            if self._previous is not None or store is not None:
+                self.fingerprints = self._fingerprint(datasets, helpers)
+
+            todo, reused = self._split_reuse(datasets, timestamp)
+
+            fps = self.fingerprints
             if not self._debug and self._n_jobs > 1:  # yes debug masks jobs for now
-                from joblib import Parallel, delayed
                 # this flies with no_google, so something is up with
                 # the reserialization of the Sheets classes I think
-                # FIXME I suspect that the major bottleneck here is deserialization
-                # of the types back into this thread, once we have the json -> IR
-                # loader we should be able to simply write out the json for each
-                # dataset and then reload them all at once and possibly even do
-                # the per-dataset ttl conversion as well, parsing the ttl is probably
-                # a bad call though
-                hrm = Parallel(n_jobs=self._n_jobs)(
-                    delayed(datame)(d, ca, timestamp, helpers, log.level)
-                    for d in self.iter_datasets_safe)
-                #hrm = Async()(deferred(datame)(d) for d in self.iter_datasets)
-                self._data_cache = self.make_json(hrm)
+                # helpers, the anchor, and logging are sent to each
+                # worker exactly once by the pool initializer, tasks
+                # are just (path, fingerprint) and results are either
+                # the fingerprint written to the blob store or a json
+                # string, never the ir
+                import multiprocessing
+                initargs = ca, timestamp, helpers, log.level, store, self._profile_path
+                tasks = [(d.path, fps[d.id] if fps else None) for d in todo]
+                with multiprocessing.Pool(self._n_jobs,
+                                          initializer=_datame_init,
+                                          initargs=initargs) as pool:
+                    hrm = list(pool.imap(_datame_worker, tasks))
+
+                if store is None:
+                    hrm = [load_ir(json.loads(j)) for j in hrm]
+
             else:
-                self._data_cache = self.make_json(datame(d, ca, timestamp, helpers)
-                                                  for d in self.iter_datasets_safe)
+                hrm = [datame(d, ca, timestamp, helpers, log.level,
+                              store, fps[d.id] if fps else None,
+                              self._profile_path)
+                       for d in todo]
+
+            if store is not None:
+                for d, fp in zip(todo, hrm):
+                    if fp != fps[d.id]:
+                        raise ValueError(f'no blob written for {d.id} {fps[d.id]}')
+
+                store.evict(keep=fps.items())
+                stored = StoredDatasets(store, [(d.id, fps[d.id]) for d in datasets],
+                                        timestamp)
+                if any(blob is not None for blob in reused.values()):
+                    # reused from the previous export and not in the store
+                    hrm = [reused[d.id] if reused.get(d.id) is not None else stored[i]
+                           for i, d in enumerate(datasets)]
+                else:
+                    hrm = stored
+
+            elif reused:
+                # keep the usual dataset ordering
+                fresh = {d.id:b for d, b in zip(todo, hrm)}
+                hrm = [reused[d.id] if d.id in reused else fresh[d.id]
+                       for d in datasets]
+
+            self._data_cache = self.make_json(hrm)
 
         return self._data_cache
 
-    @hasSchema.f(sc.SummarySchema, fail=True)
+    @staticmethod
+    def _helpers_fingerprint(helpers):
+        # FIXME organ and member are not covered, they are backed by
+        # remote services with no cheap notion of a version
+        def sheet_rows(helper):
+            try:
+                return helper.values
+            except AttributeError:
+                # fake sheets for no_google and local_only
+                return helper.__class__.__name__
+
+        from sparcur import __version__
+        rows = (__version__,
+                *((name, sheet_rows(helpers[name]))
+                  for name in ('organs_sheet', 'affiliations', 'overview_sheet')
+                  if name in helpers))
+        return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+    def _fingerprint(self, datasets, helpers):
+        """ Dataset.fingerprint walks the whole dataset, so reuse the
+            fingerprint from the last export if the path index shows
+            that nothing under the dataset has changed since """
+        hfp = self._helpers_fingerprint(helpers)
+        index = self.path.path_index
+        if index is None:
+            return {d.id:d.datasetdata.fingerprint((hfp,)) for d in datasets}
+
+        fps = {}
+        try:
+            for d in datasets:
+                relpath = d.path.relative_to(index.project_path).as_posix()
+                state = index.dataset_state(relpath, extra=(hfp,))
+                fp = None if state is None else index.fingerprint(d.id, state)
+                if fp is None:
+                    fp = d.datasetdata.fingerprint((hfp,))
+                    if state is not None:
+                        index.set_fingerprint(d.id, state, fp)
+
+                fps[d.id] = fp
+        finally:
+            index.close()
+
+        return fps
+
+    def _split_reuse(self, datasets, timestamp):
+        """ todo, reused, a full rebuild never reuses anything
+            even if a blob for the same fingerprint is in the store """
+        if self._previous is None:
+            return datasets, {}
+
+        return self._incremental(datasets, timestamp)
+
+    def _incremental(self, datasets, timestamp):
+        """ split datasets into those that need to go through the
+            pipeline and those we can reuse, either from the blob
+            store or from the previous export, reused maps the
+            dataset id to its blob or to None if it is in the store """
+        previous_fingerprints = self._previous.get('fingerprints', {})
+        previous_datasets = self._previous.get('datasets', {})
+        store = self._blob_store
+        todo = []
+        reused = {}
+        for d in datasets:
+            fp = self.fingerprints[d.id]
+            if store is not None and store.exists(d.id, fp):
+                # read when the summary is iterated, see StoredDatasets
+                reused[d.id] = None
+                continue
+            elif (d.id in previous_datasets and
+                  previous_fingerprints.get(d.id) == fp):
+                blob = previous_datasets[d.id]
+            else:
+                todo.append(d)
+                continue
+
+            # NOTE this timestamps the reused data AS INTENDED
+            blob['prov']['timestamp_export_start'] = timestamp
+            reused[d.id] = blob
+
+        if reused:
+            log.info(f'reusing {len(reused)} unchanged datasets, '
+                     f'rebuilding {len(todo)}')
+
+        return todo, reused
+
     def data(self, timestamp=None):
         data = self._pipeline_end(timestamp)
-        return data  # FIXME we want objects that wrap the output rather than generate it ...
+        return self._validate(data)  # FIXME we want objects that wrap the output rather than generate it ...
 
-    @hasSchema.f(sc.SummarySchema, fail=True)
     def data_for_export(self, timestamp):
         data = self._pipeline_end(timestamp)
         # NOTE this timestamps the cached data AS INTENDED
         data['prov']['timestamp_export_start'] = timestamp
+        return self._validate(data)
+
+    def _validate(self, data):
+        if isinstance(data['datasets'], StoredDatasets):
+            # SummarySchema only checks that each dataset is an object,
+            # DatasetOutSchema already ran on each of them in datame,
+            # so don't read the whole organization back just for this
+            self._validate_summary({**data, 'datasets': [{}] * len(data['datasets'])})
+            return data
+
+        return self._validate_summary(data)
+
+    @hasSchema.f(sc.SummarySchema, fail=True)
+    def _validate_summary(self, data):
         return data
 
 
-_p = Path(tempfile.gettempdir()) / 'asdf'
-_p.mkdir(exist_ok=True)  # FIXME XXXXXXXXXXXXXXXXXXXXXXXXXX
-def datame(d, ca, timestamp, helpers=None, log_level=logging.INFO, dp=_p,
-           evil=[False], dumb=False):
-    """ sigh, pickles """
+def _datame_setup(ca, log_level):
     log_names = ('sparcur',
                  'idlib',
                  'protcur',
@@ -637,7 +788,7 @@ def datame(d, ca, timestamp, helpers=None, log_level=logging.INFO, dp=_p,
             if log.level != log_level:
                 log.setLevel(log_level)
 
-    rc = d.path._cache_class._remote_class
+    rc = Path._cache_class._remote_class
     if not hasattr(rc, '_cache_anchor'):
         rc._setup()
         rc.anchorTo(ca)
@@ -651,35 +802,70 @@ def datame(d, ca, timestamp, helpers=None, log_level=logging.INFO, dp=_p,
         # can't use ca.__class__ because it is the posix variant of # _cache_class
         BlackfynnCache._anchor = ca
 
+
+_datame_state = {}
+def _datame_init(ca, timestamp, helpers, log_level, blob_store, profile_path=None):
+    """ runs once per worker process """
+    _datame_setup(ca, log_level)
+    _datame_state.update(timestamp=timestamp,
+                         helpers=helpers,
+                         blob_store=blob_store,
+                         profile_path=profile_path)
+
+
+def _datame_worker(task):
+    path, fingerprint = task
+    s = _datame_state
+    d = IntegratorSafe(path)
+    blob = _datame(d, s['timestamp'], s['helpers'], s['blob_store'], fingerprint,
+                   s['profile_path'])
+    if s['blob_store'] is None:
+        # much cheaper to pickle than the ir
+        return json.dumps(blob, cls=JEncode)
+
+    return blob
+
+
+def datame(d, ca, timestamp, helpers=None, log_level=logging.INFO,
+           blob_store=None, fingerprint=None, profile_path=None):
+    """ sigh, pickles
+
+        if blob_store is provided the results are written there and
+        only the fingerprint is returned so that nothing has to be sent back """
+    _datame_setup(ca, log_level)
+    return _datame(d, timestamp, helpers, blob_store, fingerprint, profile_path)
+
+
+def _datame(d, timestamp, helpers, blob_store, fingerprint, profile_path=None):
+    if profile_path is None:
+        return _datame_inner(d, timestamp, helpers, blob_store, fingerprint)
+
+    if not profiler.enabled:
+        profiler.start()
+
+    with profiler.dataset(d.id):
+        try:
+            return _datame_inner(d, timestamp, helpers, blob_store, fingerprint)
+        finally:
+            profiler.dump(profile_path / (d.id + '.json'))
+
+
+def _datame_inner(d, timestamp, helpers, blob_store, fingerprint):
     prp = d.path.project_relative_path
     if helpers is not None:
         d.add_helpers(helpers)
 
-    out_path = (dp / d.id).with_suffix('.json')
-    if out_path.exists() and dumb:
-        if not evil[0]:  # FIXME this is SO DUMB to do in here, but ...
-            from pysercomb.pyr import units as pyru
-            [register_type(c, c.tag) for c in (pyru._Quant, pyru.Range)]
-            pyru.Term._OntTerm = OntTerm  # the tangled web grows ever deeper :x
-            evil[0] = True
-
-        log.warning(f'loading from path {out_path}')
-        # FIXME this is _idiotically_ slow with joblib
-        # multiple orders of magnitude faster just using listcomp
-        with open(out_path, 'rt') as f:
-            return fromJson(json.load(f))
-
     blob_dataset = d.data_for_export(timestamp)
-    with open(out_path.with_suffix('.raw.json'), 'wt') as f:  # FIXME XXXXXXXXXXXXXXXXXXXXXXXXXXXX
-        json.dump(blob_dataset, f, sort_keys=True, indent=2, cls=JEncode)
+    if blob_store is None:
+        return blob_dataset
 
     try:
         pipe = pipes.IrToExportJsonPipeline(blob_dataset)  # FIXME network sandbox violation
         blob_export = pipe.data
-        with open(out_path, 'wt') as f:  # FIXME XXXXXXXXXXXXXXXXXXXXXXXXXXXX
-            json.dump(blob_export, f, sort_keys=True, indent=2, cls=JEncode)
     except Exception as e:
         log.exception(e)
         log.critical(f'error during fancy json export, see previous log entry')
+        blob_export = None
 
-    return blob_dataset
+    blob_store.put(d.id, fingerprint, blob_dataset, blob_export)
+    return fingerprint
@@ -1,6 +1,7 @@
 import io
 import csv
 import copy
+import hashlib
 from types import GeneratorType
 from itertools import chain
 from collections import Counter, defaultdict
@@ -16,6 +17,7 @@ from . import normalization as nml
 from .core import log, logd, HasErrors
 from .paths import Path, BlackfynnCache
 from .utils import is_list_or_tuple
+from .metascan import MetaTable
 
 
 # FIXME review this :/ it is not a good implementation at all
@@ -178,54 +180,43 @@ class DatasetStructure(Path):
 
             setattr(cls, section, sec)
 
+    @property
+    def meta_table(self):
+        """ one batched scan of the remote metadata for everything under
+            this path, reused by counts, files_last_updated, and
+            data_dir_structure """
+        if not hasattr(self, '_meta_table'):
+            self._meta_table = MetaTable.fromPath(self)
+
+        return self._meta_table
+
     def files_last_updated(self):
         # FIXME TODO can we get this more efficiently during pull?
-        all_updated = [c.cache.meta.updated for c in
-                       chain((self,), self.rchildren) if c.is_file()]
-        if all_updated:
-            return max(all_updated)
+        if not self.is_dir():
+            if self.is_file():
+                return self.cache.meta.updated
+
+            return
+
+        return self.meta_table.files_last_updated()
 
     @property
     def counts(self):
         if not hasattr(self, '_counts'):
-            size = 0
-            dirs = 0
-            files = 0
-            need_meta = []
             if not self.is_dir():
-                gen = self,
-
-            else:
-                gen = self.rchildren
-
-            for c in gen:
-                if c.is_dir():
-                    dirs += 1
-                    maybe_size = 0  # the remote size of a folder is zero for bf
+                # FIXME do we ever actually hit this?
+                if self.is_broken_symlink():
+                    size = aug.PathMeta.from_symlink(self).size
                 else:
-                    files += 1  # testing for broken symlinks is hard
-                    try:
-                        if c.is_broken_symlink():
-                            maybe_size = (aug.PathMeta
-                                          .from_symlink(c)
-                                          .size)
-                        else:
-                            _meta = aug.PathMeta.from_xattrs(c.xattrs(),
-                                                             prefix='bf')
-                            if _meta.size is not None:
-                                maybe_size = _meta.size
-                            elif c.is_file():  # running an export on a local dataset
-                                maybe_size = c.size
-
-                        #maybe_size = c.cache.meta.size
-                    except AttributeError as e:
-                        log.error(f'no cache or no meta for {c}\n{e}')
-                        continue
+                    size = aug.PathMeta.from_xattrs(self.xattrs(), prefix='bf').size
+                    if size is None and self.is_file():
+                        size = self.size
 
-                    if maybe_size is None:
-                        need_meta.append(c)
-                    else:
-                        size += maybe_size
+                dirs, files, need_meta = 0, 1, ([] if size is not None else [self])
+                size = size or 0
+
+            else:
+                size, dirs, files, need_meta = self.meta_table.counts()
 
             if need_meta and self._refresh_on_missing:
                 msg = "We don't do this anymore. Fetch everything first."
@@ -348,6 +339,8 @@ class DatasetStructure(Path):
                     except self._requests.exceptions.ConnectionError as e:
                         raise exc.NetworkFailedForPathError(path) from e
 
+                    path._index_update()
+
                 if path.suffix in path.stem:
                     msg = f'path has duplicate suffix {path.as_posix()!r}'
                     self.addError(msg,
@@ -419,10 +412,56 @@ class DatasetStructure(Path):
         # resolve the cache for now so we can get the nice json
         # metadata but ultimately we will need _caceh_jsonMetadata or similar
         # that uses xattrs to avoid the overhead of constructing the cache class
+        table = self.meta_table
         return {d.dataset_relative_path:{**d.cache._jsonMetadata(),
-                                         'path_meta': {k:v for k, v in self.__class__(d).cache_meta.items()
+                                         'path_meta': {k:v for k, v in table.dir_metas[relpath].items()
                                                        if v is not None}}
-                for d in (Path(d) for d in self.rchildren_dirs)}
+                for relpath in table.dirs()
+                for d in (Path(self / relpath),)}
+
+    def fingerprint(self, extra=tuple()):
+        """ a digest of everything the dataset pipeline reads from disk
+            xattrs of the metadata files, dir_structure, and counts
+            extra is for things that live outside the dataset e.g. helpers
+
+            NOTE this is xattrs only, nothing is fetched and no files
+            are read, so if the pipeline starts depending on something
+            new it needs to be added here or incremental exports will
+            silently reuse stale blobs """
+
+        def meta_row(path):
+            if path.is_broken_symlink():
+                meta = aug.PathMeta.from_symlink(path)
+            else:
+                meta = aug.PathMeta.from_xattrs(path.xattrs(), prefix='bf')
+
+            return (path.dataset_relative_path.as_posix(),
+                    meta.id,
+                    meta.updated,
+                    meta.checksum,
+                    meta.size,)
+
+        meta_rows = sorted(meta_row(p)
+                           for section_name in self.sections
+                           for p in self._abstracted_paths(
+                                   section_name,
+                                   glob_type=('rglob' if section_name in self.rglobs
+                                              else 'glob'),
+                                   fetch=False))
+        table = self.meta_table
+        dir_rows = sorted((Path(self / relpath).dataset_relative_path.as_posix(),
+                           meta.id,
+                           meta.updated,)
+                          for relpath in table.dirs()
+                          for meta in (table.dir_metas[relpath],))
+        counts = self.counts
+        rows = (self.cache.id,
+                self.cache.meta.updated,
+                counts['size'], counts['dirs'], counts['files'],
+                meta_rows,
+                dir_rows,
+                tuple(extra),)
+        return hashlib.sha256(repr(rows).encode()).hexdigest()
 
     def inverted_index(self):
         # TODO there are two steps here
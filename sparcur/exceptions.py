@@ -165,3 +165,12 @@ class StopTheWorld(SparCurError):
 
 class NotUploadedToRemoteYetError(SparCurError):
     """ signal that the file in question has not been uploaded """
+
+
+class ChecksumMismatchError(SparCurError):
+    """ a completed download does not match the remote checksum """
+
+
+class IncompleteDownloadError(SparCurError):
+    """ a download ended early, the partial object is kept so that
+        the next fetch can resume from where this one stopped """
@@ -0,0 +1,178 @@
+import os
+import json
+import tempfile
+from sparcur.core import JEncode, OntTerm
+from sparcur.utils import loge, fromJson, register_type
+
+
+_types_registered = [False]
+def load_ir(blob):
+    """ json -> ir, registers the pysercomb types the first time """
+    if not _types_registered[0]:
+        _types_registered[0] = True
+        from pysercomb.pyr import units as pyru
+        [register_type(c, c.tag) for c in (pyru._Quant, pyru.Range)]
+        pyru.Term._OntTerm = OntTerm  # the tangled web grows ever deeper :x
+
+    return fromJson(blob)
+
+
+class DatasetBlobStore:
+    """ on disk store for per dataset blobs keyed on dataset id and
+        input fingerprint so that workers can write their results
+        here instead of sending them back through joblib
+
+        <root>/<dataset-id>/<fingerprint>.raw.json  internal representation
+        <root>/<dataset-id>/<fingerprint>.json      export json
+    """
+
+    max_size_mb = 4096
+
+    def __init__(self, root, max_size_mb=None):
+        self.root = root
+        if max_size_mb is not None:
+            self.max_size_mb = max_size_mb
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.root!r})'
+
+    def _path(self, id, fingerprint, suffix):
+        # dataset ids contain colons, fine on posix, not elsewhere
+        return self.root / id / (fingerprint + suffix)
+
+    def path_ir(self, id, fingerprint):
+        return self._path(id, fingerprint, '.raw.json')
+
+    def path_export(self, id, fingerprint):
+        return self._path(id, fingerprint, '.json')
+
+    def exists(self, id, fingerprint):
+        return self.path_ir(id, fingerprint).exists()
+
+    @staticmethod
+    def _write(path, blob):
+        """ write to a temp file in the same folder and then rename
+            so that readers never see a partial blob """
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tpath = tempfile.mkstemp(dir=path.parent, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wt') as f:
+                json.dump(blob, f, sort_keys=True, indent=2, cls=JEncode)
+
+            os.replace(tpath, path)
+        except BaseException as e:
+            os.unlink(tpath)
+            raise e
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rt') as f:
+            blob = json.load(f)
+
+        os.utime(path)  # mtime tracks last use for eviction
+        return blob
+
+    def put(self, id, fingerprint, blob_ir, blob_export=None):
+        # export first so that the existence of the ir means both are done
+        path_export = self.path_export(id, fingerprint)
+        if blob_export is not None:
+            self._write(path_export, blob_export)
+        elif path_export.exists():
+            # don't pair the new ir with an export from an older run
+            path_export.unlink()
+
+        self._write(self.path_ir(id, fingerprint), blob_ir)
+
+    def get_ir(self, id, fingerprint, raw=False):
+        """ raw=True skips the json -> ir conversion """
+        blob = self._read(self.path_ir(id, fingerprint))
+        return blob if raw else load_ir(blob)
+
+    def get_export(self, id, fingerprint):
+        """ None if the export json was never written for this blob """
+        path = self.path_export(id, fingerprint)
+        if path.exists():
+            return self._read(path)
+
+    def evict(self, keep=tuple()):
+        """ remove least recently used blobs until the store is
+            under max_size_mb, never removes anything in keep
+            keep is an iterable of (id, fingerprint) pairs """
+        if not self.root.exists():
+            return
+
+        keep = set(keep)
+        entries = []
+        total = 0
+        for dataset_dir in self.root.iterdir():
+            groups = {}
+            for path in dataset_dir.iterdir():
+                fingerprint = path.name.split('.', 1)[0]
+                st = path.stat()
+                total += st.st_size
+                size, mtime, paths = groups.get(fingerprint, (0, 0, []))
+                paths.append(path)
+                groups[fingerprint] = size + st.st_size, max(mtime, st.st_mtime), paths
+
+            entries.extend((mtime, size, (dataset_dir.name, fingerprint), paths)
+                           for fingerprint, (size, mtime, paths) in groups.items())
+
+        limit = self.max_size_mb * 1024 ** 2
+        if total <= limit:
+            return
+
+        removed = 0
+        for mtime, size, key, paths in sorted(entries):
+            if total <= limit:
+                break
+            if key in keep:
+                continue
+
+            for path in paths:
+                path.unlink()
+
+            dataset_dir = paths[0].parent
+            if not list(dataset_dir.iterdir()):
+                dataset_dir.rmdir()
+
+            total -= size
+            removed += 1
+
+        loge.info(f'evicted {removed} blobs from {self}')
+
+
+class StoredDatasets:
+    """ the datasets list of a summary when every dataset is in a
+        DatasetBlobStore, each ir blob is loaded when iteration reaches
+        it and dropped after, so the ir for the whole organization is
+        never in memory at once, every pass reads the blobs again
+
+        keys is a list of (id, fingerprint) pairs in dataset order """
+
+    def __init__(self, store, keys, timestamp=None):
+        self.store = store
+        self.keys = list(keys)
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.store!r}, <{len(self)} datasets>)'
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        return self._load(*self.keys[index])
+
+    def __iter__(self):
+        for id, fingerprint in self.keys:
+            yield self._load(id, fingerprint)
+
+    def _load(self, id, fingerprint):
+        blob = self.store.get_ir(id, fingerprint)
+        if self.timestamp is not None:
+            # NOTE this timestamps reused data AS INTENDED
+            blob['prov']['timestamp_export_start'] = self.timestamp
+
+        return blob
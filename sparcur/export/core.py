@@ -2,19 +2,24 @@
 
 import csv
 import json
+import hashlib
 from socket import gethostname
 from itertools import chain
 from collections import Counter
 import idlib
+import augpathlib as aug
 #import requests  # import time hog
 from pyontutils.core import OntGraph, populateFromJsonLd
 from pyontutils.utils import Async, deferred
+from sparcur import __version__
 from sparcur import export as ex
 from sparcur import schemas as sc
 from sparcur import curation as cur  # FIXME implicit state must be set in cli
 from sparcur import pipelines as pipes
 from sparcur.core import JEncode, JFixKeys, adops, OntTerm
+from sparcur.export.blobs import DatasetBlobStore
 from sparcur.paths import Path
+from sparcur.profiling import PipelineProfiler, profiler
 from sparcur.utils import symlink_latest, loge, logd
 from sparcur.utils import register_type, fromJson
 from sparcur.config import auth
@@ -63,6 +68,53 @@ def latest_ir(org_id=None):
     return export.latest_ir
 
 
+class JsonListStream:
+    """ write a json object one element at a time for a single list
+        valued key, output is identical to ExportBase.write_json
+
+        keys that sort before key are written on enter, keys that sort
+        after are written on exit so they can be filled in at the end """
+
+    def __init__(self, filepath, blob, key):
+        self.filepath = filepath
+        self.blob = blob
+        self.key = key
+        self.count = 0
+
+    @staticmethod
+    def _dumps(value, depth):
+        s = json.dumps(value, sort_keys=True, indent=2, cls=JEncode)
+        return s.replace('\n', '\n' + '  ' * depth)
+
+    def _write_keys(self, keys, first=False):
+        for k in keys:
+            self._f.write('\n  ' if first else ',\n  ')
+            self._f.write(json.dumps(k) + ': ' + self._dumps(self.blob[k], 1))
+            first = False
+
+    def __enter__(self):
+        self._f = open(self.filepath, 'wt')
+        self._f.write('{')
+        before = sorted(k for k in self.blob if k < self.key)
+        self._write_keys(before, first=True)
+        self._f.write((',\n  ' if before else '\n  ') + json.dumps(self.key) + ': [')
+        return self
+
+    def write(self, element):
+        self._f.write(',\n    ' if self.count else '\n    ')
+        self._f.write(self._dumps(element, 2))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._f.write('\n  ]' if self.count else ']')
+                self._write_keys(sorted(k for k in self.blob if k > self.key))
+                self._f.write('\n}')
+        finally:
+            self._f.close()
+
+
 class ExportBase:
 
     export_type = None
@@ -90,6 +142,7 @@ class ExportBase:
         self.folder_timestamp = folder_timestamp
         self.timestamp = timestamp
         self.open_when_done = open_when_done
+        self._fingerprints = None  # set by make_ir when the blob store has exports
 
     @staticmethod
     def make_dump_path(dump_path):
@@ -138,6 +191,11 @@ class ExportBase:
     def dump_path(self):
         return self.export_base / self.folder_timestamp
 
+    @property
+    def blob_store_path(self):
+        # not under export_base so it isn't mistaken for a timestamped export
+        return self.export_base.parent / 'blobs' / self.export_type
+
     @property
     def filepath_json(self):
         return self.dump_path / self.filename_json
@@ -151,8 +209,7 @@ class ExportBase:
         filepath_json = self.filepath_json
         # build or load the export of the internal representation
         blob_ir, *rest_ir = self.make_ir(**kwargs)
-        blob_export_json = self.make_export_json(blob_ir)
-        self.write_json(filepath_json, blob_export_json)
+        blob_export_json = self.write_export_json(filepath_json, blob_ir)
         symlink_latest(dump_path, self.LATEST_PARTIAL)
 
         # build or load derived exports
@@ -164,6 +221,13 @@ class ExportBase:
     def make_ir(self, *args, **kwargs):
         raise NotImplementedError('implement in subclass')
 
+    def write_export_json(self, filepath_json, blob_ir):
+        """ override to stream, return None if the export json
+            is never fully materialized """
+        blob_export_json = self.make_export_json(blob_ir)
+        self.write_json(filepath_json, blob_export_json)
+        return blob_export_json
+
     def make_export_json(self, *args, **kwargs):
         """
         if your ir is identical to your export json
@@ -189,11 +253,44 @@ class ExportXml(ExportBase):
     def export_other_formats(self, *args, **kwargs):
         pass
 
+    def make_export_json(self, blob_ir):
+        return blob_ir
+
     register_type(None, 'all-xml-files')  # FIXME VERY BAD TO NEED TO CALL THIS HERE
 
+    @staticmethod
+    def _xml_key(local, path):
+        """ cache key for the metadata extracted from a single xml file
+            changes if the remote file changes or the extractors do """
+        meta = aug.PathMeta.from_xattrs(path.xattrs(), prefix='bf')
+        if meta.checksum is None and meta.size is None:
+            # local only file, fall back to stat
+            st = path.stat()
+            sig = st.st_size, st.st_mtime_ns
+        else:
+            sig = meta.checksum, meta.size, meta.updated
+
+        rows = __version__, path.relative_to(local).as_posix(), sig
+        return hashlib.sha256(repr(rows).encode()).hexdigest()
+
     def make_ir(self, dataset_paths=tuple(), jobs=None, debug=False):
         from sparcur.extract import xml as exml
-        def do_xml_metadata(local, id):  # FIXME HACK needs its own pipeline
+        def do_xml_file(local, path):  # FIXME HACK needs its own pipeline
+            e = exml.ExtractXml(path)
+            return {'path': path.relative_to(local).as_posix(),
+                    'type': 'path',
+                    'mimetype': e.mimetype,  # FIXME should this in the extracted ??
+                    'contents': e.asDict() if e.mimetype else None}
+
+        # extracted metadata is cached per file so that unchanged
+        # files are never parsed again, the cache holds the json
+        # form so hits have strings where misses have path objects
+        store = DatasetBlobStore(self.blob_store_path)
+        dataset_dict = {}
+        todo = []
+        keep = []
+        for dataset in dataset_paths:
+            local = dataset.local
             local_xmls = list(local.rglob('*.xml'))
             missing = [p.as_posix() for p in local_xmls if not p.exists()]
             if missing:
@@ -201,32 +298,35 @@ class ExportXml(ExportBase):
                 raise BaseException(f'unfetched children\n{oops}')
 
             blob = {'type': 'all-xml-files',  # FIXME not quite correct use of type here
-                    'dataset_id': id,
-                    'xml': tuple()}
-            blob['xml'] = [{'path': x.relative_to(local).as_posix(),
-                            'type': 'path',
-                            'mimetype': e.mimetype,  # FIXME should this in the extracted ??
-                            'contents': e.asDict() if e.mimetype else None}
-                           for x in local_xmls
-                           for e in (exml.ExtractXml(x),)]
-
-            return blob
-
+                    'dataset_id': dataset.id,
+                    'xml': []}
+            dataset_dict[dataset.id] = blob
+            for x in local_xmls:
+                key = self._xml_key(local, x)
+                keep.append((dataset.id, key))
+                if store.exists(dataset.id, key):
+                    blob['xml'].append(store.get_ir(dataset.id, key, raw=True))
+                else:
+                    todo.append((blob['xml'], len(blob['xml']), dataset.id, key, local, x))
+                    blob['xml'].append(None)
+
+        loge.info(f'xml cache hits {len(keep) - len(todo)} misses {len(todo)}')
         if jobs == 1 or debug:
-            dataset_dict = {}
-            for dataset in dataset_paths:
-                blob = do_xml_metadata(dataset.local, dataset.id)
-                dataset_dict[dataset.id] = blob
+            hrm = [do_xml_file(local, x) for *_, local, x in todo]
         else:
             # 3.7 0m25.395s, pypy3 fails iwth unpickling error
+            # per file not per dataset so one huge dataset doesn't serialize everything
             from joblib import Parallel, delayed
             from joblib.externals.loky import get_reusable_executor
-            hrm = Parallel(n_jobs=9)(delayed(do_xml_metadata)
-                                     (dataset.local, dataset.id)
-                                     for dataset in dataset_paths)
+            hrm = Parallel(n_jobs=9 if jobs is None else jobs)(
+                delayed(do_xml_file)(local, x) for *_, local, x in todo)
             get_reusable_executor().shutdown()  # close the loky executor to clear memory
-            dataset_dict = {d.id:b for d, b in zip(dataset_paths, hrm)}
 
+        for (xml, index, id, key, _, _), entry in zip(todo, hrm):
+            xml[index] = entry
+            store.put(id, key, entry)
+
+        store.evict(keep=keep)
         blob_ir = dataset_dict
         return blob_ir,
 
@@ -236,6 +336,7 @@ class Export(ExportBase):
     export_type = 'integrated'
     filename_json = 'curation-export.json'
     id_metadata = 'identifier-metadata.json'
+    id_fingerprints = 'dataset-fingerprints.json'
 
     _pyru_loaded = False
 
@@ -284,6 +385,36 @@ class Export(ExportBase):
     def latest_datasets_path(self):
         return self.base_path / 'datasets'
 
+    @property
+    def latest_fingerprints_path(self):
+        return self.base_path / self.id_fingerprints
+
+    @property
+    def latest_fingerprints(self):
+        with open(self.latest_fingerprints_path, 'rt') as f:
+            return json.load(f)
+
+    def previous_for_incremental(self):
+        """ fingerprints from the latest export, empty if there is
+            nothing usable to build on
+
+            the latest export json is not ir so nothing is seeded from
+            it, unchanged datasets are reused from the ir blobs in the
+            blob store and anything that was evicted is rebuilt """
+        if not self.latest_fingerprints_path.exists():
+            loge.info('no previous fingerprints, incremental export '
+                      'will rebuild all datasets')
+            return {}
+
+        fingerprints = self.latest_fingerprints
+        store = DatasetBlobStore(self.blob_store_path)
+        missing = [id for id, fp in fingerprints.items() if not store.exists(id, fp)]
+        if missing:
+            loge.info(f'{len(missing)} datasets from the latest export are '
+                      'no longer in the blob store and will be rebuilt')
+
+        return {'fingerprints': fingerprints}
+
     def latest_export_ttl_populate(self, graph):
         # intentionally fail if the ttl export failed
         lce = self.latest_ttl_path.as_posix()
@@ -385,6 +516,10 @@ class Export(ExportBase):
             else:
                 ted.graph.write(filepsuf)  # yay OntGraph defaults
 
+            # only the graph is used after this, don't keep every
+            # blob alive when they are being read from the blob store
+            ted.data = None
+
             loge.info(f'dataset graph exported to {filepsuf}')
 
         return teds
@@ -538,7 +673,8 @@ class Export(ExportBase):
                 writer = csv.writer(f, delimiter='\t', lineterminator='\n')
                 writer.writerows(tabular)
 
-    def export(self, dataset_paths=tuple(), exclude=tuple()):
+    def export(self, dataset_paths=tuple(), exclude=tuple(), incremental=False,
+               profile_pipelines=False):
         """ export output of curation workflows to file """
         if self.export_source_path != self.export_source_path.cache.anchor:
             if not self.export_source_path.cache.is_dataset():  # FIXME just go find the dataset in that case?
@@ -548,9 +684,13 @@ class Export(ExportBase):
             return self.export_single_dataset()  # FIXME unused except for `spc export .` from inside a dataset folder
 
         else:
-            return super().export(dataset_paths=dataset_paths, exclude=exclude)
+            return super().export(dataset_paths=dataset_paths,
+                                  exclude=exclude,
+                                  incremental=incremental,
+                                  profile_pipelines=profile_pipelines)
 
-    def make_ir(self, dataset_paths=tuple(), exclude=tuple()):
+    def make_ir(self, dataset_paths=tuple(), exclude=tuple(), incremental=False,
+                profile_pipelines=False):
         """ build the internal representation """
         # FIXME inversion of control would be nice here :/
         # FIXME this should really be coming from a fully
@@ -566,11 +706,39 @@ class Export(ExportBase):
         previous_latest_datasets = self.latest_datasets_path.resolve()
         # data
         # FIXME Summary has implicit state set by cli
-        summary = cur.Summary(self.export_source_path, dataset_paths=dataset_paths, exclude=exclude)
+        # always fingerprint so that the next run can be incremental
+        previous = (self.previous_for_incremental()
+                    if incremental and not self.latest else None)
+        self._blob_store = DatasetBlobStore(self.blob_store_path)
+        profile_path = None
+        if profile_pipelines and not self.latest:
+            # one file per dataset so worker processes can write independently
+            profile_path = self.dump_path / 'pipeline-profile'
+            profile_path.mkdir(parents=True, exist_ok=True)
+
+        summary = cur.Summary(self.export_source_path,
+                              dataset_paths=dataset_paths,
+                              exclude=exclude,
+                              previous=previous,
+                              blob_store=self._blob_store,
+                              profile_path=profile_path)
+        fingerprints_path = self.dump_path / self.id_fingerprints
         if self.latest:
             blob_data = self.latest_ir
+            self._fingerprints = None  # only use the store for fresh runs
+            if self.latest_fingerprints_path.exists():
+                fingerprints_path.copy_from(self.latest_fingerprints_path)
         else:
             blob_data = summary.data_for_export(self.timestamp)
+            self._fingerprints = summary.fingerprints
+            self.write_json(fingerprints_path, summary.fingerprints)
+            if profile_path is not None:
+                profiler.stop()
+                table = PipelineProfiler.report(
+                    profile_path,
+                    self.dump_path / 'pipeline-profile.json',
+                    self.dump_path / 'pipeline-profile.txt')
+                loge.info(f'pipeline profile\n{table}')
 
         return blob_data, summary, previous_latest, previous_latest_datasets
 
@@ -580,14 +748,44 @@ class Export(ExportBase):
         # FIXME hack
         datasets = blob_ir['datasets']
         blob_export_json = {k:v for k, v in blob_ir.items() if k != 'datasets'}
-        blob_export_json['datasets'] = []
-        for blob_dataset in datasets:
-            pipe = pipes.IrToExportJsonPipeline(blob_dataset)
-            data = pipe.data
-            blob_export_json['datasets'].append(data)
-
+        blob_export_json['datasets'] = list(self._iter_export_json(datasets))
         return blob_export_json
 
+    def _iter_export_json(self, datasets):
+        fps = self._fingerprints
+        for blob_dataset in datasets:
+            id = blob_dataset['id']
+            data = None
+            if fps and id in fps:
+                # already done by the workers in datame
+                data = self._blob_store.get_export(id, fps[id])
+                if data is not None:
+                    # reused blobs only have their ir timestamp updated
+                    data['prov']['timestamp_export_start'] = (
+                        blob_dataset['prov']['timestamp_export_start'])
+
+            if data is None:
+                pipe = pipes.IrToExportJsonPipeline(blob_dataset)
+                data = pipe.data
+
+            yield data
+
+    def write_export_json(self, filepath_json, blob_ir):
+        """ write the export json and jsonld one dataset at a time so
+            that neither is ever fully materialized in memory """
+        head = {k:v for k, v in blob_ir.items() if k != 'datasets'}
+        with JsonListStream(filepath_json.with_suffix('.json'), head, 'datasets') as sj, \
+             JsonListStream(filepath_json.with_suffix('.jsonld'), head, 'datasets') as sjld:
+            for blob_export in self._iter_export_json(blob_ir['datasets']):
+                sj.write(blob_export)
+                sjld.write(self._dataset_export_jsonld(blob_export))
+
+            # meta and prov sort after datasets so they land at the end
+            head['meta'] = {**head['meta'], 'count': sj.count}
+
+        # streamed, never materialized, see export_other_formats
+        return None
+
     def export_jsonld(self, filepath_json, blob_export_json):
         """ currently this requires the export json blob NOT the ir """
         blob_export_jsonld = self.make_jsonld(blob_export_json)
@@ -615,8 +813,7 @@ class Export(ExportBase):
         summary, previous_latest, previous_latest_datasets = rest
         dataset_blobs = blob_ir['datasets']
 
-        # jsonld
-        blob_export_jsonld = self.export_jsonld(filepath_json, blob_export_json)
+        # jsonld is streamed alongside the json in write_export_json
 
         # identifier metadata
         blob_id_met = self.export_identifier_metadata(dump_path, previous_latest, dataset_blobs)
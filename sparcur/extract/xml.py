@@ -14,19 +14,37 @@ if etree.__name__ == 'lxml.etree':
 
 
 class ExtractXml:
+    """ dispatch on the root element, only the prolog and the root
+        start tag are read before we know which class to use """
+
+    _sniff_chunk = 4096
+    _sniff_limit = 1024 ** 2  # give up if there is no root by here
+
     def __new__(cls, path):
+        root = cls._sniff(path)
+        if root is None:
+            inst = NotXml(path)
+            msg = f'path is not a valid xml file! {path}'
+            if inst.addError(msg, blame='submission', path=path):
+                logd.error(msg)
+
+            return inst
+
+        tag, attrib = root
         inst = None
-        for c in cls.classes:
-            #log.debug(c)
+        for c in cls.index.get(tag, tuple()):
+            if not c.rootMatches(tag, attrib):
+                continue
+
             if inst is not None:
                 _inst = inst
                 inst = c.fromExisting(inst)
-                if inst._isXml:
+                if hasattr(_inst, 'e'):  # streaming classes have no tree
                     delattr(_inst, 'e')  # prevent __del__ from zapping e
-                    del _inst
+                del _inst
             else:
                 inst = c(path)
-                if not inst._isXml:
+                if not inst._isXml:  # broken somewhere after the root
                     inst = NotXml(path)
                     msg = f'path is not a valid xml file! {path}'
                     if inst.addError(msg, blame='submission', path=path):
@@ -36,16 +54,34 @@ class ExtractXml:
 
             if inst.typeMatches():
                 return inst
-            #else:
-                #if hasattr(inst, 'e'):
-                    #log.debug(inst.e.getroot().tag)
 
-        else:
-            msg = f'FIXME converter not implemented for whatever this is {path}'
-            log.critical(msg)
-            raise NotImplementedError(msg)
-            #path.xopen()
-            #breakpoint()
+        msg = f'FIXME converter not implemented for whatever this is {path}'
+        log.critical(msg)
+        raise NotImplementedError(msg)
+        #path.xopen()
+        #breakpoint()
+
+    @classmethod
+    def _sniff(cls, path):
+        """ (root tag, root attributes) or None if not xml """
+        parser = etree.XMLPullParser(events=('start',))
+        read = 0
+        try:
+            with open(path, 'rb') as f:
+                while read < cls._sniff_limit:
+                    chunk = f.read(cls._sniff_chunk)
+                    if not chunk:
+                        parser.close()  # raises if the document is incomplete
+                        return
+
+                    read += len(chunk)
+                    parser.feed(chunk)
+                    for event, element in parser.read_events():
+                        return element.tag, dict(element.attrib)
+
+        except (etree.XMLSyntaxError if etree.__name__ == 'lxml.etree' else
+                etree.ParseError) as e:
+            logd.debug(f'{e} {path}')
 
 
 class NotXml(HasErrors):
@@ -125,6 +161,11 @@ class XmlSource(HasErrors):
     def isXml(self):
         return self._isXml
 
+    @classmethod
+    def rootMatches(cls, tag, attrib):
+        """ check that only needs the root start tag, see ExtractXml._sniff """
+        return tag == cls.top_tag
+
     def typeMatches(self):
         return self._isXml and self.e.getroot().tag == self.top_tag
 
@@ -216,6 +257,32 @@ class ExtractMBF(XmlSource):
     top_tag = '{http://www.mbfbioscience.com}mbf'
     mimetype = 'application/vnd.mbfbioscience.metadata+xml'
 
+    # tracing files can have hundreds of thousands of contour points
+    # so by default we never build the tree, set to False to use the
+    # xpath version in _extract_tree
+    streaming = True
+
+    def __init__(self, path):
+        if not self.streaming:
+            return super().__init__(path)
+
+        super(XmlSource, self).__init__()
+        self.path = path
+        try:
+            self._streamed = self._stream()
+            self._isXml = True
+        except (etree.XMLSyntaxError if etree.__name__ == 'lxml.etree' else
+                etree.ParseError) as e:
+            self._isXml = False
+            logd.exception(e)
+            logd.error(f'error parsing {self.path}')
+
+    def typeMatches(self):
+        if hasattr(self, '_streamed'):
+            return self._isXml and self._root_tag == self.top_tag
+
+        return super().typeMatches()
+
     @hasSchema.f(sc.MbfTracingSchema)
     def asDict(self, unique=True, guid=False):
         return self._condense(unique=unique, guid=guid)
@@ -240,6 +307,93 @@ class ExtractMBF(XmlSource):
         return data_in
 
     def _extract(self, *args, prefix='_:', **kwargs):
+        if hasattr(self, '_streamed'):
+            return self._streamed
+
+        return self._extract_tree(*args, prefix=prefix, **kwargs)
+
+    def _stream(self):
+        """ same result as _extract_tree but every element is discarded
+            as soon as it ends so memory is proportional to the metadata
+            not to the file, contour points are never kept around """
+        subject_attrs = {'subjectid': 'id',
+                         'species': 'species',
+                         'sex': 'sex',
+                         'age': 'age',}
+        atlas_attrs = {'organ': 'organ',
+                       'label': 'atlas_label',
+                       'rootid': 'atlas_rootid',}
+        property_keys = {'GUID': 'guid',
+                         'TraceAssociation': 'id_ontology',}
+        subject = {k:[] for k in subject_attrs.values()}
+        atlas = {k:[] for k in atlas_attrs.values()}
+        images = []
+        contours = []
+
+        def attrs(element, *names):
+            # xpath('@name') is a list in lxml
+            return [element.get(n) for n in names if n in element.attrib]
+
+        self.namespaces = {}
+        stack = []  # local names of open elements, None if wrong namespace
+        property_key = None
+        events = ('start-ns', 'start', 'end')
+        for event, element in etree.iterparse(self.path.as_posix(), events=events):
+            if event == 'start-ns':
+                prefix, uri = element
+                self.namespaces[prefix if prefix else '_'] = uri
+                continue
+
+            if not stack:  # root
+                self._root_tag = element.tag
+                self._root_attrib = dict(element.attrib)
+                ns = element.tag.rsplit('}', 1)[0] + '}' if '}' in element.tag else ''
+
+            if event == 'start':
+                tag = element.tag
+                stack.append(tag[len(ns):] if tag.startswith(ns) else None)
+                path = tuple(stack[1:])
+                if path == ('sparcdata', 'subject'):
+                    for a, k in subject_attrs.items():
+                        subject[k].extend(attrs(element, a))
+                elif path == ('sparcdata', 'atlas'):
+                    for a, k in atlas_attrs.items():
+                        atlas[k].extend(attrs(element, a))
+                elif path == ('images', 'image'):
+                    images.append({'path_mbf': [], 'channels': []})
+                elif path == ('images', 'image', 'channels', 'channel'):
+                    images[-1]['channels'].append({'id': attrs(element, 'id'),
+                                                   'source': attrs(element, 'source'),})
+                elif path == ('contour',):
+                    contours.append({'name': attrs(element, 'name'),
+                                     'guid': [],
+                                     'id_ontology': [],})
+                elif path == ('contour', 'property'):
+                    property_key = property_keys.get(element.get('name'))
+
+            else:
+                path = tuple(stack[1:])
+                text = element.text
+                if text is not None:
+                    if path == ('images', 'image', 'filename'):
+                        images[-1]['path_mbf'].append(pathlib.PureWindowsPath(text))
+                    elif path == ('contour', 'property', 's') and property_key:
+                        contours[-1][property_key].append(text)
+
+                stack.pop()
+                element.clear()
+                if hasattr(element, 'getprevious'):  # lxml keeps empty siblings
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+
+        return {
+            'subject':  subject,
+            'atlas':    atlas,
+            'images':   images,
+            'contours': contours,
+        }
+
+    def _extract_tree(self, *args, prefix='_:', **kwargs):
         _p = prefix
         subject = {
             'id':      self.xpath(f'{_p}sparcdata/{_p}subject/@subjectid'),
@@ -304,7 +458,16 @@ class ExtractVesselucida(ExtractMBF):
     top_tag = 'mbf'
     mimetype = 'application/vnd.mbfbioscience.vesselucida+xml'
 
+    @classmethod
+    def rootMatches(cls, tag, attrib):
+        return (super().rootMatches(tag, attrib) and
+                attrib.get('appname') == 'Vesselucida')
+
     def typeMatches(self):
+        if hasattr(self, '_streamed'):
+            return (super().typeMatches() and
+                    self._root_attrib.get('appname') == 'Vesselucida')
+
         return (super().typeMatches() and
                 'Vesselucida' in self.xpath('/mbf/@appname'))
 
@@ -418,6 +581,9 @@ class ExtractMSXMLExcel(XmlSource):
 
 
 ExtractXml.classes = (*[c for c in subclasses(XmlSource)], XmlSource)
+ExtractXml.index = {}
+# XmlSource.top_tag matches nothing so it is safe to include
+[ExtractXml.index.setdefault(c.top_tag, []).append(c) for c in ExtractXml.classes]
 
 # FIXME not entirely clear that I am using type correctly here
 [register_type(None, cls.mimetype) for cls in ExtractXml.classes
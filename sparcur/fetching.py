@@ -0,0 +1,171 @@
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from sparcur.utils import log
+
+
+class TokenBucket:
+    """ thread safe token bucket, consume blocks until there are enough
+        tokens, used for both the bandwidth cap (bytes per second) and
+        the request rate (requests per second) """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = rate if burst is None else burst
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.rate!r}, burst={self.burst!r})'
+
+    def consume(self, n=1):
+        # requests larger than the burst are allowed but go into debt
+        # so that the long run average stays at rate
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+class FetchScheduler:
+    """ fetch many files at once without letting big files starve small ones
+
+        files with a known size of at least large_mb go to the large
+        queue, everything else goes to the small queue, each queue has
+        its own pool of workers so metadata files never wait behind huge
+        binaries, files with no size are usually metadata files that
+        were never pulled and there is nothing to say they are large
+
+        bandwidth_mb caps the total bytes per second across all workers,
+        per_host caps the number of open connections to any one host,
+        both are enforced in BlackfynnRemote.get_file_by_url when the
+        scheduler is bound to the remote class """
+
+    progress_interval = 10  # seconds
+
+    def __init__(self, small_workers=8, large_workers=2, large_mb=100,
+                 rate=None, bandwidth_mb=None, per_host=None):
+        self.small_workers = small_workers
+        self.large_workers = large_workers
+        self.large_mb = large_mb
+        self._rate = TokenBucket(rate) if rate else None
+        self._bandwidth = (TokenBucket(bandwidth_mb * 1024 ** 2)
+                           if bandwidth_mb else None)
+        self.per_host = per_host
+        self._hosts = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+        self._hosts_lock = threading.Lock()
+        self._progress_lock = threading.Lock()
+        # per run counters, reset by __call__, chunks can arrive through
+        # get_file_by_url as soon as the scheduler is bound
+        self._total = self._done = self._failed = self._bytes = 0
+        self._start = self._last_report = time.monotonic()
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(small_workers={self.small_workers}, '
+                f'large_workers={self.large_workers}, large_mb={self.large_mb})')
+
+    def bind(self, remote_class):
+        """ route downloads for remote_class through the host and bandwidth limits """
+        remote_class._fetch_scheduler = self
+
+    def unbind(self, remote_class):
+        if remote_class._fetch_scheduler is self:
+            remote_class._fetch_scheduler = None
+
+    @contextmanager
+    def connection(self, host):
+        if self.per_host is None:
+            yield
+            return
+
+        with self._hosts_lock:
+            semaphore = self._hosts[host]
+
+        with semaphore:
+            yield
+
+    def transferred(self, n):
+        """ called for every chunk that comes off the wire """
+        if self._bandwidth is not None:
+            self._bandwidth.consume(n)
+
+        with self._progress_lock:
+            self._bytes += n
+
+    @staticmethod
+    def _size(path):
+        """ None if there is no cache or no size in its meta """
+        cache = path.cache
+        if cache is not None:
+            meta = cache.meta
+            if meta is not None:
+                return meta.size
+
+    def is_large(self, path):
+        size = self._size(path)
+        return size is not None and size >= self.large_mb * 1024 ** 2
+
+    def _report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < self.progress_interval:
+            return
+
+        self._last_report = now
+        elapsed = now - self._start
+        mb = self._bytes / 1024 ** 2
+        log.info(f'fetched {self._done}/{self._total} files '
+                 f'{mb:.1f} MB in {elapsed:.0f}s '
+                 f'({mb / elapsed if elapsed else 0:.2f} MB/s) '
+                 f'{self._failed} failed')
+
+    def _job(self, function, path):
+        if self._rate is not None:
+            self._rate.consume()
+
+        try:
+            return function(path)
+        except BaseException as e:
+            with self._progress_lock:
+                self._failed += 1
+
+            raise e
+        finally:
+            with self._progress_lock:
+                self._done += 1
+                self._report()
+
+    def __call__(self, function, paths):
+        """ run function(path) for all paths, results are returned in
+            the order of paths, the first error is raised after all
+            other jobs have finished """
+        paths = list(paths)
+        self._total = len(paths)
+        self._done = self._failed = self._bytes = 0
+        self._start = self._last_report = time.monotonic()
+
+        large = [self.is_large(p) for p in paths]
+        # smallest first in the small queue so the counts move quickly
+        # unknown sizes go last since they could be anything
+        sizes = [self._size(p) for p in paths]
+        smalls = sorted((i for i, l in enumerate(large) if not l),
+                        key=lambda i: (sizes[i] is None, sizes[i] or 0))
+        larges = [i for i, l in enumerate(large) if l]
+        log.info(f'fetching {len(smalls)} small and {len(larges)} large files')
+
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.small_workers) as small_pool, \
+             ThreadPoolExecutor(max_workers=self.large_workers) as large_pool:
+            for pool, indexes in ((large_pool, larges), (small_pool, smalls)):
+                for i in indexes:
+                    futures[i] = pool.submit(self._job, function, paths[i])
+
+        self._report(force=True)
+        return [futures[i].result() for i in range(len(paths))]
@@ -0,0 +1,168 @@
+import os
+import math
+import errno
+from array import array
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+import augpathlib as aug
+from augpathlib.core import XATTR_DEFAULT_NS
+from sparcur.utils import log
+
+DIR, FILE, BROKEN = 0, 1, 2  # broken symlinks are remote files we have not fetched
+
+
+class MetaTable:
+    """ columnar table of the remote metadata for everything under a path
+
+        one row per child, built from a single scandir walk with the
+        xattr and symlink reads fanned out to a thread pool so that a
+        200k file dataset doesn't construct 200k path and PathMeta objects
+
+        sizes are -1 and updated is nan when unknown, dir_metas holds the
+        full PathMeta for directories since there are few of them and
+        data_dir_structure needs everything """
+
+    prefix = 'bf'
+    workers = 16
+    chunk = 512
+    _file_keys = 'size', 'updated'
+
+    def __init__(self, root, relpaths, kinds, sizes, updated, dir_metas):
+        self.root = root
+        self.relpaths = relpaths
+        self.kinds = kinds
+        self.sizes = sizes
+        self.updated = updated
+        self.dir_metas = dir_metas
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.root!r}, rows={len(self.relpaths)})'
+
+    def __len__(self):
+        return len(self.relpaths)
+
+    @staticmethod
+    def _walk(root):
+        """ (relpath, kind) for everything under root, symlinks are not followed """
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            with os.scandir(os.path.join(root, rel)) as it:
+                for entry in it:
+                    relpath = os.path.join(rel, entry.name)
+                    if entry.is_symlink():
+                        # the links for remote files point at themselves
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            yield relpath, BROKEN
+                            continue
+
+                        if not os.path.exists(entry.path):
+                            yield relpath, BROKEN
+                        else:
+                            yield relpath, DIR if is_dir else FILE
+
+                    elif entry.is_dir():
+                        yield relpath, DIR
+                        stack.append(relpath)
+                    else:
+                        yield relpath, FILE
+
+    # os.getxattr on the string path is much cheaper than making a path
+    # object per file, but read from the same namespace augpathlib uses
+    _xattr_ns = (XATTR_DEFAULT_NS.decode() if isinstance(XATTR_DEFAULT_NS, bytes)
+                 else XATTR_DEFAULT_NS)
+
+    @classmethod
+    def _read_file(cls, path):
+        xattrs = {}
+        for key in cls._file_keys:
+            key = f'{cls.prefix}.{key}'
+            try:
+                xattrs[key.encode()] = os.getxattr(path, f'{cls._xattr_ns}.{key}')
+            except OSError as e:
+                if e.errno not in (errno.ENODATA, errno.ENOTSUP):
+                    raise e
+
+        meta = aug.PathMeta.from_xattrs(xattrs, prefix=cls.prefix)
+        size = meta.size
+        if size is None:  # running an export on a local dataset
+            size = os.stat(path).st_size
+
+        return size, meta.updated
+
+    @classmethod
+    def _read_rows(cls, root, rows):
+        out = []
+        for relpath, kind in rows:
+            path = root / relpath
+            if kind == DIR:
+                out.append(aug.PathMeta.from_xattrs(path.xattrs(), prefix=cls.prefix))
+            elif kind == BROKEN:
+                meta = aug.PathMeta.from_symlink(path)
+                out.append((meta.size, meta.updated))
+            else:
+                out.append(cls._read_file(path.as_posix()))
+
+        return out
+
+    @classmethod
+    def fromPath(cls, root, workers=None):
+        workers = cls.workers if workers is None else workers
+        rows = list(cls._walk(root))
+        chunks = [rows[i:i + cls.chunk] for i in range(0, len(rows), cls.chunk)]
+        if workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(lambda c: cls._read_rows(root, c), chunks))
+        else:
+            results = [cls._read_rows(root, c) for c in chunks]
+
+        relpaths = []
+        kinds = array('b')
+        sizes = array('q')
+        updated = array('d')
+        dir_metas = {}
+        for chunk, result in zip(chunks, results):
+            for (relpath, kind), value in zip(chunk, result):
+                relpaths.append(relpath)
+                kinds.append(kind)
+                if kind == DIR:
+                    dir_metas[relpath] = value
+                    # the remote size of a folder is zero for bf
+                    size, upd = 0, None
+                else:
+                    size, upd = value
+
+                sizes.append(-1 if size is None else size)
+                updated.append(math.nan if upd is None else upd.timestamp())
+
+        log.debug(f'scanned {len(relpaths)} paths under {root}')
+        return cls(root, relpaths, kinds, sizes, updated, dir_metas)
+
+    def counts(self):
+        """ size dirs files and the relpaths of files with unknown size """
+        size = dirs = files = 0
+        missing = []
+        for relpath, kind, s in zip(self.relpaths, self.kinds, self.sizes):
+            if kind == DIR:
+                dirs += 1
+            else:
+                files += 1
+                if s < 0:
+                    missing.append(relpath)
+                else:
+                    size += s
+
+        return size, dirs, files, missing
+
+    def files_last_updated(self):
+        """ most recent updated time of fetched files """
+        ts = [u for k, u in zip(self.kinds, self.updated)
+              if k == FILE and not math.isnan(u)]
+        if ts:
+            return datetime.fromtimestamp(max(ts), tz=timezone.utc)
+
+    def dirs(self):
+        """ relpaths of all real directories, no symlinks """
+        return [r for r in self.dir_metas if not os.path.islink(self.root / r)]
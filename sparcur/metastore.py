@@ -1,23 +1,44 @@
 import sqlite3
+import threading
+import augpathlib as aug
 
 
 class MetaStore:
-    """ A local backup against accidental xattr removal """
-    _attrs = ('bf.id',
-              'bf.file_id',
-              'bf.size',
-              'bf.created_at',
-              'bf.updated_at',
-              'bf.checksum',
-              'bf.error')
-    attrs = 'xattrs',
-    # FIXME horribly inefficient 1 connection per file due to the async code ... :/
+    """ A local backup against accidental xattr removal
+
+        keyed on (remote id, file id) since packages can have more than
+        one file, the value is the packed PathMeta from
+        PathMeta.as_metastore, one connection per thread in WAL mode
+        so many readers can run while a bulk snapshot is written
+
+        anywhere a key is expected a bare id or path means the entry
+        without a file id, e.g. a folder, or a single file package
+        from before file ids were recorded """
+
+    prefix = 'bf'
+    # NULLs are never equal so they can't be part of the primary key
+    _no_file_id = -1
+    # sqlite has a limit on variables per statement, join on a temp table instead
+    _bulk_read_table = 'bulk_read_ids'
+
     def __init__(self, db_path):
         self.db_path = db_path
+        self._local = threading.local()
         self.setup()
 
     def conn(self):
-        return sqlite3.connect(self.db_path.as_posix())
+        if not hasattr(self._local, 'conn'):
+            conn = sqlite3.connect(self.db_path.as_posix())
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+
+        return self._local.conn
+
+    def close(self):
+        if hasattr(self._local, 'conn'):
+            self._local.conn.close()
+            del self._local.conn
 
     def setup(self):
         if not self.db_path.parent.exists():
@@ -25,81 +46,126 @@ class MetaStore:
 
         sqls = (('CREATE TABLE IF NOT EXISTS path_xattrs'
                  '('
-                 'id TEXT PRIMARY KEY,'  # for hypothesis ids this can be string(??)
-                 'xattrs BLOB'  # see path meta for the packed representation
-                 ');'),
-                ('CREATE UNIQUE INDEX IF NOT EXISTS path_xattrs_u_id ON path_xattrs (id);'))
+                 'id TEXT NOT NULL,'  # for hypothesis ids this can be string(??)
+                 'file_id INTEGER NOT NULL,'
+                 'xattrs BLOB,'  # see path meta for the packed representation
+                 'PRIMARY KEY (id, file_id)'
+                 ');'),)
         conn = self.conn()
         with conn:
+            columns = [r[1] for r in conn.execute('PRAGMA table_info(path_xattrs)')]
+            if columns and 'file_id' not in columns:
+                # keyed on id alone, rekey what is there
+                metas = [(id, self._unpack(blob)) for id, blob in
+                         conn.execute('SELECT id, xattrs FROM path_xattrs')]
+                conn.execute('DROP TABLE path_xattrs')
+            else:
+                metas = []
+
             for sql in sqls:
                 conn.execute(sql)
 
-    def bulk(self, id_blobs):  # FIXME no longer a dict really ...
-        cols = ', '.join(_.replace('.', '_') for _ in self.attrs)
-        values_template = ', '.join('?' for _ in self.attrs)
-        sql = ('INSERT OR REPLACE INTO path_xattrs '
-               f'(id, {cols}) VALUES (?, {values_template})')
+            conn.executemany(self._insert, ((*self._key((id, meta.file_id)), self._pack(meta))
+                                            for id, meta in metas))
+
+    _insert = 'INSERT OR REPLACE INTO path_xattrs (id, file_id, xattrs) VALUES (?, ?, ?)'
+
+    @staticmethod
+    def _id(path_or_id):
+        # FIXME paths are only here for backward compat, everything should be ids
+        return path_or_id if isinstance(path_or_id, str) else path_or_id.as_posix()
+
+    def _key(self, key):
+        """ (id, file_id) or a bare id or path -> row key """
+        if isinstance(key, tuple):
+            id, file_id = key
+        else:
+            id, file_id = key, None
+
+        return self._id(id), self._no_file_id if file_id is None else file_id
+
+    def _unkey(self, id, file_id):
+        return id, None if file_id == self._no_file_id else file_id
+
+    def _pack(self, meta):
+        return meta.as_metastore(prefix=self.prefix)
+
+    def _unpack(self, blob):
+        return aug.PathMeta.from_metastore(blob, prefix=self.prefix)
+
+    def bulk(self, id_metas):
+        """ upsert many (id, PathMeta) pairs in a single transaction
+            files in the same package are kept apart by meta.file_id """
         conn = self.conn()
         with conn:
-            for id, blob in id_blobs:
-                conn.execute(sql, args)
-            return
-            for path, attrs in pdict.items():
-                args = path.as_posix(), *self.convert_attrs(attrs)
-                conn.execute(sql, args)
-
-    def remove(self, path):
-        sql = 'DELETE FROM path_xattrs WHERE id = ?'
-        args = path.as_posix(),
+            conn.executemany(self._insert, ((*self._key((id, meta.file_id)), self._pack(meta))
+                                            for id, meta in id_metas))
+
+    def backup(self, paths):
+        """ snapshot the xattrs of local paths, e.g. a whole dataset via rchildren
+            paths without an id (not from the remote) are skipped """
+        def id_metas():
+            for path in paths:
+                if path.is_broken_symlink():
+                    meta = aug.PathMeta.from_symlink(path)
+                else:
+                    meta = aug.PathMeta.from_xattrs(path.xattrs(), prefix=self.prefix)
+
+                if meta.id is not None:
+                    yield meta.id, meta
+
+        self.bulk(id_metas())
+
+    def remove(self, key):
+        """ a bare id removes every file in the package """
+        if isinstance(key, tuple):
+            sql = 'DELETE FROM path_xattrs WHERE id = ? AND file_id = ?'
+            args = self._key(key)
+        else:
+            sql = 'DELETE FROM path_xattrs WHERE id = ?'
+            args = self._id(key),
+
         conn = self.conn()
         with conn:
             return conn.execute(sql, args)
 
-    def convert_attrs(self, attrs):
-        for key in self.attrs:
-            if key in attrs:
-                yield attrs[key]
-            else:
-                yield None
+    def xattrs(self, key):
+        sql = 'SELECT xattrs FROM path_xattrs WHERE id = ? AND file_id = ?'
+        row = self.conn().execute(sql, self._key(key)).fetchone()
+        if row:
+            return self._unpack(row[0])
 
-    def xattrs(self, path):
-        sql = 'SELECT xattrs FROM path_xattrs WHERE id = ?'
-        args = path.as_posix(),
+    def bulk_xattrs(self, ids):
+        """ {(id, file_id): PathMeta} for every file of every id that is
+            present, one query, file_id is None for entries without one """
+        table = self._bulk_read_table
         conn = self.conn()
         with conn:
-            cursor = conn.execute(sql, args)
-            blob = cursor.fetchone()
-            if blob:
-                return PathMeta.from_metastore(blob)
-            #print(values)
-            #if values:
-                #return 
-                #keys = [n.replace('_', '.', 1) for n, *_ in cursor.description]
-                #print(keys, values)
-                #return {k:v for k, v in zip(keys, values) if k != 'path' and v is not None}  # skip path itself
-            #else:
-                #return {}
-
-    def setxattr(self, path, key, value):
-        return self.setxattrs(path, {key:value})
-
-    def setxattrs(self, path, attrs):
-        # FIXME skip nulls on replace
-        cols = ', '.join(attrs)
-        values_template = ', '.join('?' for _ in self.attrs)
-        sql = (f'INSERT OR REPLACE INTO path_xattrs (id, {cols}) VALUES (?, {values_template})')
-        args = path.as_posix(), *self.convert_attrs(attrs)
+            conn.execute(f'CREATE TEMP TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY)')
+            conn.execute(f'DELETE FROM {table}')
+            conn.executemany(f'INSERT OR IGNORE INTO {table} (id) VALUES (?)',
+                             ((self._id(id),) for id in ids))
+            rows = conn.execute('SELECT p.id, p.file_id, p.xattrs FROM path_xattrs AS p '
+                                f'JOIN {table} AS b ON p.id = b.id').fetchall()
+            conn.execute(f'DELETE FROM {table}')
+
+        return {self._unkey(id, file_id):self._unpack(blob) for id, file_id, blob in rows}
+
+    def setxattr(self, key, attr, value):
+        return self.setxattrs(key, {attr:value})
+
+    def setxattrs(self, key, attrs):
+        """ merge PathMeta fields into the existing entry, None values are skipped """
+        meta = self.xattrs(key)
+        old = dict(meta.items()) if meta is not None else {}
+        new = aug.PathMeta(**{**old, **{k:v for k, v in attrs.items()
+                                         if v is not None}})
+        id, file_id = self._key(key)
         conn = self.conn()
-        with conn:
-            return conn.execute(sql, args)
+        with conn:  # stays under key even if attrs changes file_id
+            conn.execute(self._insert, (id, file_id, self._pack(new)))
 
-    def getxattr(self, path, key):
-        if key in self.attrs:
-            col = key.replace('.', '_')
-            sql = f'SELECT {col} FROM path_xattrs WHERE id = ?'
-            args = path.as_posix(),
-            conn = self.conn()
-            with conn:
-                return conn.execute(sql, args)
-        else:
-            print('WARNING unknown key', key)
+    def getxattr(self, key, attr):
+        meta = self.xattrs(key)
+        if meta is not None:
+            return getattr(meta, attr)
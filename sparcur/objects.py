@@ -0,0 +1,128 @@
+import os
+from sparcur.utils import log
+
+
+class ObjectStore:
+    """ content addressed store for fetched file data
+
+        identical files that live in many packages (templates, protocols)
+        are stored and downloaded once, packages point at the content
+        via a symlink keyed on cache_key so that the id -> checksum
+        lookup still works when the checksum is not in the metadata
+
+        <objects>/<cypher>/<xx>/<hexdigest>  content
+        <objects>/<id>-<file_id>             symlink to content or a partial download
+
+        a regular file at the cache_key location is either a partial
+        download that can be resumed or an object that was fetched before
+        the store existed and has no checksum to move it under """
+
+    def __init__(self, objects_dir, cypher_name='sha256'):
+        self.objects_dir = objects_dir
+        self.cypher_name = cypher_name
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.objects_dir!r})'
+
+    @property
+    def content_dir(self):
+        return self.objects_dir / self.cypher_name
+
+    def path(self, checksum):
+        hexdigest = checksum.hex()
+        return self.content_dir / hexdigest[:2] / hexdigest
+
+    def key_path(self, key):
+        return self.objects_dir / key
+
+    def lookup(self, key, checksum=None):
+        """ path to complete content for this key or None
+            touches the content so that eviction sees it was used """
+        if checksum is not None:
+            path = self.path(checksum)
+        else:
+            kp = self.key_path(key)
+            if not kp.is_symlink():
+                return
+
+            path = kp.resolve()
+
+        if path.exists():
+            os.utime(path)
+            return path
+
+    def add(self, key, checksum):
+        """ move a complete verified download at the key path into the
+            store and replace it with a link to the content """
+        kp = self.key_path(key)
+        path = self.path(checksum)
+        if not path.parent.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+        # replace is atomic, if two packages with the same content
+        # finish at the same time the second one wins, both are identical
+        os.replace(kp, path)
+        self.link(key, checksum)
+        return path
+
+    def link(self, key, checksum):
+        kp = self.key_path(key)
+        target = os.path.relpath(self.path(checksum), kp.parent)
+        if kp.is_symlink():
+            if os.readlink(kp) == target:
+                return
+
+            kp.unlink()
+
+        tmp = kp.with_name(f'.{kp.name}.{os.getpid()}.link')
+        os.symlink(target, tmp)
+        os.replace(tmp, kp)
+
+    def evict(self, max_mb, keep=tuple()):
+        """ remove least recently used content until the store is under
+            max_mb then remove links that no longer point at anything
+            keep is an iterable of checksums that must not be removed
+
+            partial downloads and objects from before the store sit at
+            their key as regular files, they count toward max_mb and are
+            evicted the same way, a partial just restarts from zero """
+        if not self.objects_dir.exists():
+            return
+
+        keep = set(self.path(c) for c in keep)
+        entries = []
+        total = 0
+        def add(path):
+            nonlocal total
+            st = path.stat()
+            total += st.st_size
+            entries.append((st.st_mtime, st.st_size, path))
+
+        if self.content_dir.exists():
+            for prefix in self.content_dir.iterdir():
+                for path in prefix.iterdir():
+                    add(path)
+
+        for path in self.objects_dir.iterdir():
+            if (not path.is_symlink() and path.is_file() and
+                not path.name.startswith('.')):  # skip in flight link temps
+                add(path)
+
+        limit = max_mb * 1024 ** 2
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= limit:
+                break
+            if path in keep:
+                continue
+
+            path.unlink()
+            total -= size
+            removed += 1
+
+        if removed:
+            for path in self.objects_dir.iterdir():
+                if path.is_symlink() and not path.exists():
+                    path.unlink()
+
+            log.info(f'evicted {removed} objects from {self}')
@@ -0,0 +1,294 @@
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from itertools import chain
+from collections import namedtuple
+import augpathlib as aug
+
+
+IndexRow = namedtuple('IndexRow', ('relpath', 'id', 'parent_id', 'dataset_id',
+                                   'is_dir', 'size', 'updated', 'checksum',
+                                   'file_id', 'fetched', 'indexed'))
+
+
+class PathIndex:
+    """ persistent index of the local copy of the remote file tree
+
+        one row per path that has remote metadata, keyed on the path
+        relative to the project root so that commands like goto,
+        status, and tofetch don't have to walk the whole tree reading
+        xattrs every time they run, rebuilt per dataset during pull
+        and updated for individual paths after refresh and fetch """
+
+    prefix = 'bf'
+    _fields = ', '.join(IndexRow._fields)
+    _insert = (f'INSERT OR REPLACE INTO paths ({_fields}) '
+               f'VALUES ({", ".join("?" * len(IndexRow._fields))})')
+
+    def __init__(self, db_path, project_path):
+        self.db_path = db_path
+        self.project_path = project_path
+        self._local = threading.local()
+        self.setup()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.db_path!r}, {self.project_path!r})'
+
+    def conn(self):
+        if not hasattr(self._local, 'conn'):
+            # pull runs one process per dataset, so writers may have to wait
+            conn = sqlite3.connect(self.db_path.as_posix(), timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+
+        return self._local.conn
+
+    def close(self):
+        if hasattr(self._local, 'conn'):
+            self._local.conn.close()
+            del self._local.conn
+
+    def setup(self):
+        if not self.db_path.parent.exists():
+            self.db_path.parent.mkdir(parents=True)
+
+        sqls = (('CREATE TABLE IF NOT EXISTS paths'
+                 '('
+                 'relpath TEXT PRIMARY KEY,'
+                 'id TEXT NOT NULL,'  # packages with many files share an id
+                 'parent_id TEXT,'
+                 'dataset_id TEXT,'
+                 'is_dir INTEGER,'
+                 'size INTEGER,'
+                 'updated REAL,'  # posix timestamp so that MAX works across timezones
+                 'checksum BLOB,'
+                 'file_id INTEGER,'
+                 'fetched INTEGER,'
+                 'indexed REAL'  # posix time the row was written
+                 ');'),
+                'CREATE INDEX IF NOT EXISTS paths_id ON paths (id);',
+                'CREATE INDEX IF NOT EXISTS paths_dataset_id ON paths (dataset_id);',
+                # remote state of each dataset as of its last pull
+                ('CREATE TABLE IF NOT EXISTS pulls'
+                 '('
+                 'dataset_id TEXT PRIMARY KEY,'
+                 'updated REAL,'
+                 'package_counts TEXT'  # json
+                 ');'),
+                # Dataset.fingerprint walks the whole dataset, cache it
+                ('CREATE TABLE IF NOT EXISTS fingerprints'
+                 '('
+                 'dataset_id TEXT PRIMARY KEY,'
+                 'state TEXT,'  # json, see dataset_state
+                 'fingerprint TEXT'
+                 ');'),)
+        conn = self.conn()
+        with conn:
+            for sql in sqls:
+                conn.execute(sql)
+
+            columns = [r[1] for r in conn.execute('PRAGMA table_info(paths)')]
+            if 'indexed' not in columns:  # index from before the column existed
+                conn.execute('ALTER TABLE paths ADD COLUMN indexed REAL')
+
+    def empty(self):
+        return self.conn().execute('SELECT 1 FROM paths LIMIT 1').fetchone() is None
+
+    def _meta(self, path):
+        if path.is_broken_symlink():
+            return aug.PathMeta.from_symlink(path)
+        else:
+            return aug.PathMeta.from_xattrs(path.xattrs(), prefix=self.prefix)
+
+    def _rows(self, paths, dataset_id):
+        """ paths must be ordered parents first, e.g. chain((p,), p.rchildren)
+            paths without a remote id are local only and are skipped """
+        ids = {}
+        indexed = time.time()
+        for path in paths:
+            meta = self._meta(path)
+            if meta.id is None:
+                continue
+
+            relpath = path.relative_to(self.project_path).as_posix()
+            ids[relpath] = meta.id
+            parent_relpath = relpath.rsplit('/', 1)[0] if '/' in relpath else None
+            parent_id = ids.get(parent_relpath)
+            if parent_id is None and parent_relpath is not None:
+                parent_id = self._meta(path.parent).id
+
+            is_dir = path.is_dir()
+            yield IndexRow(relpath,
+                           meta.id,
+                           parent_id,
+                           dataset_id,
+                           int(is_dir),
+                           meta.size,
+                           meta.updated.timestamp() if meta.updated else None,
+                           meta.checksum,
+                           meta.file_id,
+                           int(is_dir or not path.is_broken_symlink()),
+                           indexed)
+
+    def index_dataset(self, dataset_path):
+        """ replace every row for a dataset with a fresh walk of the dataset """
+        dataset_id = self._meta(dataset_path).id
+        if dataset_id is None:
+            return
+
+        # walk before taking the write lock, other datasets may be pulling
+        rows = list(self._rows(chain((dataset_path,), dataset_path.rchildren),
+                               dataset_id))
+        conn = self.conn()
+        with conn:
+            conn.execute('DELETE FROM paths WHERE dataset_id = ?', (dataset_id,))
+            conn.executemany(self._insert, rows)
+
+    def build(self):
+        """ index every dataset in the project """
+        for path in self.project_path.children:
+            if path.is_dir():
+                self.index_dataset(path)
+
+    def update(self, paths):
+        """ upsert rows for individual paths, e.g. after fetch or refresh """
+        rows = []
+        for path in paths:
+            relpath = path.relative_to(self.project_path).as_posix()
+            dataset_relpath = relpath.split('/', 1)[0]
+            dataset_id = self._meta(self.project_path / dataset_relpath).id
+            rows.extend(self._rows((path,), dataset_id=dataset_id))
+
+        conn = self.conn()
+        with conn:
+            conn.executemany(self._insert, rows)
+
+    def remove(self, relpaths):
+        """ drop rows for paths that no longer exist locally """
+        conn = self.conn()
+        with conn:
+            conn.executemany('DELETE FROM paths WHERE relpath = ?',
+                             [(r,) for r in relpaths])
+
+    def remove_dataset(self, dataset_id):
+        conn = self.conn()
+        with conn:
+            conn.execute('DELETE FROM paths WHERE dataset_id = ?', (dataset_id,))
+
+    def pull_state(self, dataset_id):
+        """ (updated, package_counts) recorded at the last pull or None """
+        row = self.conn().execute('SELECT updated, package_counts FROM pulls '
+                                  'WHERE dataset_id = ?', (dataset_id,)).fetchone()
+        if row is not None:
+            updated, package_counts = row
+            return updated, json.loads(package_counts)
+
+    def set_pull_state(self, dataset_id, updated, package_counts):
+        conn = self.conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO pulls (dataset_id, updated, package_counts) '
+                         'VALUES (?, ?, ?)',
+                         (dataset_id, updated, json.dumps(package_counts, sort_keys=True)))
+
+    def dataset_state(self, relpath, extra=tuple()):
+        """ json summary of the indexed rows of a dataset, if it does not
+            change then neither did any of the remote metadata that
+            Dataset.fingerprint reads, None if the dataset isn't indexed
+
+            NOTE local only files are not in the index, so they are
+            not covered here """
+        rows = self._select('WHERE relpath = ?', (relpath,))
+        if not rows:
+            return
+
+        row, = rows
+        updated = self.updated_max(relpath)
+        return json.dumps([row.id,
+                           row.updated,
+                           updated.timestamp() if updated is not None else None,
+                           self.size_counts(relpath),
+                           list(extra)])
+
+    def fingerprint(self, dataset_id, state):
+        """ the fingerprint cached for state or None """
+        row = self.conn().execute('SELECT state, fingerprint FROM fingerprints '
+                                  'WHERE dataset_id = ?', (dataset_id,)).fetchone()
+        if row is not None and row[0] == state:
+            return row[1]
+
+    def set_fingerprint(self, dataset_id, state, fingerprint):
+        conn = self.conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO fingerprints (dataset_id, state, fingerprint) '
+                         'VALUES (?, ?, ?)', (dataset_id, state, fingerprint))
+
+    def _select(self, where='', args=tuple()):
+        sql = f'SELECT {self._fields} FROM paths {where}'
+        return [IndexRow(*r) for r in self.conn().execute(sql, args)]
+
+    @staticmethod
+    def _under(relpath):
+        """ where clause for everything under relpath, including itself
+            '/' < '0' so the range covers exactly the children """
+        if relpath in ('', '.'):
+            return '1', ()
+
+        return ('(relpath = ? OR (relpath >= ? AND relpath < ?))',
+                (relpath, relpath + '/', relpath + '0'))
+
+    def by_id(self, id):
+        return self._select('WHERE id = ? ORDER BY relpath', (id,))
+
+    def under(self, relpath, files_only=False):
+        where, args = self._under(relpath)
+        if files_only:
+            where += ' AND is_dir = 0'
+
+        return self._select(f'WHERE {where} ORDER BY relpath', args)
+
+    def size_counts(self, relpath):
+        """ (local bytes, remote bytes, uncertain, local files, remote files, dirs)
+            matching the columns of the tofetch report """
+        where, args = self._under(relpath)
+        sql = ('SELECT '
+               'TOTAL(CASE WHEN is_dir = 0 AND fetched = 1 THEN size END), '
+               'TOTAL(CASE WHEN is_dir = 0 AND fetched = 0 THEN size END), '
+               'COUNT(CASE WHEN is_dir = 0 AND size IS NULL THEN 1 END), '
+               'COUNT(CASE WHEN is_dir = 0 AND fetched = 1 AND size IS NOT NULL THEN 1 END), '
+               'COUNT(CASE WHEN is_dir = 0 AND fetched = 0 AND size IS NOT NULL THEN 1 END), '
+               'COUNT(CASE WHEN is_dir = 1 AND relpath != ? THEN 1 END) '
+               f'FROM paths WHERE {where}')
+        local, remote, uncertain, lf, rf, td = self.conn().execute(sql, (relpath, *args)).fetchone()
+        return int(local), int(remote), bool(uncertain), lf, rf, td
+
+    def updated_max(self, relpath):
+        """ most recent updated time under relpath, dataset rows are excluded
+            to match Path.updated_cache_transitive """
+        where, args = self._under(relpath)
+        sql = f'SELECT MAX(updated) FROM paths WHERE {where} AND id != dataset_id'
+        ts, = self.conn().execute(sql, args).fetchone()
+        if ts is not None:
+            return datetime.fromtimestamp(ts, tz=timezone.utc)
+
+    @staticmethod
+    def current(row, path):
+        """ False if path changed after its row was written, fetch and
+            xattr writes both bump ctime, the cached mtime can be set to
+            the remote updated time so it can't be used here """
+        try:
+            return row.indexed is not None and path.lstat().st_ctime <= row.indexed
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    def row_meta(row):
+        return aug.PathMeta(id=row.id,
+                            size=row.size,
+                            updated=(datetime.fromtimestamp(row.updated, tz=timezone.utc)
+                                     if row.updated is not None else None),
+                            checksum=row.checksum,
+                            file_id=row.file_id)
+
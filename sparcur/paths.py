@@ -1,3 +1,4 @@
+import re
 import logging
 import hashlib
 import pathlib
@@ -10,6 +11,8 @@ from augpathlib import RepoPath, LocalPath
 from sparcur import backends
 from sparcur import exceptions as exc
 from sparcur.utils import log, GetTimeNow, register_type, transitive_dirs
+from sparcur.objects import ObjectStore
+from sparcur.pathindex import PathIndex
 from sparcur.config import auth
 
 
@@ -215,6 +218,26 @@ class BlackfynnCache(PrimaryCache, EatCache):
             msg = 'at the moment only datasets can be marked as sparse'
             raise NotImplementedError(msg)
 
+    def fetch(self, size_limit_mb=2):
+        super().fetch(size_limit_mb=size_limit_mb)
+        local = self.local
+        if local.is_file():
+            # the local write stamped the checksum so this does not reread
+            self._checksum_init(local.checksum(cypher=self._instance_cypher()))
+
+    def _checksum_init(self, checksum):
+        """ the remote does not always give us a checksum, so record
+            the one for the data we actually have in bf.checksum """
+        meta = self.meta
+        if meta is not None and meta.checksum is None:
+            nmeta = {k: v for k, v in meta.items()}
+            nmeta['checksum'] = checksum
+            self._meta_setter(meta.__class__(**nmeta))
+
+    @property
+    def object_store(self):
+        return ObjectStore(self.local_objects_dir, self.cypher().name)
+
     @property
     def data(self):
         """ get the 'cached' data which isn't really cached at the moment
@@ -236,13 +259,44 @@ class BlackfynnCache(PrimaryCache, EatCache):
         # TODO where to store the chain of prior versions? i.e. do
         # we just keep the xattrs in the object cache? how about file moves?
         # sigh git ...
-        if self.local_object_cache_path.exists():
-            locsize = self.local_object_cache_path.size
-            if locsize != meta.size:
-                raise NotImplementedError('TODO yield from local then fetch the rest starting at offset')
-
-            gen = chain((f'from local cache {self.local_object_cache_path}',),
-                        self.local_object_cache_path.data)
+        store = self.object_store
+        key = self.cache_key
+        ocp = store.key_path(key)  # same as self.local_object_cache_path
+        found = store.lookup(key, meta.checksum)
+        start = None  # byte offset when resuming a partial object
+        if found is not None:
+            # some other package already brought us this content
+            if meta.checksum is not None:
+                store.link(key, meta.checksum)
+        elif ocp.is_symlink():
+            # content was evicted or this package now has different content
+            ocp.unlink()
+        elif ocp.exists():
+            # a partial download or an object from before the content store
+            locsize = ocp.size
+            if meta.size is None or locsize > meta.size:
+                log.warning(f'discarding bad partial object {ocp} {locsize} {meta.size}')
+                ocp.unlink()
+            elif locsize == meta.size:
+                hasher = self.cypher()
+                for chunk in ocp.data:
+                    hasher.update(chunk)
+
+                if meta.checksum is None:
+                    found = ocp  # nothing else to check it against
+                elif hasher.digest() == meta.checksum:
+                    found = store.add(key, meta.checksum)
+                else:
+                    log.warning(f'discarding object with bad checksum {ocp}')
+                    ocp.unlink()
+            elif locsize:
+                start = locsize
+                log.info(f'resuming {self} from {start} of {meta.size}')
+            # else nothing was written before the last fetch failed, restart
+
+        from_local = found is not None
+        if from_local:
+            gen = chain((f'from local cache {found}',), found.data)
         else:
             if not hasattr(self._remote_class, '_api'):
                 # NOTE we do not want to dereference self.remote
@@ -251,7 +305,8 @@ class BlackfynnCache(PrimaryCache, EatCache):
                 # is bound
                 self._remote_class.anchorToCache(self.anchor)
 
-            gen = self._remote_class.get_file_by_id(meta.id, meta.file_id)
+            gen = self._remote_class.get_file_by_id(meta.id, meta.file_id,
+                                                    start=0 if start is None else start)
 
         try:
             self.data_headers = next(gen)
@@ -260,25 +315,52 @@ class BlackfynnCache(PrimaryCache, EatCache):
             raise exc.CacheNotFoundError(f'{self}') from e  # have to raise so that we don't overwrite the file
 
         log.debug(self.data_headers)
-        if self.local_object_cache_path.exists():
+        if from_local:
             yield from gen
-        else:
+            return
+
+        if start is None:
             # FIXME we MUST write the metadata first so that we know the expected size
             # so that in the event that the generator is only partially run out we know
             # that we can pick up where we left off with the fetch, this also explains
             # why all the cases where the cached data size did not match were missing
             # xattrs entirely
-
-            self.local_object_cache_path.touch()
-            self.local_object_cache_path.cache_init(meta)
-
-            yield from self.local_object_cache_path._data_setter(gen)
-
-            ls = self.local_object_cache_path.size
-            if ls != meta.size:
-                self.local_object_cache_path.unlink()
-                msg = f'{ls} != {meta.size} for {self}'
-                raise ValueError(msg)  # FIXME TODO
+            ocp.touch()
+            ocp.cache_init(meta)
+
+        # hash as we go, the caller needs every byte anyway
+        hasher = self.cypher()
+        if start is not None:
+            # consumers expect the whole file so replay what we already have
+            for chunk in ocp.data:
+                hasher.update(chunk)
+                yield chunk
+
+        for chunk in ocp._data_setter(gen, append=start is not None):
+            hasher.update(chunk)
+            yield chunk
+
+        ls = ocp.size
+        if meta.size is None:
+            # nothing to compare against, a partial object was discarded
+            # above so this is a whole download, only the checksum can check it
+            log.warning(f'no remote size for {self} got {ls}')
+        elif ls < meta.size:
+            # keep the partial object so the next fetch resumes from here
+            msg = f'{ls} < {meta.size} for {self}'
+            raise exc.IncompleteDownloadError(msg)
+        elif ls > meta.size:
+            ocp.unlink()
+            msg = f'{ls} > {meta.size} for {self}'
+            raise ValueError(msg)  # FIXME TODO
+
+        if meta.checksum is not None and hasher.digest() != meta.checksum:
+            ocp.unlink()
+            msg = f'{hasher.hexdigest()} != {meta.checksum.hex()} for {self}'
+            raise exc.ChecksumMismatchError(msg)
+
+        # multipart uploads have no remote checksum, use the one we computed
+        store.add(key, hasher.digest() if meta.checksum is None else meta.checksum)
 
 
     def _meta_is_root(self, meta):
@@ -409,6 +491,105 @@ class Path(aug.XopenPath, aug.RepoPath, aug.LocalPath):  # NOTE this is a hack t
         except OSError as e:
             raise exc.NoCachedMetadataError(self) from e
 
+    _checksum_key = 'sparcur.checksum'
+
+    def _checksum_cypher(self, cypher=aug.utils.default_cypher):
+        # same resolution rules as LocalPath.checksum
+        if (cypher == aug.utils.default_cypher and
+            self._cache_class is not None and
+            self._cache_class.cypher is not None):
+            return self._cache_class.cypher
+
+        return cypher
+
+    def _checksum_stamped(self, cypher):
+        """ the checksum stored when the file was last written if it has
+            not been modified or replaced since then """
+        try:
+            name, ino, mtime_ns, size, hexdigest = (
+                self.getxattr(self._checksum_key).decode().split(' '))
+            st = self.stat()
+        except (OSError, ValueError, exc.NoStreamError):
+            return
+
+        if (name == cypher().name and
+            int(ino) == st.st_ino and
+            int(mtime_ns) == st.st_mtime_ns and
+            int(size) == st.st_size):
+            return bytes.fromhex(hexdigest)
+
+    def _stamp_checksum(self, cypher, checksum, size):
+        """ size is the number of bytes that were hashed, if the file
+            is not that size then something else wrote to it after we
+            closed it and the checksum does not match what is there """
+        st = self.stat()
+        if st.st_size != size:
+            log.debug(f'not stamping checksum on {self} {st.st_size} != {size}')
+            return
+
+        value = (f'{cypher().name} {st.st_ino} {st.st_mtime_ns} '
+                 f'{st.st_size} {checksum.hex()}')
+        try:
+            self.setxattr(self._checksum_key, value.encode())
+        except OSError as e:
+            # read only files, filesystems without xattrs, etc.
+            log.debug(f'could not stamp checksum on {self} {e}')
+
+    def checksum(self, cypher=aug.utils.default_cypher, extra_cyphers=tuple()):
+        """ reuse the checksum computed when the file was last written
+            so that status and diff don't have to reread large files
+
+            NOTE this never stamps, only writes do, see _write_chunks """
+        if extra_cyphers or not self.is_file():
+            return super().checksum(cypher, extra_cyphers)
+
+        cypher = self._checksum_cypher(cypher)
+        checksum = self._checksum_stamped(cypher)
+        if checksum is None:
+            checksum = super().checksum(cypher)
+
+        return checksum
+
+    def _write_chunks(self, generator):
+        # hash the same buffers that go to disk, this covers fetch
+        # since the cache writes the local file through data
+        cypher = self._checksum_cypher()
+        m = cypher()
+        size = 0
+        def hashed():
+            nonlocal size
+            for chunk in generator:
+                m.update(chunk)
+                size += len(chunk)
+                yield chunk
+
+        super()._write_chunks(hashed())
+        self._stamp_checksum(cypher, m.digest(), size)
+
+    @property
+    def path_index(self):
+        """ the index of remote paths for the project containing this path
+            None if the path is not in a project """
+        project_path = self.find_cache_root()
+        if project_path is not None:
+            return PathIndex(project_path / self._cache_class._local_data_dir /
+                             'path-index.db', project_path)
+
+    def _index_dataset(self):
+        index = self.path_index
+        if index is not None:
+            index.index_dataset(self)
+            index.close()
+
+    def _index_update(self):
+        """ upsert the index row for this path, e.g. after a one off fetch """
+        index = self.path_index
+        if index is not None:
+            try:
+                index.update((self,))
+            finally:
+                index.close()
+
     @property
     def rchildren_dirs(self):
         # FIXME windows support if find not found
@@ -477,7 +658,9 @@ class Path(aug.XopenPath, aug.RepoPath, aug.LocalPath):  # NOTE this is a hack t
              Parallel=None,
              delayed=None,
              _in_parallel=False,
-             exclude_uploaded=True,):
+             exclude_uploaded=True,
+             changed_only=False,
+             diff=False,):
         # TODO usage errors
 
         if time_now is None:
@@ -498,36 +681,229 @@ class Path(aug.XopenPath, aug.RepoPath, aug.LocalPath):  # NOTE this is a hack t
         cache = self.cache
 
         if cache.is_organization():
-            if debug or Parallel is None or n_jobs <= 1:
-                for child in self.children:
-                    if paths is None or child in paths:
-                        child.pull()
-            else:
-                Parallel(n_jobs=n_jobs)(
-                    delayed(child.pull)(_in_parallel=True,
-                                        time_now=time_now,
-                                        cache_anchor=cache.anchor,
-                                        log_name=_log.name,
-                                        log_level=log_level,
-                                        exclude_uploaded=exclude_uploaded,)
-                    for child in self.children
-                    if paths is None or child in paths)
+            children = [child for child in self.children
+                        if paths is None or child in paths]
+            # pull states are only read and recorded for changed_only
+            index = self.path_index if changed_only else None
+            try:
+                if index is not None:
+                    states = self._remote_dataset_states(children)
+                    unchanged = [child for child in children
+                                 if child.cache_id in states and
+                                 index.pull_state(child.cache_id) == states[child.cache_id]]
+                    _log.info(f'skipping {len(unchanged)} unchanged datasets')
+                    children = [child for child in children if child not in unchanged]
+
+                if debug or Parallel is None or n_jobs <= 1:
+                    for child in children:
+                        child.pull(time_now=time_now,
+                                   exclude_uploaded=exclude_uploaded,
+                                   diff=diff)
+                else:
+                    Parallel(n_jobs=n_jobs)(
+                        delayed(child.pull)(_in_parallel=True,
+                                            time_now=time_now,
+                                            cache_anchor=cache.anchor,
+                                            log_name=_log.name,
+                                            log_level=log_level,
+                                            exclude_uploaded=exclude_uploaded,
+                                            diff=diff,)
+                        for child in children)
+
+                if index is not None:
+                    # only recorded once the pulls succeed, the state was
+                    # retrieved before the pull so a change that lands
+                    # during the pull will be caught next time
+                    for child in children:
+                        if child.cache_id in states:
+                            index.set_pull_state(child.cache_id, *states[child.cache_id])
+            finally:
+                if index is not None:
+                    index.close()
 
         elif cache.is_dataset():
-            self._pull_dataset(time_now, exclude_uploaded)  # XXX actual pull happens in here
+            self._pull_dataset(time_now, exclude_uploaded, diff)  # XXX actual pull happens in here
 
         else:
             raise NotImplementedError(self)
 
-    def _pull_dataset(self, time_now, exclude_uploaded):
+    def _remote_dataset_states(self, children):
+        """ {dataset id: (updated, package counts)} from the remote
+            one listing for the organization plus one package count
+            request per dataset, much cheaper than pulling a dataset """
+        from pyontutils.utils import Async, deferred
+        ids = {child.cache_id for child in children}
+        remotes = [remote for remote in self.cache.remote.children
+                   if remote.id in ids]
+
+        def state(remote):
+            updated = remote.meta.updated
+            return (remote.id,
+                    (updated.timestamp() if updated is not None else None,
+                     remote.bfobject.packageTypeCounts))
+
+        return dict(Async(rate=self._remote_class._async_rate)(
+            deferred(state)(remote) for remote in remotes))
+
+    def _pull_dataset(self, time_now, exclude_uploaded, diff=False):
         cache = self.cache
         try:
             _old_eu = self._remote_class._exclude_uploaded
             cache._remote_class._exclude_uploaded = exclude_uploaded
-            return self._pull_dataset_internal(time_now)
+            if diff and list(self.children):
+                try:
+                    out = self._pull_dataset_diff(time_now)
+                    self._gc_upstream()
+                    return out
+                except self._DiffConflict as e:
+                    log.info(f'{e}, falling back to a full pull for {self}')
+
+            out = self._pull_dataset_internal(time_now)
+            self._gc_upstream()
+            return out
         finally:
             cache._remote_class._exclude_uploaded = _old_eu
 
+    class _DiffConflict(Exception):
+        """ the working tree cannot be updated in place """
+
+    _upstream_keep = 1  # old copies of each dataset left by full pulls
+
+    def _gc_upstream(self):
+        """ remove all but the most recent _upstream_keep old copies of this
+            dataset that full pulls leave in temp-upstream """
+        contain_upstream = self.cache.local_data_dir / 'temp-upstream'
+        if not contain_upstream.exists():
+            return
+
+        # name-<timestamp> or name-<timestamp>-ERROR, never match other datasets
+        rx = re.compile(re.escape(self.name) + r'-[0-9]{8}T[0-9]{6},[0-9]+Z(-ERROR)?$')
+        olds = sorted((p for p in contain_upstream.children if rx.match(p.name)),
+                      key=lambda p: p.name, reverse=True)
+        for old in olds[self._upstream_keep:]:
+            log.info(f'removing old copy {old}')
+            old.rmtree(onerror=lambda *args: log.error(args))
+
+    def _pull_dataset_diff(self, time_now):
+        """ update the working tree in place with only the differences
+            between the remote listing and the working tree
+
+            paths are keyed on (id, file_id) so renames become moves,
+            removed and changed files are moved to the trash, raises
+            _DiffConflict if anything would land on an existing path """
+        cache = self.cache
+        remote = cache.remote
+
+        def meta(path):
+            if path.is_broken_symlink():
+                return aug.PathMeta.from_symlink(path)
+            else:
+                return aug.PathMeta.from_xattrs(path.xattrs(), prefix='bf')
+
+        def key(meta, is_dir):
+            return meta.id, None if is_dir else meta.file_id
+
+        def different(a, b):
+            return any(getattr(a, f) != getattr(b, f)
+                       for f in ('updated', 'size', 'checksum'))
+
+        upstream = {}
+        for child in remote._rchildren(create_cache=False,
+                                       exclude_uploaded=remote._exclude_uploaded):
+            parts = tuple(child._parts_relative_to(remote))
+            cmeta = child.meta
+            upstream[key(cmeta, child.is_dir())] = parts, child, cmeta
+
+        current = {}
+        working = {}
+        for path in self.rchildren:
+            wmeta = meta(path)
+            if wmeta.id is None:
+                continue  # local only
+
+            k = key(wmeta, path.is_dir())
+            current[k] = path
+            working[k] = wmeta
+
+        added = [k for k in upstream if k not in working]
+        removed = [k for k in working if k not in upstream]
+        moved = [k for k in upstream if k in working and
+                 current[k] != self.joinpath(*upstream[k][0])]
+        # a path can be both moved and changed, changes apply after moves
+        changed = [k for k in upstream if k in working and
+                   different(working[k], upstream[k][2])]
+
+        if not (added or removed or moved or changed):
+            log.info(f'no changes for {self}')
+            return
+
+        log.info(f'{self} added {len(added)} removed {len(removed)} '
+                 f'moved {len(moved)} changed {len(changed)}')
+
+        for k in added + moved:
+            target = self.joinpath(*upstream[k][0])
+            if target.exists() or target.is_broken_symlink():
+                raise self._DiffConflict(f'{target} already exists')
+
+        def move(k, target):
+            source = current[k]
+            source.rename(target)
+            if target.is_dir():
+                prefix = source.as_posix() + '/'
+                for ok, path in current.items():
+                    if path.as_posix().startswith(prefix):
+                        current[ok] = target / path.relative_to(source)
+
+            current[k] = target
+
+        def depth(k):
+            return len(upstream[k][0])
+
+        def create(k):
+            parts, child, cmeta = upstream[k]
+            current[k] = cache._make_child(parts, child).local
+
+        # directories top down so that targets always have a parent
+        dirs = sorted((k for k in added + moved if upstream[k][1].is_dir()), key=depth)
+        for k in dirs:
+            target = self.joinpath(*upstream[k][0])
+            if k not in working:
+                create(k)
+            elif current[k] != target:  # may have moved with its parent
+                move(k, target)
+
+        for k in moved:
+            target = self.joinpath(*upstream[k][0])
+            if current[k] != target:
+                move(k, target)
+
+        for k in changed:
+            path = current[k]
+            if path.is_dir():
+                path.cache._meta_setter(upstream[k][2])
+            else:
+                # same as a full pull, the old content goes away
+                if path.is_broken_symlink():
+                    path.unlink()
+                else:
+                    path.cache.crumple()
+
+                create(k)
+
+        for k in added:
+            if k not in dirs:
+                create(k)
+
+        # deepest first so removed folders are empty of tracked paths
+        for k in sorted(removed, key=lambda k: len(current[k].parts), reverse=True):
+            path = current[k]
+            if path.is_broken_symlink():
+                path.unlink()
+            else:
+                path.cache.crumple()
+
+        self._index_dataset()
+
     def _pull_dataset_internal(self, time_now):
         cache = self.cache
         if cache.is_organization():
@@ -537,7 +913,9 @@ class Path(aug.XopenPath, aug.RepoPath, aug.LocalPath):  # NOTE this is a hack t
 
         children = list(self.children)
         if not children:
-            return list(self.cache.rchildren)  # XXX actual pull happens here
+            out = list(self.cache.rchildren)  # XXX actual pull happens here
+            self._index_dataset()
+            return out
 
         # instantiate a temporary staging area for pull
         ldd = cache.local_data_dir
@@ -584,9 +962,12 @@ class Path(aug.XopenPath, aug.RepoPath, aug.LocalPath):  # NOTE this is a hack t
         suf = f'-{time_now.START_TIMESTAMP_LOCAL_SAFE}'
         upstream_now_old.rename(upstream_now_old.parent /
                                 (upstream_now_old.name + suf))  # FIXME
+        self._index_dataset()
 
     def updated_cache_transitive(self):
         """ fast get the date for the most recently updated cached path """
+        # NOTE this stays a walk, the path index can lag a pull and
+        # has no rows for local only or overwritten files
         if self.cache.is_organization():
             gen = (rc for c in self.children for rc in c.rchildren)
         elif self.cache.is_dataset():
@@ -622,12 +1003,16 @@ class Path(aug.XopenPath, aug.RepoPath, aug.LocalPath):  # NOTE this is a hack t
                                 replace=True,
                                 local_backup=False))
 
+        # _stream_from_local already checksummed self so this is free
+        checksum = self.checksum()
         if True:  # local_backup = True:  # force True until we can get remote checksums
             # FIXME there must be a better way to do this ...
-            object_path = self._cache_class._anchor.local_objects_dir / remote.cache_key
-            # TODO possibly use _data_setter to calculate the hash at the same time?
+            anchor = self._cache_class._anchor
+            object_path = anchor.local_objects_dir / remote.cache_key
             object_path.copy_from(self)
             object_path.cache_init(remote.meta)
+            if remote.meta.checksum in (None, checksum):
+                anchor.object_store.add(remote.cache_key, checksum)
 
         if self.cache is None:
             # FIXME didn't we already figure out the right way to do this?
@@ -649,6 +1034,7 @@ class Path(aug.XopenPath, aug.RepoPath, aug.LocalPath):  # NOTE this is a hack t
             # we already have the latest data (ignoring concurency)
             remote.update_cache(cache=self.cache, fetch=False) # FIXME fetch=False => different diff rule
 
+        self.cache._checksum_init(checksum)
         return remote
 
 
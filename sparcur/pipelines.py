@@ -1,8 +1,13 @@
+import os
 import copy
 import json
+import multiprocessing
+from time import perf_counter
+from functools import wraps
 from pathlib import Path
 from itertools import chain
 from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import idlib
 import rdflib
 import augpathlib as aug
@@ -26,6 +31,7 @@ from sparcur.core import DictTransformer, copy_all, get_all_errors, compact_erro
 from sparcur.core import JT, JEncode, log, logd, lj, OntId, OntTerm, OntCuries, get_nested_by_key
 from sparcur.core import JApplyRecursive, json_identifier_expansion, dereference_all_identifiers
 from sparcur.state import State
+from sparcur.profiling import profiler
 from sparcur.config import auth
 from sparcur.derives import Derives
 from sparcur.extract import xml as exml
@@ -39,16 +45,34 @@ _THIS_PATH_KEY = object()
 THIS_PATH = [_THIS_PATH_KEY]
 
 
+def _pipe_data(pipe):
+    return pipe.data
+
+
 class MapPathsCombinator:
 
     # FIXME could be implemented as a subpipeline of a subpipeline ?
     # not quite sure how to do that though
 
-    def __init__(self, PipelineClass, debug=True, n_jobs=12):
+    _n_jobs = 1  # serial unless the cli sets it from --jobs
+    # use processes only when there are enough bytes to parse that
+    # the work outweighs worker start up and pickling, e.g. a few
+    # big xlsx files, thousands of small csv files go to threads
+    process_min_mb = 32
+    process_min_file_mb = 1
+    window = 4  # results in flight per worker, bounds memory while streaming
+    batch_size = 16  # max pipelines pickled together for a process worker
+
+    def __init__(self, PipelineClass, debug=False, n_jobs=None, mode=None):
         # FIXME need to figure out how to pass config variables in
         self.PipelineClass = PipelineClass
         self.debug = debug
         self.n_jobs = n_jobs
+        self.mode = mode  # None means pick from the file sizes
+
+    @property
+    def _jobs(self):
+        return self._n_jobs if self.n_jobs is None else self.n_jobs
 
     def __call__(self, previous_pipeline, lifters, runtime_context,
                  # FIXME from runtime context or something?
@@ -66,8 +90,9 @@ class MapPathsCombinator:
 
         data = previous_pipeline.data
         sv = data['template_schema_version'] if 'template_schema_version' in data else None
+        self.paths = data['paths']
         previous_pipelines = [DataWrapper({'path': p, 'template_schema_version': sv,})
-                              for p in data['paths']]
+                              for p in self.paths]
         self.pipes = [self.PipelineClass(previous_pipeline,
                                          lifters,
                                          runtime_context)
@@ -75,13 +100,109 @@ class MapPathsCombinator:
 
         return self # hack to mimic __init__
 
+    @staticmethod
+    def _size(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:  # not fetched, the pipeline will report it
+            return 0
+
+    def _mode(self):
+        """ serial, thread, or process """
+        if self.mode is not None:
+            return self.mode
+
+        if self.debug or self._jobs == 1 or len(self.pipes) < 2:
+            return 'serial'
+
+        if multiprocessing.current_process().daemon:
+            # inside an export pool worker, daemonic processes cannot
+            # have children so loky cannot start its workers
+            return 'thread'
+
+        mb = 1024 ** 2
+        total = sum(self._size(p) for p in self.paths)
+        if (total >= self.process_min_mb * mb and
+            total / len(self.paths) >= self.process_min_file_mb * mb):
+            return 'process'
+
+        return 'thread'
+
+    def _iter_threads(self, jobs):
+        """ ordered results with at most jobs * window pipelines in flight """
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = deque()
+            for pipe in self.pipes:
+                futures.append(pool.submit(_pipe_data, pipe))
+                if len(futures) >= jobs * self.window:
+                    yield futures.popleft().result()
+
+            while futures:
+                yield futures.popleft().result()
+
+    def _iter_processes(self, jobs):
+        """ ordered results, pipelines are sent to the workers in
+            batches so that pickling is amortized over many files """
+        batch_size = max(1, min(self.batch_size, len(self.pipes) // jobs))
+        step = jobs * self.window * batch_size
+        with Parallel(n_jobs=jobs, batch_size=batch_size) as parallel:
+            for i in range(0, len(self.pipes), step):
+                yield from parallel(delayed(_pipe_data)(p)
+                                    for p in self.pipes[i:i + step])
+
+    def iter_data(self):
+        mode = self._mode()
+        jobs = min(self._jobs, len(self.pipes))
+        logd.debug(f'{self.PipelineClass.__name__} {len(self.pipes)} paths {mode}')
+        if mode == 'serial':
+            return (p.data for p in self.pipes)
+        elif mode == 'thread':
+            return self._iter_threads(jobs)
+        elif mode == 'process':
+            return self._iter_processes(jobs)
+        else:
+            raise ValueError(f'unknown mode {mode!r}')
+
     @property
     def data(self):
-        if self.debug or self.n_jobs == 1:
-            return [p.data for p in self.pipes]
-        else:
-            return Parallel(n_jobs=self.n_jobs)(delayed(lambda :p.data)()
-                                                for p in self.pipes)
+        return list(self.iter_data())
+
+
+def _memoize_stage(function):
+    """ compute a pipeline stage once per instance and record how long
+        it took excluding the time spent in the stages it called
+
+        keyed on qualname so that a subclass stage that calls
+        super().stage gets its own entry instead of the parent's """
+
+    key = function.__qualname__
+    @wraps(function)
+    def stage(self):
+        cache = self.__dict__.setdefault('_stage_cache', {})
+        if key in cache:
+            return cache[key]
+
+        stack = self.__dict__.setdefault('_stage_stack', [])
+        stack.append(0)
+        start = perf_counter()
+        try:
+            if not profiler.enabled:  # skip the context manager
+                value = function(self)
+            else:
+                with profiler.measure('stage', key):
+                    value = function(self)
+        finally:
+            elapsed = perf_counter() - start
+            inner = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+
+        # errors are not cached, a SkipPipelineError has to propagate every time
+        self.stage_times[key] = elapsed - inner
+        cache[key] = value
+        return value
+
+    return stage
 
 
 class Pipeline:
@@ -89,6 +210,36 @@ class Pipeline:
 
     object_class = None
 
+    # properties listed here are computed once per instance
+    # stages mutate the data from the stage before them in place
+    # so a partially invalidated chain would be wrong, use invalidate
+    _stages = tuple()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in cls._stages:
+            prop = cls.__dict__.get(name)
+            if (not isinstance(prop, (property, sc.hproperty)) or
+                getattr(prop.fget, '_memoized', False)):
+                continue
+
+            fget = _memoize_stage(prop.fget)
+            fget._memoized = True
+            if isinstance(prop, property):
+                setattr(cls, name, property(fget, prop.fset, prop.fdel, prop.__doc__))
+            else:  # hproperty, keep the object since it carries the schema
+                prop.fget = fget
+
+    @property
+    def stage_times(self):
+        """ {stage qualname: seconds} excluding time in nested stages """
+        return self.__dict__.setdefault('_stage_times', {})
+
+    def invalidate(self):
+        """ drop all memoized stages so the next access recomputes """
+        self.__dict__.pop('_stage_cache', None)
+        self.__dict__.pop('_stage_times', None)
+
     @property
     def object(self):
         return self.object_class(self.data)
@@ -243,6 +394,8 @@ class PrePipeline(Pipeline):
 class PathPipeline(PrePipeline):
     # FIXME this is a temporary solution to reuse the conversion existing
     data_transformer_class = None
+    _stages = 'transformed', 'data'
+
     def __init__(self, previous_pipeline, lifters, runtime_context):
         #log.debug(lj(previous_pipeline.data))
         if isinstance(previous_pipeline, Path):
@@ -261,8 +414,19 @@ class PathPipeline(PrePipeline):
         self.path = path
         self.template_schema_version = template_schema_version
 
+    def invalidate(self):
+        super().invalidate()
+        if hasattr(self, '_c_transformer'):
+            delattr(self, '_c_transformer')
+
     @property
     def _transformer(self):
+        if not hasattr(self, '_c_transformer'):
+            self._c_transformer = self._make_transformer()
+
+        return self._c_transformer
+
+    def _make_transformer(self):
         try:
             return self.data_transformer_class(self.path, template_schema_version=self.template_schema_version)
         except (exc.FileTypeError, exc.NoDataError, exc.BadDataError) as e:
@@ -464,6 +628,11 @@ class Merge(Pipeline):
         self.lifters = lifters
         self.runtime_context = runtime_context
 
+    def invalidate(self):
+        super().invalidate()
+        for pipeline in self.pipelines:
+            pipeline.invalidate()
+
     @property
     def data(self):
         data = {}
@@ -503,6 +672,19 @@ class JSONPipeline(Pipeline):
     # if there is more than one class any overlapping keys will match the output
     # of the last class in the pipeline FIXME duplicate keys should probably error loudly ...
 
+    _stages = ('pipeline_start',
+               'subpipelined',
+               'copied',
+               'moved',
+               'cleaned',
+               'updated',
+               'augmented',
+               'pipeline_end',
+               'added',
+               'data',)
+
+    _subpipeline_jobs = 1  # set from --jobs by the cli
+
     subpipelines = []
     copies = []
     moves = []
@@ -572,6 +754,29 @@ class JSONPipeline(Pipeline):
         if hasattr(runtime_context, 'path'):
             self.path = runtime_context.path
 
+    def invalidate(self):
+        """ pipeline_start mutates the data of the previous pipeline
+            in place so it has to be recomputed as well """
+        super().invalidate()
+        self.previous_pipeline.invalidate()
+
+    def _plan(self, name, kind):
+        """ the spec at name compiled once per class, the spec is
+            checked by identity so reassigning it recompiles """
+        spec = getattr(self, name)
+        cls = self.__class__
+        if '_plans' not in cls.__dict__:
+            cls._plans = {}
+
+        if name in cls._plans:
+            cached_spec, plan = cls._plans[name]
+            if cached_spec is spec:
+                return plan
+
+        plan = DictTransformer.compile(kind, spec, source_key_optional=True)
+        cls._plans[name] = spec, plan
+        return plan
+
     def subpipeline_errors(self, errors):
         """ override this for pipeline specific error handling rules """
         for path, error, subpipeline_class in errors:
@@ -592,7 +797,8 @@ class JSONPipeline(Pipeline):
                 data,
                 self.runtime_context,
                 self.subpipelines,
-                lifters=self.lifters))
+                lifters=self.lifters,
+                jobs=self._subpipeline_jobs))
         except Exception as e:
             log.exception(e)
             log.critical('Unhandled error!')
@@ -606,19 +812,19 @@ class JSONPipeline(Pipeline):
     @property
     def copied(self):
         data = self.subpipelined
-        DictTransformer.copy(data, self.copies, source_key_optional=True)
+        self._plan('copies', 'copy')(data)
         return data
 
     @property
     def moved(self):
         data = self.copied
-        DictTransformer.move(data, self.moves, source_key_optional=True)
+        self._plan('moves', 'move')(data)
         return data
 
     @property
     def cleaned(self):
         data = self.moved
-        removed = list(DictTransformer.pop(data, self.cleans, source_key_optional=True))
+        removed = self._plan('cleans', 'pop')(data)
         #log.debug(f'cleaned the following values from {self}' + lj(removed))
         #log.debug(log.handlers)
         log.debug(f'cleaned {len(removed)} values from {self}')
@@ -627,7 +833,7 @@ class JSONPipeline(Pipeline):
     @property
     def updated(self):
         data = self.cleaned
-        DictTransformer.update(data, self.updates, source_key_optional=True)
+        self._plan('updates', 'update')(data)
         return data
 
     @property
@@ -645,7 +851,7 @@ class JSONPipeline(Pipeline):
         # FIXME THIS_PATH is cool but but violates our desire to keep validating the
         # existence of things separate from rearranging them
         try:
-            DictTransformer.derive(data, self.derives, source_key_optional=True)
+            self._plan('derives', 'derive')(data)
         finally:
             if _THIS_PATH_KEY in data:
                 data.pop(_THIS_PATH_KEY)
@@ -1581,7 +1787,7 @@ class ToJsonLdPipeline(JSONPipeline):
     @property
     def augmented_after_added(self):
         data = super().added
-        DictTransformer.derive(data, self.derives_after_adds, source_key_optional=True)
+        self._plan('derives_after_adds', 'derive')(data)
         return data
 
     @property
@@ -0,0 +1,166 @@
+""" opt in instrumentation for the dataset pipelines
+
+    spc export --profile-pipelines records wall time and peak
+    allocation for every pipeline stage, derive function, and
+    subpipeline class for each dataset, see PipelineProfiler """
+
+import json
+import threading
+import tracemalloc
+from time import perf_counter
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class PipelineProfiler:
+    """ records are keyed on (kind, name) per dataset
+
+        seconds and peak_bytes are inclusive of everything nested
+        inside, self_seconds excludes time spent in nested records
+        so that summing self_seconds over a dataset gives its total
+
+        tracemalloc is global to the process, so peak allocation
+        is approximate when pipelines run in threads """
+
+    kinds = 'stage', 'derive', 'subpipeline'
+
+    def __init__(self):
+        self.enabled = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._records = {}
+        self._dataset = None
+
+    def start(self, trace_memory=True):
+        self.enabled = True
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @property
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+
+        return self._local.stack
+
+    @contextmanager
+    def dataset(self, id):
+        """ everything measured inside is attributed to dataset id """
+        self._dataset = id
+        self._records = {}
+        try:
+            yield self
+        finally:
+            self._dataset = None
+
+    @contextmanager
+    def measure(self, kind, name):
+        if not self.enabled:
+            yield
+            return
+
+        tracing = tracemalloc.is_tracing()
+        stack = self._stack
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # keep the parent peak before we reset it
+                stack[-1][2] = max(stack[-1][2], peak)
+
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+
+        frame = [0, current, 0]  # child seconds, start bytes, running peak
+        stack.append(frame)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - start
+            stack.pop()
+            peak_bytes = 0
+            if tracing:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(frame[2], peak)
+                peak_bytes = peak - frame[1]
+                if stack:
+                    stack[-1][2] = max(stack[-1][2], peak)
+
+                tracemalloc.reset_peak()
+
+            if stack:
+                stack[-1][0] += seconds
+
+            self._record(kind, name, seconds, seconds - frame[0], peak_bytes)
+
+    def _record(self, kind, name, seconds, self_seconds, peak_bytes):
+        with self._lock:
+            key = kind, name
+            if key not in self._records:
+                self._records[key] = dict(kind=kind, name=name, calls=0, seconds=0,
+                                          self_seconds=0, peak_bytes=0)
+
+            r = self._records[key]
+            r['calls'] += 1
+            r['seconds'] += seconds
+            r['self_seconds'] += self_seconds
+            r['peak_bytes'] = max(r['peak_bytes'], peak_bytes)
+
+    def records(self):
+        return sorted(self._records.values(), key=lambda r: -r['self_seconds'])
+
+    def dump(self, path):
+        """ write the records for the current dataset, one file per
+            dataset so that worker processes don't have to coordinate """
+        blob = {'id': self._dataset, 'records': self.records()}
+        with open(path, 'wt') as f:
+            json.dump(blob, f, indent=2)
+
+    @classmethod
+    def report(cls, profile_dir, json_path, table_path, top=30):
+        """ merge the per dataset records in profile_dir, write them as
+            json and write a summary table sorted by time, returns the table """
+        datasets = []
+        for path in sorted(profile_dir.glob('*.json')):
+            with open(path, 'rt') as f:
+                datasets.append(json.load(f))
+
+        for d in datasets:
+            d['total_seconds'] = sum(r['self_seconds'] for r in d['records'])
+            d['peak_bytes'] = max((r['peak_bytes'] for r in d['records']), default=0)
+
+        datasets.sort(key=lambda d: -d['total_seconds'])
+        totals = defaultdict(lambda: dict(calls=0, self_seconds=0, peak_bytes=0))
+        for d in datasets:
+            for r in d['records']:
+                t = totals[r['kind'], r['name']]
+                t['calls'] += r['calls']
+                t['self_seconds'] += r['self_seconds']
+                t['peak_bytes'] = max(t['peak_bytes'], r['peak_bytes'])
+
+        with open(json_path, 'wt') as f:
+            json.dump({'datasets': datasets}, f, indent=2)
+
+        mb = 1024 ** 2
+        lines = [f'{"seconds":>10} {"peak MB":>10}  dataset',]
+        lines += [f'{d["total_seconds"]:>10.2f} {d["peak_bytes"] / mb:>10.1f}  {d["id"]}'
+                  for d in datasets[:top]]
+        lines += ['', f'{"seconds":>10} {"peak MB":>10} {"calls":>8}  {"kind":<12} name']
+        lines += [f'{t["self_seconds"]:>10.2f} {t["peak_bytes"] / mb:>10.1f} '
+                  f'{t["calls"]:>8}  {kind:<12} {name}'
+                  for (kind, name), t in sorted(totals.items(),
+                                                key=lambda kv: -kv[1]['self_seconds'])[:top]]
+        table = '\n'.join(lines) + '\n'
+        with open(table_path, 'wt') as f:
+            f.write(table)
+
+        return table
+
+
+profiler = PipelineProfiler()
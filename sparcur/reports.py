@@ -449,10 +449,25 @@ class Report:
         def dead(p):
             raise ValueError(p)
 
+        index = self._path_index()
         for d in dirs:
             if not Path(d).is_dir():
                 continue  # helper files at the top level, and the symlinks that destory python
             path = Path(d).resolve()
+            if index is not None:
+                (local, outstanding, uncertain, lf, ff,
+                 td) = index.size_counts(path.relative_to(index.project_path).as_posix())
+                data.append([path.name,
+                             aug.FileSize(local),
+                             aug.FileSize(outstanding),
+                             aug.FileSize(local + outstanding),
+                             uncertain,
+                             lf,
+                             ff,
+                             lf + ff,
+                             td])
+                continue
+
             paths = path.rchildren #list(path.rglob('*'))
             path_meta = {p:p.cache.meta if p.cache else dead(p) for p in paths
                          if p.suffix not in ('.swp',)}
@@ -506,7 +521,14 @@ class Report:
     def filetypes(self, ext=None):
         key = self._sort_key
         paths = self.paths if self.paths else (self.cwd,)
-        paths = [c for p in paths for c in p.rchildren if not c.is_dir()]
+        index = self._path_index()
+        if index is not None:
+            pp = index.project_path
+            paths = [pp / row.relpath for p in paths
+                     for row in index.under(p.relative_to(pp).as_posix(),
+                                            files_only=True)]
+        else:
+            paths = [c for p in paths for c in p.rchildren if not c.is_dir()]
         rex = re.compile('^\.[0-9][0-9][0-9A-Z]$')
         rex_paths = [p for p in paths if re.match(rex, p.suffix)]
         paths = [p for p in paths if not re.match(rex, p.suffix)]
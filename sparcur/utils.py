@@ -142,6 +142,95 @@ class GetTimeNow:
         return timeformat_friendly(self._start_time_local)
 
 
+class Concurrency:
+    """ number of workers for each parallel stage
+
+        the default is an int or 'auto', stages can be overridden
+        e.g. Concurrency('auto', export=32, xml=4) or from the cli
+        --jobs=auto,export=32,xml=4
+
+        auto sizes pools from the cpu count and free memory using a
+        rough per worker memory estimate for the stage """
+
+    # rough peak rss per worker in MB, tune as needed
+    worker_mb = {'pull': 256,
+                 'export': 2048,
+                 'xml': 1024,
+                 'manifests': 512,
+                 'subpipelines': 128,  # threads inside an export worker
+                 'fetch': 64,}
+    stages = tuple(worker_mb)
+
+    def __init__(self, default=12, **overrides):
+        bads = [s for s in overrides if s not in self.stages]
+        if bads:
+            raise ValueError(f'unknown stages {bads} not in {self.stages}')
+
+        self.default = self._normalize(default)
+        self.overrides = {s:self._normalize(v) for s, v in overrides.items()}
+
+    @staticmethod
+    def _normalize(value):
+        if value == 'auto':
+            return value
+
+        value = int(value)
+        if value < 1:
+            raise ValueError(f'jobs must be >= 1 or auto not {value}')
+
+        return value
+
+    @classmethod
+    def fromString(cls, string):
+        """ N, auto, stage=N, or a comma separated mix of them """
+        default = 12
+        overrides = {}
+        for part in string.split(','):
+            if '=' in part:
+                stage, value = part.split('=', 1)
+                overrides[stage.strip()] = value.strip()
+            else:
+                default = part.strip()
+
+        return cls(default, **overrides)
+
+    def __repr__(self):
+        overrides = ''.join(f', {k}={v!r}' for k, v in self.overrides.items())
+        return f'{self.__class__.__name__}({self.default!r}{overrides})'
+
+    def __call__(self, stage):
+        value = self.overrides.get(stage, self.default)
+        if value == 'auto':
+            return self._auto(stage)
+
+        return value
+
+    @staticmethod
+    def _free_mb():
+        try:
+            with open('/proc/meminfo', 'rt') as f:
+                for line in f:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) // 1024
+        except FileNotFoundError:
+            pass
+
+        try:
+            return (os.sysconf('SC_AVPHYS_PAGES') *
+                    os.sysconf('SC_PAGE_SIZE') // 1024 ** 2)
+        except (ValueError, AttributeError, OSError):
+            return None
+
+    def _auto(self, stage):
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        n = cpus or 1
+        free_mb = self._free_mb()
+        if free_mb is not None:
+            n = min(n, free_mb // self.worker_mb.get(stage, 512))
+
+        return max(n, 1)
+
+
 class SimpleFileHandler:
     _FIRST = object()
     def __init__(self, log_file_path, *logs, mimic=_FIRST):
@@ -1,4 +1,5 @@
 import unittest
+from sparcur import exceptions as exc
 from sparcur.core import adops, DictTransformer
 from sparcur.derives import Derives as De
 
@@ -213,3 +214,63 @@ class TestDictTransformer(ExamplesDT, Populator, unittest.TestCase):
     to_test = DictTransformer
     apply = False
 TestDictTransformer.populate()
+
+
+class CompiledDictTransformer:
+    """ same signatures as DictTransformer but run through compiled plans """
+
+    @staticmethod
+    def derive(data, derives, source_key_optional=True):
+        DictTransformer.compile('derive', derives, source_key_optional)(data)
+
+    @staticmethod
+    def update(data, updates, source_key_optional=False):
+        DictTransformer.compile('update', updates, source_key_optional)(data)
+
+    @staticmethod
+    def move(data, moves, source_key_optional=False):
+        DictTransformer.compile('move', moves, source_key_optional)(data)
+
+
+class TestCompiledPlans(ExamplesDT, Populator, unittest.TestCase):
+    functions = 'derive', 'update', 'move',
+    to_test = CompiledDictTransformer
+    apply = False
+
+    def test_compile_without_data(self):
+        derives = [[[['a'], ['b']], lambda a, b: (a + b,), [['c']]]]
+        plan = DictTransformer.compile('derive', derives)
+        assert len(plan) == 1
+        assert plan.spec is derives
+        self.assertRaises(ValueError, DictTransformer.compile, 'lift', [])
+
+    def test_matches_interpreted(self):
+        def blob():
+            return {'a': {'b': [{'c': 1}, {'c': 2}], 'd': 'e'},
+                    'f': ({'g': 3},),
+                    'h': 'i'}
+
+        copies = [[['a', 'd'], ['x', 'y']],
+                  [['a', 'b', 1, 'c'], ['z']],  # through a list
+                  [['missing', 'key'], ['nope']],
+                  [['h'], ['x', 'h']]]
+        moves = [[['a', 'd'], ['moved']],
+                 [['missing'], ['nope']]]
+        pops = [['f', 0, 'g'], ['h'], ['missing']]
+
+        for kind, spec, method in (('copy', copies, DictTransformer.copy),
+                                   ('move', moves, DictTransformer.move)):
+            expect, data = blob(), blob()
+            method(expect, spec, source_key_optional=True)
+            DictTransformer.compile(kind, spec, source_key_optional=True)(data)
+            assert data == expect, (kind, data, expect)
+
+        expect, data = blob(), blob()
+        removed = list(DictTransformer.pop(expect, pops, source_key_optional=True))
+        assert DictTransformer.compile('pop', pops, True)(data) == removed
+        assert data == expect, (data, expect)
+
+    def test_target_exists(self):
+        plan = DictTransformer.compile('copy', [[['a'], ['b']]])
+        self.assertRaises(exc.TargetPathExistsError, plan, {'a': 1, 'b': 2})
+TestCompiledPlans.populate()
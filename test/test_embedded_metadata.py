@@ -5,7 +5,7 @@ import pytest
 from pyontutils.utils import Async, deferred
 from sparcur.core import JEncode
 from sparcur.extract import xml as exml
-from .common import examples_root, RealDataHelper
+from .common import examples_root, temp_path, RealDataHelper
 
 export = False
 
@@ -20,6 +20,48 @@ class TestExtractMetadata(unittest.TestCase):
         error_types = set(e['validator'] for es in errors for e in es)
         assert error_types == {'not'} or not error_types, f'unexpected error type! {error_types}'
 
+    def test_streaming_same_as_tree(self):
+        x = examples_root / 'mbf-example.xml'
+        streamed = exml.ExtractXml(x)
+        try:
+            exml.ExtractMBF.streaming = False
+            tree = exml.ExtractXml(x)
+        finally:
+            exml.ExtractMBF.streaming = True
+
+        assert hasattr(streamed, '_streamed') and not hasattr(streamed, 'e')
+        assert streamed._extract() == tree._extract()
+
+    def test_sniff(self):
+        x = examples_root / 'mbf-example.xml'
+        tag, attrib = exml.ExtractXml._sniff(x)
+        assert tag == exml.ExtractMBF.top_tag
+        assert attrib['appname'] == 'Tissue Mapper'
+
+    def test_sniff_dispatch(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        try:
+            bad = temp_path / 'bad.xml'
+            bad.write_text('not xml at all')
+            assert isinstance(exml.ExtractXml(bad), exml.NotXml)
+
+            ves = temp_path / 'ves.xml'
+            ves.write_text('<mbf appname="Vesselucida"><contour name="x"/></mbf>')
+            assert isinstance(exml.ExtractXml(ves), exml.ExtractVesselucida)
+
+            unknown = temp_path / 'unknown.xml'
+            unknown.write_text('<wat><a/></wat>')
+            try:
+                exml.ExtractXml(unknown)
+                raise AssertionError('should have failed')
+            except NotImplementedError:
+                pass
+        finally:
+            temp_path.rmtree()
+
 
 class TestExtractMetadataReal(RealDataHelper, unittest.TestCase):
 
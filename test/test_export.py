@@ -0,0 +1,144 @@
+import json
+import unittest
+from sparcur.core import JEncode
+from sparcur.export.blobs import DatasetBlobStore, StoredDatasets
+from sparcur.export.core import JsonListStream
+from sparcur.curation import Summary
+from .common import temp_path
+
+
+class TestDatasetBlobStore(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        self.store = DatasetBlobStore(temp_path / 'blobs')
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def test_roundtrip(self):
+        id = 'N:dataset:fake-id'
+        self.store.put(id, 'fp1', {'id': id, 'meta': {}}, {'id': id})
+        assert self.store.exists(id, 'fp1')
+        assert not self.store.exists(id, 'fp2')
+        assert self.store.get_export(id, 'fp1') == {'id': id}
+        assert self.store.get_ir(id, 'fp1') == {'id': id, 'meta': {}}
+
+    def test_no_export(self):
+        id = 'N:dataset:fake-id'
+        self.store.put(id, 'fp1', {'id': id})
+        assert self.store.get_export(id, 'fp1') is None
+
+    def test_no_partial(self):
+        id = 'N:dataset:fake-id'
+        try:
+            self.store.put(id, 'fp1', {'id': id, 'bad': object()})
+            raise AssertionError('should have failed')
+        except TypeError:
+            pass
+
+        assert not self.store.exists(id, 'fp1')
+        assert not list((temp_path / 'blobs' / id).iterdir())
+
+    def test_evict(self):
+        self.store.max_size_mb = 0
+        self.store.put('N:dataset:a', 'fp1', {'id': 'a'})
+        self.store.put('N:dataset:b', 'fp1', {'id': 'b'})
+        self.store.evict(keep=[('N:dataset:a', 'fp1')])
+        assert self.store.exists('N:dataset:a', 'fp1')
+        assert not self.store.exists('N:dataset:b', 'fp1')
+
+    def test_stored_datasets(self):
+        self.store.put('N:dataset:a', 'fp1', {'id': 'a', 'prov': {}})
+        self.store.put('N:dataset:b', 'fp2', {'id': 'b', 'prov': {}})
+        stored = StoredDatasets(self.store, [('N:dataset:b', 'fp2'),
+                                             ('N:dataset:a', 'fp1')], 'now')
+        assert len(stored) == 2
+        assert [b['id'] for b in stored] == ['b', 'a']
+        # every pass reads the blobs again
+        assert [b['id'] for b in stored] == ['b', 'a']
+        assert stored[1] == {'id': 'a', 'prov': {'timestamp_export_start': 'now'}}
+        assert stored[0] is not stored[0]
+
+
+class TestSummaryReuse(unittest.TestCase):
+    id = 'N:dataset:fake-id'
+
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        self.store = DatasetBlobStore(temp_path / 'blobs')
+        self.store.put(self.id, 'fp1', {'id': self.id, 'prov': {}})
+
+        class FakeDataset:
+            id = self.id
+
+        self.datasets = [FakeDataset()]
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def _summary(self, previous):
+        # skip __init__, it needs a real project
+        summary = object.__new__(Summary)
+        summary._previous = previous
+        summary._blob_store = self.store
+        summary.fingerprints = {self.id: 'fp1'}
+        return summary
+
+    def test_full_rebuild_ignores_store(self):
+        todo, reused = self._summary(None)._split_reuse(self.datasets, 'now')
+        assert todo == self.datasets
+        assert not reused
+
+    def test_incremental_reuses_store(self):
+        todo, reused = self._summary({})._split_reuse(self.datasets, 'now')
+        assert not todo
+        assert reused == {self.id: None}  # read later from the store
+
+    def test_stale_export_removed(self):
+        self.store.put(self.id, 'fp2', {'id': self.id}, {'id': self.id})
+        self.store.put(self.id, 'fp2', {'id': self.id})
+        assert self.store.get_export(self.id, 'fp2') is None
+
+
+class TestJsonListStream(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def test_same_as_dump(self):
+        path = temp_path / 'test.json'
+        heads = ({'id': 'org', 'meta': {'count': 2}, 'prov': {}, 'aaa': [1]},
+                 {'id': 'org'},
+                 {},)
+        elements = [{'id': 1, 'x': [1, {'y': []}]}, {'id': 2, 'z': {}}]
+        for head in heads:
+            for els in (elements, []):
+                with JsonListStream(path, head, 'datasets') as stream:
+                    for element in els:
+                        stream.write(element)
+
+                expect = json.dumps({**head, 'datasets': els},
+                                    sort_keys=True, indent=2, cls=JEncode)
+                with open(path, 'rt') as f:
+                    assert f.read() == expect, (head, els)
+
+    def test_filled_at_end(self):
+        path = temp_path / 'test.json'
+        head = {'meta': {}}
+        with JsonListStream(path, head, 'datasets') as stream:
+            stream.write({'id': 1})
+            head['meta'] = {'count': stream.count}
+
+        with open(path, 'rt') as f:
+            assert json.load(f)['meta']['count'] == 1
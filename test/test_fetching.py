@@ -0,0 +1,110 @@
+import time
+import threading
+import unittest
+from types import SimpleNamespace
+from sparcur.fetching import FetchScheduler, TokenBucket
+
+
+def fake_path(name, size):
+    meta = SimpleNamespace(size=size)
+    return SimpleNamespace(name=name, cache=SimpleNamespace(meta=meta))
+
+
+class TestFetchScheduler(unittest.TestCase):
+    def test_order(self):
+        paths = [fake_path(str(i), s) for i, s in
+                 enumerate((10, 10 * 1024 ** 2, None, 5, 200 * 1024 ** 2))]
+        fs = FetchScheduler(small_workers=2, large_workers=1, large_mb=1)
+        assert fs(lambda p: p.name, paths) == [p.name for p in paths]
+
+    def test_unknown_size(self):
+        fs = FetchScheduler(large_mb=1)
+        no_cache = SimpleNamespace(name='no-cache', cache=None)
+        no_meta = SimpleNamespace(name='no-meta', cache=SimpleNamespace(meta=None))
+        paths = [fake_path('big', 1024 ** 2), fake_path('none', None),
+                 no_cache, no_meta, fake_path('small', 10)]
+        assert [fs.is_large(p) for p in paths] == [True, False, False, False, False]
+        assert fs(lambda p: p.name, paths) == [p.name for p in paths]
+
+    def test_small_not_blocked(self):
+        # the large queue has one worker stuck on a big file
+        # the small files should all finish anyway
+        release = threading.Event()
+        done = []
+        def function(path):
+            if path.cache.meta.size > 1024:
+                release.wait(5)
+            else:
+                done.append(path.name)
+                if len(done) == 20:
+                    release.set()
+
+            return path.name
+
+        paths = ([fake_path('big', 1024 ** 3)] +
+                 [fake_path(f's{i}', 10) for i in range(20)])
+        fs = FetchScheduler(small_workers=4, large_workers=1, large_mb=1)
+        start = time.monotonic()
+        fs(function, paths)
+        assert time.monotonic() - start < 4, 'small files waited on the big one'
+        assert len(done) == 20
+
+    def test_error(self):
+        def function(path):
+            if path.name == '1':
+                raise ValueError('oops')
+
+        paths = [fake_path(str(i), 10) for i in range(3)]
+        fs = FetchScheduler(small_workers=2)
+        try:
+            fs(function, paths)
+            raise AssertionError('should have failed')
+        except ValueError:
+            pass
+
+        assert fs._done == 3 and fs._failed == 1
+
+    def test_per_host(self):
+        fs = FetchScheduler(per_host=2)
+        active = []
+        peak = [0]
+        lock = threading.Lock()
+        def function(path):
+            with fs.connection('example.org'):
+                with lock:
+                    active.append(path)
+                    peak[0] = max(peak[0], len(active))
+
+                time.sleep(0.01)
+                with lock:
+                    active.remove(path)
+
+        fs(function, [fake_path(str(i), 10) for i in range(10)])
+        assert peak[0] <= 2
+
+    def test_bind(self):
+        class Remote:
+            _fetch_scheduler = None
+
+        fs = FetchScheduler()
+        fs.bind(Remote)
+        # chunks can arrive before the first run
+        fs.transferred(10)
+        assert fs._bytes == 10
+        other = FetchScheduler()
+        other.unbind(Remote)
+        assert Remote._fetch_scheduler is fs
+        fs.unbind(Remote)
+        assert Remote._fetch_scheduler is None
+
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        tb = TokenBucket(100)
+        start = time.monotonic()
+        for _ in range(150):
+            tb.consume()
+
+        # the first 100 are the burst, the last 50 wait ~0.5s
+        assert time.monotonic() - start >= 0.4
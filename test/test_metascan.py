@@ -0,0 +1,52 @@
+import unittest
+import augpathlib as aug
+from sparcur.paths import Path
+from sparcur.metascan import MetaTable
+from .common import temp_path
+
+
+class TestMetaTable(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        self.root = Path(temp_path) / 'dataset'
+        sub = self.root / 'sub' / 'subsub'
+        sub.mkdir(parents=True)
+        sub.parent.setxattrs(aug.PathMeta(id='N:collection:1').as_xattrs(prefix='bf'))
+        fetched = sub / 'fetched.txt'
+        fetched.write_text('hello')
+        fetched.setxattrs(aug.PathMeta(id='N:package:1', size=5,
+                                       updated='2021-01-01T00:00:00Z')
+                          .as_xattrs(prefix='bf'))
+        (self.root / 'local.txt').write_text('abc')  # no remote metadata
+        remote = self.root / 'sub' / 'remote.dat'
+        remote.symlink_to(aug.PathMeta(id='N:package:2', size=100, file_id=2,
+                                       updated='2022-01-01T00:00:00Z')
+                          .as_symlink(local_name=remote.name))
+        for i in range(20):
+            (self.root / f'x{i}').write_text('z')
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def test_scan(self):
+        # chunk smaller than the number of rows so the pool is used
+        MetaTable.chunk, chunk = 4, MetaTable.chunk
+        try:
+            table = MetaTable.fromPath(self.root)
+        finally:
+            MetaTable.chunk = chunk
+
+        size, dirs, files, missing = table.counts()
+        assert (size, dirs, files, missing) == (5 + 3 + 100 + 20, 2, 23, [])
+        # broken symlinks have not been fetched so they don't count
+        assert table.files_last_updated().year == 2021
+        assert sorted(table.dirs()) == ['sub', 'sub/subsub']
+        assert table.dir_metas['sub'].id == 'N:collection:1'
+
+    def test_matches_rchildren(self):
+        table = MetaTable.fromPath(self.root)
+        assert sorted(table.relpaths) == sorted(
+            c.relative_to(self.root).as_posix() for c in self.root.rchildren)
@@ -0,0 +1,71 @@
+import sqlite3
+import unittest
+import augpathlib as aug
+from sparcur.paths import Path
+from sparcur.metastore import MetaStore
+from .common import temp_path
+
+
+class TestMetaStore(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        self.ms = MetaStore(temp_path / 'metastore.db')
+
+    def tearDown(self):
+        self.ms.close()
+        temp_path.rmtree()
+
+    def test_bulk_roundtrip(self):
+        metas = [(f'N:package:{i}', aug.PathMeta(id=f'N:package:{i}', size=i))
+                 for i in range(1000)]
+        self.ms.bulk(metas)
+        got = self.ms.bulk_xattrs([id for id, _ in metas] + ['N:package:missing'])
+        assert len(got) == len(metas)
+        assert got['N:package:10', None].size == 10
+        assert self.ms.xattrs('N:package:999').size == 999
+
+    def test_merge_and_remove(self):
+        id = 'N:package:a'
+        self.ms.bulk([(id, aug.PathMeta(id=id, size=1))])
+        self.ms.setxattr(id, 'size', 2)
+        assert self.ms.xattrs(id).size == 2
+        assert self.ms.getxattr(id, 'id') == id
+        self.ms.remove(id)
+        assert self.ms.xattrs(id) is None
+
+    def test_package_with_two_files(self):
+        id = 'N:package:a'
+        folder = Path(temp_path) / 'package'
+        folder.mkdir()
+        for file_id, name in ((1, 'a.txt'), (2, 'b.txt')):
+            path = folder / name
+            path.write_text(name)
+            path.setxattrs(aug.PathMeta(id=id, file_id=file_id, size=file_id)
+                           .as_xattrs(prefix='bf'))
+
+        self.ms.backup(folder.children)
+        got = self.ms.bulk_xattrs([id])
+        assert {k:v.size for k, v in got.items()} == {(id, 1): 1, (id, 2): 2}
+        assert self.ms.xattrs((id, 2)).size == 2
+        assert self.ms.xattrs(id) is None
+        self.ms.remove((id, 1))
+        assert list(self.ms.bulk_xattrs([id])) == [(id, 2)]
+        self.ms.remove(id)
+        assert not self.ms.bulk_xattrs([id])
+
+    def test_rekey_old_table(self):
+        self.ms.close()
+        db_path = temp_path / 'old.db'
+        meta = aug.PathMeta(id='N:package:a', file_id=3, size=1)
+        conn = sqlite3.connect(db_path.as_posix())
+        with conn:
+            conn.execute('CREATE TABLE path_xattrs (id TEXT PRIMARY KEY, xattrs BLOB)')
+            conn.execute('INSERT INTO path_xattrs VALUES (?, ?)',
+                         ('N:package:a', meta.as_metastore(prefix='bf')))
+
+        conn.close()
+        self.ms = MetaStore(db_path)
+        assert self.ms.xattrs(('N:package:a', 3)).size == 1
@@ -0,0 +1,71 @@
+import os
+import hashlib
+import unittest
+from sparcur.paths import Path
+from sparcur.objects import ObjectStore
+from .common import temp_path
+
+
+class TestObjectStore(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        self.objects = Path(temp_path) / 'objects'
+        self.objects.mkdir(parents=True)
+        self.store = ObjectStore(self.objects)
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def _download(self, key, data):
+        kp = self.store.key_path(key)
+        kp.write_bytes(data)
+        checksum = hashlib.sha256(data).digest()
+        self.store.add(key, checksum)
+        return checksum
+
+    def test_dedup(self):
+        data = b'template'
+        checksum = self._download('N:package:1-1', data)
+        # a second package with the same content is found by checksum
+        found = self.store.lookup('N:package:2-2', checksum)
+        assert found == self.store.path(checksum)
+        self.store.link('N:package:2-2', checksum)
+        assert self.store.key_path('N:package:2-2').read_bytes() == data
+        # and by key alone when the checksum is not known
+        assert self.store.lookup('N:package:1-1') == found
+        assert len(list(self.store.content_dir.rglob('*'))) == 2  # prefix dir and one object
+
+    def test_missing(self):
+        assert self.store.lookup('N:package:3-3') is None
+        assert self.store.lookup('N:package:3-3', b'\x00' * 32) is None
+
+    def test_evict(self):
+        checksums = [self._download(f'N:package:{i}-{i}', bytes([i]) * 1024 ** 2)
+                     for i in range(4)]
+        for i, c in enumerate(checksums):
+            os.utime(self.store.path(c), (i, i))
+
+        self.store.lookup('N:package:0-0')  # most recently used now
+        self.store.evict(2, keep=checksums[1:2])
+        remaining = [c for c in checksums if self.store.path(c).exists()]
+        assert remaining == checksums[:2], remaining
+        # dangling links are cleaned up
+        assert not self.store.key_path('N:package:2-2').is_symlink()
+        assert self.store.key_path('N:package:1-1').exists()
+
+    def test_evict_key_files(self):
+        checksum = self._download('N:package:0-0', b'0' * 1024 ** 2)
+        os.utime(self.store.path(checksum), (0, 0))
+        # a partial download and a pre store object at their keys
+        for i in (1, 2):
+            self.store.key_path(f'N:package:{i}-{i}').write_bytes(b'x' * 1024 ** 2)
+
+        self.store.evict(2)
+        # the oldest content goes first, the key files count toward the limit
+        assert not self.store.path(checksum).exists()
+        assert not self.store.key_path('N:package:0-0').is_symlink()
+        assert self.store.key_path('N:package:1-1').exists()
+        self.store.evict(0)
+        assert not [p for p in self.store.objects_dir.rglob('*') if p.is_file()]
@@ -0,0 +1,111 @@
+import time
+import sqlite3
+import unittest
+import augpathlib as aug
+from sparcur.paths import Path
+from sparcur.pathindex import PathIndex
+from .common import temp_path
+
+
+class TestPathIndex(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        self.project_path = Path(temp_path) / 'project'
+        self.dataset = self.project_path / 'dataset'
+        sub = self.dataset / 'sub'
+        sub.mkdir(parents=True)
+        for path, meta in ((self.dataset, aug.PathMeta(id='N:dataset:1')),
+                           (sub, aug.PathMeta(id='N:collection:2'))):
+            path.setxattrs(meta.as_xattrs(prefix='bf'))
+
+        local = sub / 'local.txt'
+        local.write_text('hello')
+        local.setxattrs(aug.PathMeta(id='N:package:3', size=5, file_id=1,
+                                     updated='2020-01-01T00:00:00Z')
+                        .as_xattrs(prefix='bf'))
+        remote = sub / 'remote.txt'
+        remote.symlink_to(aug.PathMeta(id='N:package:4', size=100, file_id=2,
+                                       updated='2021-01-01T00:00:00Z')
+                          .as_symlink(local_name=remote.name))
+        (self.dataset / 'not-from-remote.txt').write_text('local only')
+        self.index = PathIndex(temp_path / 'path-index.db', self.project_path)
+        self.index.index_dataset(self.dataset)
+
+    def tearDown(self):
+        self.index.close()
+        temp_path.rmtree()
+
+    def test_goto(self):
+        row, = self.index.by_id('N:package:4')
+        assert row.relpath == 'dataset/sub/remote.txt'
+        assert row.parent_id == 'N:collection:2'
+        assert not self.index.by_id('N:package:nope')
+
+    def test_tofetch(self):
+        local, remote, uncertain, lf, rf, td = self.index.size_counts('dataset')
+        assert (local, remote, uncertain, lf, rf, td) == (5, 100, False, 1, 1, 1)
+
+    def test_updated(self):
+        assert self.index.updated_max('dataset').year == 2021
+
+    def test_reindex(self):
+        (self.dataset / 'sub' / 'remote.txt').unlink()
+        self.index.index_dataset(self.dataset)
+        assert not self.index.by_id('N:package:4')
+        assert len(self.index.under('dataset/sub', files_only=True)) == 1
+
+    def test_remove(self):
+        self.index.remove(['dataset/sub/remote.txt'])
+        assert not self.index.by_id('N:package:4')
+        assert self.index.by_id('N:package:3')
+
+    def test_pull_state(self):
+        assert self.index.pull_state('N:dataset:1') is None
+        self.index.set_pull_state('N:dataset:1', 1.5, {'Collection': 1})
+        assert self.index.pull_state('N:dataset:1') == (1.5, {'Collection': 1})
+
+    def test_fingerprint_cache(self):
+        state = self.index.dataset_state('dataset', extra=('helpers',))
+        assert self.index.dataset_state('not-indexed') is None
+        assert self.index.fingerprint('N:dataset:1', state) is None
+        self.index.set_fingerprint('N:dataset:1', state, 'fp1')
+        assert self.index.fingerprint('N:dataset:1', state) == 'fp1'
+        assert self.index.dataset_state('dataset', extra=('other',)) != state
+
+        local = self.dataset / 'sub' / 'local.txt'
+        local.setxattrs(aug.PathMeta(id='N:package:3', size=6, file_id=1,
+                                     updated='2022-01-01T00:00:00Z')
+                        .as_xattrs(prefix='bf'))
+        self.index.update((local,))
+        new_state = self.index.dataset_state('dataset', extra=('helpers',))
+        assert new_state != state
+        assert self.index.fingerprint('N:dataset:1', new_state) is None
+
+    def test_current(self):
+        local = self.dataset / 'sub' / 'local.txt'
+        row, = self.index.by_id('N:package:3')
+        assert self.index.current(row, local)
+        time.sleep(0.01)
+        local.write_text('fetched again')
+        assert not self.index.current(row, local)
+        self.index.update((local,))
+        row, = self.index.by_id('N:package:3')
+        assert self.index.current(row, local)
+
+    def test_add_indexed_column(self):
+        db_path = temp_path / 'old-index.db'
+        conn = sqlite3.connect(db_path.as_posix())
+        conn.execute('CREATE TABLE paths (relpath TEXT PRIMARY KEY, id TEXT NOT NULL, '
+                     'parent_id TEXT, dataset_id TEXT, is_dir INTEGER, size INTEGER, '
+                     'updated REAL, checksum BLOB, file_id INTEGER, fetched INTEGER)')
+        conn.close()
+        index = PathIndex(db_path, self.project_path)
+        try:
+            index.index_dataset(self.dataset)
+            row, = index.by_id('N:package:3')
+            assert row.indexed is not None
+        finally:
+            index.close()
@@ -0,0 +1,430 @@
+import os
+import hashlib
+import unittest
+import augpathlib as aug
+from sparcur import exceptions as exc
+from sparcur.paths import Path, BlackfynnCache
+from sparcur.objects import ObjectStore
+from sparcur.backends import BlackfynnRemote
+from sparcur.pathindex import PathIndex
+from .common import temp_path
+
+
+class TestChecksumStamp(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        self.path = Path(temp_path) / 'data.bin'
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def test_write_stamps(self):
+        chunks = [b'a' * 4096, b'b' * 10]
+        self.path.data = iter(chunks)
+        expect = hashlib.sha256(b''.join(chunks)).digest()
+        assert self.path._checksum_stamped(hashlib.sha256) == expect
+        assert self.path.checksum() == expect
+
+    def test_modified(self):
+        self.path.data = iter([b'hello'])
+        with open(self.path, 'ab') as f:
+            f.write(b' there')
+
+        assert self.path._checksum_stamped(hashlib.sha256) is None
+        assert self.path.checksum() == hashlib.sha256(b'hello there').digest()
+        # reading never stamps
+        assert self.path._checksum_stamped(hashlib.sha256) is None
+
+    def test_replaced(self):
+        self.path.data = iter([b'hello'])
+        other = self.path.with_name('other.bin')
+        other.write_bytes(b'HELLO')
+        key = self.path._checksum_key
+        other.setxattr(key, self.path.getxattr(key))
+        st = self.path.stat()
+        os.utime(other, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(other, self.path)
+        # same stamp, size, and mtime but a different file
+        assert self.path._checksum_stamped(hashlib.sha256) is None
+        assert self.path.checksum() == hashlib.sha256(b'HELLO').digest()
+
+    def test_no_stamp_on_size_mismatch(self):
+        self.path.write_bytes(b'hello there')
+        self.path._stamp_checksum(hashlib.sha256, hashlib.sha256(b'hello').digest(), 5)
+        assert self.path._checksum_stamped(hashlib.sha256) is None
+
+
+class FakeRemote:
+    def __init__(self, parts, meta):
+        self.parts = parts
+        self.meta = meta
+
+    def _parts_relative_to(self, remote):
+        return self.parts
+
+    def is_dir(self):
+        return self.meta.file_id is None
+
+
+class FakeDatasetRemote:
+    _exclude_uploaded = False
+    listing = []
+
+    def _rchildren(self, create_cache=True, exclude_uploaded=False):
+        yield from self.listing
+
+
+class FakeCache:
+    _remote_class = FakeDatasetRemote
+    anchor = None
+
+    def __init__(self, local):
+        self.local = local
+        self.remote = FakeDatasetRemote()
+
+    def crumple(self):
+        DiffPath.trashed.append(self.local.name)
+        if self.local.is_dir():
+            self.local.rmdir()
+        else:
+            self.local.unlink()
+
+    def _meta_setter(self, meta):
+        self.local.setxattrs(meta.as_xattrs(prefix='bf'))
+
+    def _make_child(self, parts, child):
+        local = self.local.joinpath(*parts)
+        if child.is_dir():
+            local.mkdir()
+        else:
+            local.write_bytes(b'x' * child.meta.size)
+
+        FakeCache(local)._meta_setter(child.meta)
+        return FakeCache(local)
+
+
+class DiffPath(Path):
+    trashed = []
+    _remote_class = FakeDatasetRemote
+
+    @property
+    def cache(self):
+        return FakeCache(self)
+
+    def _index_dataset(self):
+        pass
+
+    def _gc_upstream(self):
+        pass
+
+    def _pull_dataset_internal(self, time_now):
+        return 'full'
+
+DiffPath._bind_flavours()
+
+
+class TestPullDatasetDiff(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        DiffPath.trashed = []
+        self.dataset = DiffPath(temp_path) / 'dataset'
+        self.dataset.mkdir()
+        self.listing = [self._remote(('folder',), 'N:collection:1'),
+                        self._remote(('folder', 'a.txt'), 'N:package:2', 1),
+                        self._remote(('b.txt',), 'N:package:3', 1),
+                        self._remote(('c.txt',), 'N:package:4', 1),
+                        self._remote(('d.txt',), 'N:package:5', 1),]
+        cache = self.dataset.cache
+        for child in self.listing:
+            cache._make_child(child.parts, child)
+
+    def tearDown(self):
+        FakeDatasetRemote.listing = []
+        temp_path.rmtree()
+
+    @staticmethod
+    def _remote(parts, id, file_id=None, size=1, updated='2020-01-01T00:00:00Z'):
+        return FakeRemote(parts, aug.PathMeta(id=id, file_id=file_id, size=size,
+                                              updated=updated))
+
+    def _pull(self, *changes):
+        FakeDatasetRemote.listing = [c for c in self.listing if c.meta.id not in
+                                     [n.meta.id for n in changes]] + list(changes)
+        return self.dataset._pull_dataset(None, False, diff=True)
+
+    def _meta(self, *parts):
+        return aug.PathMeta.from_xattrs(self.dataset.joinpath(*parts).xattrs(),
+                                        prefix='bf')
+
+    def test_no_changes(self):
+        self._pull()
+        assert not DiffPath.trashed
+
+    def test_rename(self):
+        self._pull(self._remote(('e.txt',), 'N:package:3', 1))
+        assert not (self.dataset / 'b.txt').exists()
+        assert self._meta('e.txt').id == 'N:package:3'
+        assert not DiffPath.trashed
+
+    def test_folder_move(self):
+        self._pull(self._remote(('moved',), 'N:collection:1'),
+                   self._remote(('moved', 'a.txt'), 'N:package:2', 1))
+        assert not (self.dataset / 'folder').exists()
+        assert self._meta('moved', 'a.txt').id == 'N:package:2'
+        assert not DiffPath.trashed
+
+    def test_changed(self):
+        self._pull(self._remote(('c.txt',), 'N:package:4', 1, size=3,
+                                updated='2021-01-01T00:00:00Z'))
+        assert DiffPath.trashed == ['c.txt']
+        assert (self.dataset / 'c.txt').read_bytes() == b'xxx'
+        assert self._meta('c.txt').updated.year == 2021
+
+    def test_moved_and_changed(self):
+        self._pull(self._remote(('moved',), 'N:collection:1', size=None,
+                                updated='2021-01-01T00:00:00Z'),
+                   self._remote(('moved', 'a.txt'), 'N:package:2', 1))
+        assert self._meta('moved').updated.year == 2021
+
+    def test_removed(self):
+        self.listing = [c for c in self.listing if c.meta.id != 'N:package:5']
+        self._pull()
+        assert DiffPath.trashed == ['d.txt']
+        assert not (self.dataset / 'd.txt').exists()
+
+    def test_conflict_fallback(self):
+        (self.dataset / 'new.txt').write_text('local only')
+        assert self._pull(self._remote(('new.txt',), 'N:package:6', 1)) == 'full'
+        assert (self.dataset / 'new.txt').read_text() == 'local only'
+
+
+class FakeResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {}
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), 4):  # small to hit the skip split
+            yield self.content[i:i + 4]
+
+
+class FakeRequests:
+    def __init__(self, content, ranges=True, sent=None):
+        self.content = content
+        self.ranges = ranges
+        self.sent = content if sent is None else sent
+        self.starts = []
+
+    def get(self, url, stream=False, headers=None):
+        start = int(headers['Range'][6:-1]) if headers else 0
+        self.starts.append(start)
+        if start and self.ranges:
+            return FakeResponse(206, self.sent[start:])
+
+        return FakeResponse(200, self.sent)
+
+
+class FileRemote(BlackfynnRemote):
+    _api = None  # already bound as far as data is concerned
+
+    @classmethod
+    def get_file_url(cls, id, file_id):
+        return f'https://example.org/{id}/{file_id}'
+
+
+class FakeFileCache:
+    """ just enough of a BlackfynnCache to run data """
+    _remote_class = FileRemote
+
+    def __init__(self, objects, meta):
+        self.object_store = ObjectStore(objects)
+        self.meta = meta
+        self.cache_key = f'{meta.id}-{meta.file_id}'
+
+    def is_dir(self):
+        return False
+
+    def cypher(self):
+        return hashlib.sha256()
+
+
+class TestFetchResume(unittest.TestCase):
+    content = b'hello there world'
+
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        self.objects = Path(temp_path) / 'objects'
+        self.objects.mkdir(parents=True)
+
+    def tearDown(self):
+        FileRemote._requests = None
+        temp_path.rmtree()
+
+    def _cache(self, size=len(content), checksum=hashlib.sha256(content).digest()):
+        meta = aug.PathMeta(id='N:package:1', file_id=1, size=size, checksum=checksum)
+        return FakeFileCache(self.objects, meta)
+
+    def _data(self, cache, partial=None, **kwargs):
+        FileRemote._requests = requests = FakeRequests(self.content, **kwargs)
+        if partial is not None:
+            cache.object_store.key_path(cache.cache_key).write_bytes(partial)
+
+        return b''.join(BlackfynnCache.data.fget(cache)), requests
+
+    def _stored(self, cache, checksum=hashlib.sha256(content).digest()):
+        kp = cache.object_store.key_path(cache.cache_key)
+        return kp.is_symlink() and kp.resolve() == cache.object_store.path(checksum)
+
+    def test_resume(self):
+        cache = self._cache()
+        data, requests = self._data(cache, self.content[:6])
+        assert data == self.content
+        assert requests.starts == [6]
+        assert self._stored(cache)
+
+    def test_range_ignored(self):
+        cache = self._cache()
+        data, requests = self._data(cache, self.content[:6], ranges=False)
+        assert data == self.content
+        assert requests.starts == [6]
+        assert self._stored(cache)
+
+    def test_incomplete(self):
+        cache = self._cache()
+        with self.assertRaises(exc.IncompleteDownloadError):
+            self._data(cache, sent=self.content[:9])
+
+        # the partial is kept for the next fetch
+        kp = cache.object_store.key_path(cache.cache_key)
+        assert kp.read_bytes() == self.content[:9]
+        data, requests = self._data(cache)
+        assert data == self.content
+        assert requests.starts == [9]
+
+    def test_checksum_mismatch(self):
+        cache = self._cache(checksum=b'\x00' * 32)
+        with self.assertRaises(exc.ChecksumMismatchError):
+            self._data(cache)
+
+        assert not cache.object_store.key_path(cache.cache_key).exists()
+
+    def test_empty_partial(self):
+        # the first chunk failed after the metadata was written
+        cache = self._cache()
+        data, requests = self._data(cache, b'')
+        assert data == self.content
+        assert requests.starts == [0]
+        assert self._stored(cache)
+
+    def test_partial_bad_checksum(self):
+        cache = self._cache()
+        with self.assertRaises(exc.ChecksumMismatchError):
+            self._data(cache, b'garbage')
+
+        # the bad partial is gone so the next fetch starts over
+        assert not cache.object_store.key_path(cache.cache_key).exists()
+        data, requests = self._data(cache)
+        assert data == self.content
+        assert requests.starts == [0]
+
+    def test_complete_key_file(self):
+        # objects from before the store are used if they check out
+        cache = self._cache()
+        data, requests = self._data(cache, self.content)
+        assert data == self.content
+        assert requests.starts == []
+        assert self._stored(cache)
+
+    def test_complete_key_file_bad_checksum(self):
+        cache = self._cache()
+        data, requests = self._data(cache, b'x' * len(self.content))
+        assert data == self.content
+        assert requests.starts == [0]
+        assert self._stored(cache)
+
+    def test_no_size_no_checksum(self):
+        cache = self._cache(size=None, checksum=None)
+        data, requests = self._data(cache)
+        assert data == self.content
+        # stored under the checksum computed while streaming
+        assert self._stored(cache)
+
+
+class FakeDatasetChild:
+    def __init__(self, cache_id):
+        self.cache_id = cache_id
+
+    def pull(self, **kwargs):
+        OrgPath.pulled.append(self.cache_id)
+
+
+class FakeOrgCache:
+    anchor = None
+
+    def is_organization(self):
+        return True
+
+
+class OrgPath(Path):
+    pulled = []
+    states = {}
+    queried = False
+
+    @property
+    def cache(self):
+        return FakeOrgCache()
+
+    @property
+    def children(self):
+        return [FakeDatasetChild(f'N:dataset:{i}') for i in range(3)]
+
+    @property
+    def path_index(self):
+        return PathIndex(temp_path / 'path-index.db', temp_path)
+
+    def _remote_dataset_states(self, children):
+        OrgPath.queried = True
+        return self.states
+
+OrgPath._bind_flavours()
+
+
+class TestPullChangedOnly(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir()
+        OrgPath.pulled = []
+        OrgPath.queried = False
+        OrgPath.states = {f'N:dataset:{i}': (1.0, {'csv': i}) for i in range(3)}
+        self.org = OrgPath(temp_path)
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def _pull(self, **kwargs):
+        OrgPath.pulled = []
+        self.org.pull(debug=True, **kwargs)
+        return OrgPath.pulled
+
+    def test_skip_unchanged(self):
+        assert len(self._pull(changed_only=True)) == 3
+        assert self._pull(changed_only=True) == []
+        OrgPath.states['N:dataset:1'] = (2.0, {'csv': 1})
+        assert self._pull(changed_only=True) == ['N:dataset:1']
+
+    def test_no_states_without_changed_only(self):
+        assert len(self._pull()) == 3
+        assert not OrgPath.queried
+        # nothing was recorded so changed_only pulls everything
+        assert len(self._pull(changed_only=True)) == 3
@@ -1,10 +1,15 @@
+import time
 import unittest
+import threading
+import multiprocessing
 from pathlib import Path
 import pytest
 from sparcur import apinat
+from sparcur import exceptions as exc
 from sparcur import pipelines as pipes
 from .common import (examples_root,
                      project_path,
+                     temp_path,
                      RealDataHelper,
                      )
 
@@ -41,6 +46,167 @@ class TestDatasetDescription(unittest.TestCase):
         # TODO test as subpipeline ?
 
 
+class TestMemoizedStages(unittest.TestCase):
+    def test_single_evaluation(self):
+        calls = []
+        class Start(pipes.Pipeline):
+            @property
+            def data(self):
+                calls.append('start')
+                return {'a': 1}
+
+        class Moves(pipes.JSONPipeline):
+            moves = [[['a'], ['b']]]
+            @property
+            def moved(self):
+                data = super().moved
+                calls.append('moved')
+                return data
+
+        p = Moves(Start())
+        assert p.data == {'b': 1}
+        # a second move would fail to find a and lose b
+        assert p.data == {'b': 1}
+        assert calls == ['start', 'moved'], calls
+        assert 'JSONPipeline.moved' in p.stage_times
+        assert [k for k in p.stage_times if k.endswith('<locals>.Moves.moved')]
+        p.invalidate()
+        assert p.data == {'b': 1}
+        assert calls == ['start', 'moved'] * 2, calls
+
+
+class TestSubpipelineFanout(unittest.TestCase):
+    def _pipelines(self, barrier=None, fail=None, built=None):
+        class Start(pipes.Pipeline):
+            @property
+            def data(self):
+                return {'a': 1, 'b': 2, 'c': 3}
+
+        class Double(pipes.Pipeline):
+            def __init__(self, previous_pipeline, lifters, runtime_context):
+                self.previous_pipeline = previous_pipeline
+                if built is not None:
+                    built.append(previous_pipeline.data['value'])
+
+            @property
+            def data(self):
+                value = self.previous_pipeline.data['value']
+                if value == fail:
+                    raise ValueError(value)
+
+                if barrier is not None and value < 3:
+                    barrier.wait()  # only passes if both run at the same time
+
+                return value * 2
+
+        class Fan(pipes.JSONPipeline):
+            subpipelines = [[[[[k], ['value']]], Double, [k + '_out']]
+                            for k in ('a', 'b', 'c')]
+
+        return Start, Fan
+
+    def test_concurrent(self):
+        Start, Fan = self._pipelines(threading.Barrier(2, timeout=10))
+        Fan._subpipeline_jobs = 3
+        data = Fan(Start()).data
+        assert list(data) == ['a', 'b', 'c', 'a_out', 'b_out', 'c_out'], list(data)
+        assert [data[k + '_out'] for k in 'abc'] == [2, 4, 6]
+
+    def test_serial_matches(self):
+        Start, Fan = self._pipelines()
+        serial = Fan(Start()).data
+        Fan._subpipeline_jobs = 3
+        assert Fan(Start()).data == serial
+
+    def test_error_order(self):
+        Start, Fan = self._pipelines(fail=2)
+        Fan._subpipeline_jobs = 3
+        with self.assertRaises(exc.SubPipelineError) as cm:
+            Fan(Start()).data
+
+        assert isinstance(cm.exception.__cause__, ValueError)
+
+    def test_serial_lazy(self):
+        built = []
+        Start, Fan = self._pipelines(fail=1, built=built)
+        with self.assertRaises(exc.SubPipelineError):
+            Fan(Start()).data
+
+        # later subpipelines are not constructed before an earlier one fails
+        assert built == [1], built
+
+
+class Reverse(pipes.Pipeline):
+    """ module level so the process pool can pickle it """
+    def __init__(self, previous_pipeline, lifters, runtime_context):
+        self.previous_pipeline = previous_pipeline
+
+    @property
+    def data(self):
+        path = self.previous_pipeline.data['path']
+        # later paths finish first so ordering has to be restored
+        time.sleep(0.01 * (int(path.name) % 3 == 0))
+        return path.name[::-1]
+
+
+def _worker_mode(paths):
+    class Start(pipes.Pipeline):
+        data = {'paths': paths}
+
+    mpc = pipes.MapPathsCombinator(Reverse, n_jobs=4)(Start(), None, None)
+    mpc.process_min_mb = 0
+    mpc.process_min_file_mb = 0
+    return mpc._mode()
+
+
+class TestMapPathsCombinator(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        temp_path.mkdir(parents=True)
+        self.paths = []
+        for i in range(40):
+            path = temp_path / f'{i:0>2}'
+            path.write_bytes(b'x' * 10)
+            self.paths.append(path)
+
+        class Start(pipes.Pipeline):
+            data = {'paths': self.paths}
+
+        self.start = Start()
+        self.expect = [p.name[::-1] for p in self.paths]
+
+    def tearDown(self):
+        temp_path.rmtree()
+
+    def test_auto_mode(self):
+        mpc = pipes.MapPathsCombinator(Reverse, n_jobs=4)(self.start, None, None)
+        assert mpc._mode() == 'thread'
+        mpc.process_min_mb = 0
+        mpc.process_min_file_mb = 0
+        assert mpc._mode() == 'process'
+        mpc = pipes.MapPathsCombinator(Reverse, n_jobs=1)(self.start, None, None)
+        assert mpc._mode() == 'serial'
+
+    def test_serial_by_default(self):
+        mpc = pipes.MapPathsCombinator(Reverse)(self.start, None, None)
+        assert mpc._mode() == 'serial'
+
+    def test_auto_mode_pool_worker(self):
+        # export workers are daemonic and cannot start a process pool
+        assert _worker_mode(self.paths) == 'process'
+        with multiprocessing.Pool(1) as pool:
+            assert pool.apply(_worker_mode, (self.paths,)) == 'thread'
+
+    def test_modes_ordered(self):
+        for mode in ('serial', 'thread', 'process'):
+            mpc = pipes.MapPathsCombinator(Reverse, n_jobs=4, mode=mode)
+            mpc.window = 1  # force more than one window
+            mpc.batch_size = 2
+            assert mpc(self.start, None, None).data == self.expect, mode
+
+
 class PipelineHelper:
 
     @classmethod
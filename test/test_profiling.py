@@ -0,0 +1,65 @@
+import json
+import time
+import unittest
+from sparcur.paths import Path
+from sparcur.profiling import PipelineProfiler
+from .common import temp_path
+
+
+class TestPipelineProfiler(unittest.TestCase):
+    def setUp(self):
+        if temp_path.exists():
+            temp_path.rmtree()
+
+        self.profile_dir = Path(temp_path) / 'profile'
+        self.profile_dir.mkdir(parents=True)
+        self.profiler = PipelineProfiler()
+        self.profiler.start()
+
+    def tearDown(self):
+        self.profiler.stop()
+        temp_path.rmtree()
+
+    def test_disabled(self):
+        self.profiler.stop()
+        with self.profiler.dataset('d'):
+            with self.profiler.measure('stage', 'a'):
+                pass
+
+            assert not self.profiler.records()
+
+    def test_nested(self):
+        with self.profiler.dataset('d'):
+            with self.profiler.measure('stage', 'outer'):
+                with self.profiler.measure('derive', 'inner'):
+                    big = bytearray(1024 ** 2)
+                    time.sleep(0.02)
+
+                del big
+
+            records = {r['name']:r for r in self.profiler.records()}
+
+        outer, inner = records['outer'], records['inner']
+        assert outer['seconds'] >= inner['seconds']
+        assert outer['self_seconds'] < inner['self_seconds']
+        assert inner['peak_bytes'] >= 1024 ** 2
+        # the peak inside a child still counts for the parent
+        assert outer['peak_bytes'] >= inner['peak_bytes']
+
+    def test_report(self):
+        for id in ('d1', 'd2'):
+            with self.profiler.dataset(id):
+                with self.profiler.measure('stage', 'data'):
+                    time.sleep(0.01 if id == 'd1' else 0.03)
+
+                self.profiler.dump(self.profile_dir / f'{id}.json')
+
+        json_path = self.profile_dir.parent / 'profile.json'
+        table_path = self.profile_dir.parent / 'profile.txt'
+        table = PipelineProfiler.report(self.profile_dir, json_path, table_path)
+        with open(json_path, 'rt') as f:
+            blob = json.load(f)
+
+        assert [d['id'] for d in blob['datasets']] == ['d2', 'd1']
+        assert 'data' in table
+        assert table_path.exists()
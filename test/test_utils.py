@@ -0,0 +1,27 @@
+import unittest
+from sparcur.utils import Concurrency
+
+
+class TestConcurrency(unittest.TestCase):
+    def test_default(self):
+        c = Concurrency.fromString('12')
+        assert all(c(stage) == 12 for stage in Concurrency.stages)
+
+    def test_overrides(self):
+        c = Concurrency.fromString('export=32,xml=4')
+        assert c('export') == 32
+        assert c('xml') == 4
+        assert c('pull') == 12
+
+    def test_auto(self):
+        c = Concurrency.fromString('auto,xml=4')
+        assert c('xml') == 4
+        assert all(c(stage) >= 1 for stage in Concurrency.stages)
+
+    def test_bad(self):
+        for bad in ('0', 'export=-1', 'not-a-stage=3', 'lol'):
+            try:
+                Concurrency.fromString(bad)
+                raise AssertionError(f'should have failed {bad}')
+            except ValueError:
+                pass